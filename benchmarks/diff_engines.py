@@ -0,0 +1,51 @@
+'''
+Compares the run time of the diff engines on a generated state.
+
+Usage:
+    PYTHONPATH=. python benchmarks/diff_engines.py [<routers>] [<interfaces>]
+'''
+
+import sys
+import time
+import copy
+
+from desired_state.diff import DIFF_ENGINES
+from desired_state.keyed_diff import build_list_keys
+
+
+RULES = {'rules': [{'rule_selector': 'root.routers.index',
+                    'list_key': 'name'},
+                   {'rule_selector': 'root.routers.index.interfaces.index',
+                    'list_key': 'name'}]}
+
+
+def make_state(routers, interfaces):
+    return {'routers': [{'name': f'R{i}',
+                         'interfaces': [{'name': f'eth{j}',
+                                         'ip_address': f'10.{i % 256}.{j % 256}.1'}
+                                        for j in range(interfaces)]}
+                        for i in range(routers)]}
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    routers = int(args[0]) if len(args) > 0 else 1000
+    interfaces = int(args[1]) if len(args) > 1 else 4
+
+    t1 = make_state(routers, interfaces)
+    t2 = copy.deepcopy(t1)
+    t2['routers'][routers // 2]['interfaces'][0]['ip_address'] = '192.168.0.1'
+    t2['routers'].append({'name': 'new', 'interfaces': []})
+    t2['routers'].reverse()
+
+    list_keys = build_list_keys(RULES)
+
+    for name, engine in sorted(DIFF_ENGINES.items()):
+        start = time.perf_counter()
+        diff = engine(t1, t2, list_keys)
+        print(f'{name:10} {time.perf_counter() - start:8.3f}s {len(diff)} change types')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+'''
+Reuse of SSH connections between playbook runs.
+
+Every PlaybookRunner run starts a new ansible-playbook which opens new SSH
+connections to every host it targets.   ConnectionCache keeps SSH ControlMaster
+sockets for one monitor in a directory that lives as long as the monitor and
+lets the master connections persist between runs so that consecutive runs
+reuse the connections instead of negotiating new ones.
+
+The rules file enables connection reuse with the number of seconds an idle
+connection is kept and optionally opens the connections to all hosts in the
+inventory when the monitor starts:
+
+    control_persist: 600
+    prewarm_connections: true
+
+The ControlPersist options are added after the ssh_args of the Ansible
+configuration of the project so that the SSH options of the user are kept and
+take precedence.
+'''
+
+import os
+import glob
+import shutil
+import tempfile
+import subprocess
+import configparser
+
+
+PREWARM_PLAY = {'name': 'prewarm connections',
+                'hosts': 'all',
+                'gather_facts': False,
+                'ignore_errors': True,
+                'ignore_unreachable': True,
+                'tasks': [{'ping': None, 'name': 'open connection'}]}
+
+
+class ConnectionCache(object):
+
+    '''
+    ConnectionCache holds the SSH control socket directory of one monitor.
+    '''
+
+    def __init__(self, persist, directory=None, ssh_args=None):
+        self.persist = persist
+        self.directory = directory
+        self.ssh_args = ssh_args
+
+    def envvars(self):
+        '''
+        Returns the environment variables that make ansible use the shared
+        control sockets.   These are settings of the ssh connection so the
+        ansible_ssh_args and ansible_control_path_dir vars of the inventory
+        still take precedence.
+        '''
+
+        if self.directory is None:
+            # ControlPath must fit in a unix socket path so keep this short
+            self.directory = tempfile.mkdtemp(prefix='ds_cp')
+        control_persist = f'-o ControlMaster=auto -o ControlPersist={self.persist}s'
+        if self.ssh_args is None:
+            ssh_args = '-C ' + control_persist
+        else:
+            # ssh uses the first value of an option so the options of the
+            # user win over these
+            ssh_args = f'{self.ssh_args} {control_persist}'
+        return {'ANSIBLE_SSH_CONTROL_PATH_DIR': self.directory,
+                'ANSIBLE_SSH_ARGS': ssh_args}
+
+    def prewarm_play(self):
+        return dict(PREWARM_PLAY, tasks=[dict(task) for task in PREWARM_PLAY['tasks']])
+
+    def close(self):
+        '''
+        Stops the master connections and removes the control socket directory.
+        '''
+
+        if self.directory is None:
+            return
+        for control_path in glob.glob(os.path.join(self.directory, '*')):
+            subprocess.call(['ssh', '-o', f'ControlPath={control_path}', '-O', 'exit', 'desired-state'],
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+
+
+def ansible_config_file(project_src):
+    '''
+    Returns the ansible.cfg that ansible-playbook reads when it runs in the
+    project or None.   This is the first file found in the same order as
+    Ansible.
+    '''
+
+    paths = []
+    if 'ANSIBLE_CONFIG' in os.environ:
+        path = os.path.expanduser(os.environ['ANSIBLE_CONFIG'])
+        if os.path.isdir(path):
+            path = os.path.join(path, 'ansible.cfg')
+        paths.append(path)
+    paths.append(os.path.join(project_src, 'ansible.cfg'))
+    paths.append(os.path.expanduser('~/.ansible.cfg'))
+    paths.append('/etc/ansible/ansible.cfg')
+    for path in paths:
+        if os.path.exists(path) and os.access(path, os.R_OK):
+            return path
+    return None
+
+
+def configured_ssh_args(project_src):
+    '''
+    Returns the ssh_args that the environment or the Ansible configuration of
+    the project sets or None.
+    '''
+
+    if 'ANSIBLE_SSH_ARGS' in os.environ:
+        return os.environ['ANSIBLE_SSH_ARGS']
+    path = ansible_config_file(project_src)
+    if path is None:
+        return None
+    config = configparser.ConfigParser(inline_comment_prefixes=(';',), interpolation=None)
+    try:
+        config.read(path)
+    except configparser.Error as e:
+        print(f'Cannot read {path}: {e}')
+        return None
+    return config.get('ssh_connection', 'ssh_args', fallback=None)
+
+
+def build_connection_cache(rules, project_src='.'):
+    '''
+    Returns a ConnectionCache if the rules file enables connection reuse.
+    '''
+
+    persist = rules.get('control_persist')
+    if not persist:
+        return None
+    return ConnectionCache(int(persist), ssh_args=configured_ssh_args(project_src))
@@ -1,27 +1,184 @@
 
 import os
+import sys
 import yaml
 import tempfile
 import shutil
+import copy
 import json
-import re
 import glob
+import shlex
 import ansible_runner
+import gevent.subprocess
 from pprint import pprint
-from deepdiff import DeepDiff, extract
+from collections import OrderedDict, namedtuple
+from deepdiff import DeepDiff
+from functools import partial
 
 from .rule import select_rules_recursive, Action, ACTION_RULES, get_rule_action_subtree, deduplicate_rules
-from .util import ensure_directory, build_inventory_selector
-from .messages import ValidationResult, ValidationTask, now, Stdout
+from .rule import match_path, compile_rule_paths
+from .util import ensure_directory
+from .messages import ValidationResult, ValidationTask, now
 from .collection import split_collection_name, has_tasks, load_tasks
+from .keyed_diff import keyed_diff, build_list_keys
+from .path import format_path, get_path
+from .staging import project_staging, project_staging_for, replace_file
+from .scheduler import inventory_hosts, group_plays, run_units
+from .zygote import ansible_zygote
+from .retention import run_retention
+from .events import SET_STATS_ACTIONS
+from .discovery import touched_hosts, state_digest
+from .merkle import StateTree
+from .retry import failed_hosts
+from .health import limit_pattern, job_deadline
+
+
+RanRule = namedtuple('RanRule', ['rule', 'changed_subtree_path', 'subtree', 'inventory_name', 'path'])
+
+
+def runner_options(monitor):
+    '''
+    Returns the PlaybookRunner options for runs of a monitor.
+    '''
+
+    return dict(cooperative=monitor.rules.get('async_runner', False),
+                zygote=ansible_zygote if monitor.rules.get('zygote', False) else None,
+                envvars=monitor.connections.envvars() if monitor.connections is not None else None,
+                retention=monitor.retention,
+                data_root=monitor.rules.get('private_data_root'),
+                staging=project_staging_for(monitor.rules.get('private_data_root')),
+                suppress_artifacts=monitor.rules.get('suppress_artifacts', False),
+                verbosity=monitor.rules.get('verbosity', 1),
+                event_filter=monitor.event_filter,
+                minimal_vars=monitor.rules.get('minimal_vars', False),
+                cancelled=partial(monitor.run_cancelled, monitor.run_id),
+                play_boundary=monitor.rules.get('preempt') == 'play',
+                circuit_breaker=monitor.circuit_breaker)
+
+
+def uses_full_state(rules):
+    '''
+    Returns for each rule if its play includes the full state and diff when
+    PlaybookRunner writes minimal vars.
+    '''
+
+    return [rule.get('full_state', False) for rule in rules]
+
+
+def deepdiff_engine(t1, t2, list_keys=None, node1=None, node2=None):
+    '''
+    Finds the difference between two states using DeepDiff.  List keys and hash
+    trees are not supported by this engine.
+    '''
+
+    return DeepDiff(t1, t2, ignore_order=True)
+
+
+DIFF_ENGINES = {'deepdiff': deepdiff_engine,
+                'keyed': keyed_diff}
+
+
+def diff_states(t1, t2, rules, state_trees=None):
+    '''
+    Finds the difference between two states using the engine selected with
+    `diff_engine` in the rules file.   The default is DeepDiff and
+    `diff_engine: keyed` selects the keyed engine (see keyed_diff.py).
+
+    If a StateTreeCache is passed in state_trees the hash trees of the states
+    are used to skip equal subtrees and to return early if the states are equal.
+    '''
+
+    engine = rules.get('diff_engine', 'deepdiff')
+    if engine not in DIFF_ENGINES:
+        raise Exception(f'Unknown diff_engine {engine}')
+    if state_trees is None:
+        return DIFF_ENGINES[engine](t1, t2, build_list_keys(rules))
+    return diff_trees(state_trees.get(t1), state_trees.get(t2), rules)
+
+
+def diff_trees(tree1, tree2, rules):
+    '''
+    Finds the difference between the states of two StateTrees.
+    '''
+
+    engine = rules.get('diff_engine', 'deepdiff')
+    if engine not in DIFF_ENGINES:
+        raise Exception(f'Unknown diff_engine {engine}')
+    if tree1.digest == tree2.digest:
+        return {}
+    return DIFF_ENGINES[engine](tree1.state, tree2.state, build_list_keys(rules), tree1.node, tree2.node)
+
+
+class DiffCache(object):
+
+    '''
+    DiffCache computes the diff between two states once and returns the same
+    diff object to every consumer in a reconciliation cycle.   Diffs are keyed
+    by the identity of the two states and the rules like StateTreeCache.   The
+    digests of the hash trees are not used since they do not depend on the
+    order of list items while the paths in a diff do, and the diff engine and
+    list keys of the rules change the diff.   The diffs are shared so
+    consumers must not modify them.
+    '''
+
+    def __init__(self, state_trees, size=4):
+        self.state_trees = state_trees
+        self.size = size
+        self.diffs = OrderedDict()
+
+    def get(self, t1, t2, rules):
+        key = (id(t1), id(t2), id(rules))
+        entry = self.diffs.get(key)
+        if entry is None or entry[0] is not t1 or entry[1] is not t2 or entry[2] is not rules:
+            self.add(t1, t2, diff_states(t1, t2, rules, self.state_trees), rules)
+        else:
+            self.diffs.move_to_end(key)
+        return self.diffs[key][3]
+
+    def add(self, t1, t2, diff, rules):
+        '''
+        Adds a diff between two states that was computed elsewhere.
+        '''
+
+        key = (id(t1), id(t2), id(rules))
+        self.diffs[key] = (t1, t2, rules, diff)
+        self.diffs.move_to_end(key)
+        while len(self.diffs) > self.size:
+            self.diffs.popitem(last=False)
+
+
+# Runs ansible-runner in a subprocess and writes the events to stdout as JSON
+# lines.  The event_handler returns False so that ansible-runner does not
+# write the events to job_events like in the thread mode.
+RUNNER_PROCESS = '''
+import sys
+import json
+import ansible_runner
+
+
+def event_handler(data):
+    sys.stdout.write(json.dumps(data) + '\\n')
+    sys.stdout.flush()
+    return False
+
+
+runner = ansible_runner.run(private_data_dir=sys.argv[1],
+                            playbook='playbook.yml',
+                            binary=sys.argv[2] if len(sys.argv) > 2 else None,
+                            quiet=True,
+                            ignore_logging=True,
+                            event_handler=event_handler)
+sys.exit(runner.rc)
+'''
 
 
 def convert_diff(diff):
     '''
     Converts the DeepDiff structure into a YAML serializable data structure.
+    The diff passed in is not modified.
     '''
 
-    print(diff)
+    diff = dict(diff)
     if 'dictionary_item_added' in diff:
         diff['dictionary_item_added'] = [
             str(x) for x in diff['dictionary_item_added']]
@@ -30,8 +187,11 @@ def convert_diff(diff):
             str(x) for x in diff['dictionary_item_removed']]
     if 'type_changes' in diff:
         diff['type_changes'] = [str(x) for x in diff['type_changes']]
-    diff = dict(diff)
-    print(yaml.safe_dump(diff))
+    for key, value in diff.items():
+        # DeepDiff reports are dict subclasses that YAML cannot represent
+        if isinstance(value, dict):
+            diff[key] = {path: dict(change) if isinstance(change, dict) else change
+                         for path, change in value.items()}
     return diff
 
 
@@ -39,10 +199,77 @@ class PlaybookRunner:
 
     '''
     PlaybookRunner is responsible for setting up and running ansible-runner
+
+    The project files are staged from a shared snapshot of project_src (see
+    staging.py) unless staging is None in which case they are copied.
+
+    If cooperative is True ansible-runner runs in a subprocess and its events
+    are read from the subprocess with gevent so that other green threads keep
+    running while the playbook runs.   Otherwise ansible-runner runs in this
+    process and blocks until the playbook finishes.
+
+    If zygote is an AnsibleZygote the playbook runs in a process forked from
+    the zygote instead of a new ansible-playbook process (see zygote.py).
+
+    envvars are set in the environment of ansible-playbook.
+
+    The directory of the run is handed to retention (see retention.py) when
+    the caller calls `release` after it has read the results of the run.
+
+    The private data directory is created in data_root if it is set.  Use a
+    memory backed file system such as /dev/shm to keep the files that
+    ansible-runner writes for every event out of the disk.  If
+    suppress_artifacts is True ansible-runner does not write the stdout
+    and stderr of the run to the artifacts.
+
+    verbosity is the number of -v options passed to ansible-playbook.  Events
+    that event_filter does not accept are dropped in the event_handler of
+    ansible-runner before they are passed to message_processor (see
+    events.py).
+
+    If minimal_vars is True each play only includes its own destructured vars
+    in JSON and the full state and diff are only included by the plays that
+    are True in full_state.   Otherwise every play includes the full state and
+    diff in YAML.
+
+    The run is stopped when cancelled returns True.   If play_boundary is True
+    the run is stopped when the next play starts instead so that the plays
+    that started before the cancellation finish.
+
+    The hosts with an open circuit in circuit_breaker are excluded from the
+    run with --limit and the events of the run update the health of the
+    hosts (see health.py).   The run is stopped after job_timeout seconds
+    unless job_timeout is 0.
     '''
 
-    def __init__(self, message_processor, new_desired_state, state_diff, destructured_vars_list, playbook, secrets, project_src, inventory):
+    def __init__(self, message_processor, new_desired_state, state_diff, destructured_vars_list, playbook, secrets, project_src, inventory,
+                 staging=project_staging, cooperative=False, zygote=None, envvars=None,
+                 retention=run_retention, data_root=None, suppress_artifacts=False, verbosity=1,
+                 event_filter=None, minimal_vars=False, full_state=None, cancelled=None, play_boundary=False,
+                 circuit_breaker=None, job_timeout=0):
         print('PlaybookRunner')
+        self.circuit_breaker = circuit_breaker
+        self.excluded_hosts = set()
+        self.job_timeout = job_timeout
+        self.cancelled = cancelled
+        self.play_boundary = play_boundary
+        self.plays_started = 0
+        self.cancel_play = None
+        self.minimal_vars = minimal_vars
+        self.full_state = full_state
+        self.verbosity = verbosity
+        self.event_filter = event_filter
+        self.staging = staging
+        self.retention = retention
+        self.data_root = data_root
+        self.suppress_artifacts = suppress_artifacts
+        self.rc = None
+        self.result = None
+        self.temp_dir = None
+        self.cooperative = cooperative
+        self.zygote = zygote
+        self.envvars = dict(envvars or {})
+        self.process = None
         self.message_processor = message_processor
         self.inventory = inventory
         self.secrets = secrets
@@ -63,16 +290,33 @@ class PlaybookRunner:
         self.write_settings()
         self.write_cmdline()
         self.write_passwords()
-        self.write_state_vars()
-        self.write_diff_vars()
-        self.write_destructred_vars()
+        self.write_envvars()
+        if self.minimal_vars:
+            self.write_minimal_vars()
+        else:
+            self.write_state_vars()
+            self.write_diff_vars()
+            self.write_destructred_vars()
         self.write_playbook()
         self.write_inventory()
         self.start_ansible_playbook()
-        return self.read_result()
+        self.result = self.read_result()
+        return self.result
+
+    def release(self):
+        '''
+        Hands the directory of the run to retention.  Callers call this in a
+        finally block so that the directory of a run that raised is kept or
+        removed like any other.
+        '''
+
+        if self.retention is not None and self.temp_dir is not None:
+            self.retention.add(self.temp_dir, self.result)
 
     def build_project_directory(self):
-        self.temp_dir = tempfile.mkdtemp(prefix="desired_state_playbook")
+        if self.data_root is not None:
+            ensure_directory(self.data_root)
+        self.temp_dir = tempfile.mkdtemp(prefix="desired_state_playbook", dir=self.data_root)
         print(self.temp_dir)
         ensure_directory(os.path.join(self.temp_dir, 'env'))
         ensure_directory(os.path.join(self.temp_dir, 'project'))
@@ -83,6 +327,9 @@ class PlaybookRunner:
     def copy_files(self):
         src = os.path.abspath(self.project_src)
         dest = os.path.join(self.temp_dir, 'project')
+        if self.staging is not None:
+            self.staging.stage(src, dest)
+            return
         src_files = os.listdir(src)
         for file_name in src_files:
             full_file_name = os.path.join(src, file_name)
@@ -94,27 +341,47 @@ class PlaybookRunner:
     def write_settings(self):
         with open(os.path.join(self.temp_dir, 'env', 'settings'), 'w') as f:
             f.write(json.dumps(dict(idle_timeout=0,
-                                    job_timeout=0)))
+                                    job_timeout=self.job_timeout,
+                                    suppress_output_file=self.suppress_artifacts)))
 
     def write_cmdline(self):
+        verbosity = ' -' + 'v' * self.verbosity if self.verbosity else ''
+        if self.circuit_breaker is not None:
+            self.excluded_hosts = self.circuit_breaker.open_hosts()
+        limit = limit_pattern(self.excluded_hosts)
+        if limit is not None:
+            print('excluding hosts', sorted(self.excluded_hosts))
+            verbosity += ' --limit ' + shlex.quote(limit)
         with open(os.path.join(self.temp_dir, 'env', 'cmdline'), 'w') as f:
-            f.write("--ask-become-pass -v")
+            if self.zygote is None:
+                f.write("--ask-become-pass" + verbosity)
+            else:
+                # The zygote client replaces ansible-playbook so the playbook
+                # is an argument.  The client prompts for the become
+                # password and passes it to the forked playbook.
+                f.write("playbook.yml --ask-become-pass" + verbosity)
 
     def write_passwords(self):
         with open(os.path.join(self.temp_dir, 'env', 'passwords'), 'w') as f:
             f.write(
                 """---\n"SUDO password:": "{0}"\nBECOME password: "{0}"\n...""".format(self.secrets['become']))
 
+    def write_envvars(self):
+        if not self.envvars:
+            return
+        with open(os.path.join(self.temp_dir, 'env', 'envvars'), 'w') as f:
+            f.write(yaml.safe_dump(self.envvars, default_flow_style=False))
+
     def write_playbook(self):
-        self.playbook_file = (os.path.join(
+        self.playbook_file = replace_file(os.path.join(
             self.temp_dir, 'project', 'playbook.yml'))
         playbook = self.playbook
         with open(self.playbook_file, 'w') as f:
             f.write(yaml.safe_dump(playbook, default_flow_style=False))
 
     def write_state_vars(self):
-        state_vars_file = os.path.join(
-            self.temp_dir, 'project', 'state_vars.yml')
+        state_vars_file = replace_file(os.path.join(
+            self.temp_dir, 'project', 'state_vars.yml'))
         with open(state_vars_file, 'w') as f:
             f.write(yaml.safe_dump(
                 self.new_desired_state, default_flow_style=False))
@@ -123,8 +390,8 @@ class PlaybookRunner:
                                      'name': 'include state_vars'})
 
     def write_diff_vars(self):
-        diff_vars_file = os.path.join(
-            self.temp_dir, 'project', 'diff_vars.yml')
+        diff_vars_file = replace_file(os.path.join(
+            self.temp_dir, 'project', 'diff_vars.yml'))
         with open(diff_vars_file, 'w') as f:
             f.write(yaml.safe_dump(self.state_diff, default_flow_style=False))
         for play in self.playbook:
@@ -133,8 +400,8 @@ class PlaybookRunner:
 
     def write_destructred_vars(self):
         for i, destructured_vars in enumerate(self.destructured_vars_list):
-            diff_vars_file = os.path.join(
-                self.temp_dir, 'project', f'destructured_vars_{i}.yml')
+            diff_vars_file = replace_file(os.path.join(
+                self.temp_dir, 'project', f'destructured_vars_{i}.yml'))
             with open(diff_vars_file, 'w') as f:
                 f.write(yaml.safe_dump(
                     destructured_vars, default_flow_style=False))
@@ -142,6 +409,29 @@ class PlaybookRunner:
             play['tasks'].insert(0, {'include_vars': {'file': f'destructured_vars_{i}.yml'},
                                      'name': 'include destructured_vars'})
 
+    def write_minimal_vars(self):
+        full_state = self.full_state
+        if full_state is None:
+            full_state = [True] * len(self.playbook)
+        if any(full_state):
+            # Values that YAML supports but JSON does not, such as dates, are
+            # written as the strings that they render as in the YAML vars
+            with open(replace_file(os.path.join(self.temp_dir, 'project', 'state_vars.json')), 'w') as f:
+                json.dump(self.new_desired_state, f, default=str)
+            with open(replace_file(os.path.join(self.temp_dir, 'project', 'diff_vars.json')), 'w') as f:
+                json.dump(self.state_diff, f, default=str)
+        for i, (play, destructured_vars) in enumerate(zip(self.playbook, self.destructured_vars_list)):
+            with open(replace_file(os.path.join(self.temp_dir, 'project', f'destructured_vars_{i}.json')), 'w') as f:
+                json.dump(destructured_vars, f, default=str)
+            tasks = [{'include_vars': {'file': f'destructured_vars_{i}.json'},
+                      'name': 'include destructured_vars'}]
+            if full_state[i]:
+                tasks.append({'include_vars': {'file': 'diff_vars.json', 'name': 'diff'},
+                              'name': 'include diff_vars'})
+                tasks.append({'include_vars': {'file': 'state_vars.json', 'name': 'state'},
+                              'name': 'include state_vars'})
+            play['tasks'][0:0] = tasks
+
     def write_inventory(self):
         print("inventory set to %s", self.inventory)
         with open(os.path.join(self.temp_dir, 'inventory'), 'w') as f:
@@ -149,19 +439,65 @@ class PlaybookRunner:
 
     def start_ansible_playbook(self):
         # print('start_ansible_playbook')
-        ansible_runner.run(private_data_dir=self.temp_dir,
-                           playbook="playbook.yml",
-                           quiet=True,
-                           debug=True,
-                           ignore_logging=True,
-                           cancel_callback=self.cancel_callback,
-                           finished_callback=self.finished_callback,
-                           event_handler=self.runner_process_message)
+        if self.cooperative:
+            self.run_ansible_runner_process()
+            return
+        runner = ansible_runner.run(private_data_dir=self.temp_dir,
+                                    playbook="playbook.yml",
+                                    binary=self.zygote.binary() if self.zygote is not None else None,
+                                    quiet=True,
+                                    debug=True,
+                                    ignore_logging=True,
+                                    cancel_callback=self.cancel_callback,
+                                    finished_callback=self.finished_callback,
+                                    event_handler=self.runner_process_message)
+        self.rc = runner.rc
         # print('finished ansible runner')
         print(self.temp_dir)
 
+    def run_ansible_runner_process(self):
+        '''
+        Runs ansible-runner in a subprocess with JSON event output and passes
+        each event to runner_process_message as it is read.
+        '''
+
+        command = [sys.executable, '-c', RUNNER_PROCESS, self.temp_dir]
+        if self.zygote is not None:
+            command.append(self.zygote.binary())
+        self.process = gevent.subprocess.Popen(command,
+                                               stdin=gevent.subprocess.DEVNULL,
+                                               stdout=gevent.subprocess.PIPE)
+        watcher = gevent.spawn(self.watch_ansible_runner_process)
+        for line in self.process.stdout:
+            if not line.startswith(b'{'):
+                # Ansible output that is not an event
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            self.runner_process_message(data)
+        self.process.stdout.close()
+        self.rc = self.process.wait()
+        watcher.kill()
+        self.finished_callback(None)
+        print(self.temp_dir)
+
+    def watch_ansible_runner_process(self):
+        # Cancel the run even when ansible is not sending events
+        while self.process.poll() is None:
+            if self.cancel_callback():
+                self.process.terminate()
+                return
+            gevent.sleep(0.1)
+
     def cancel_callback(self):
         # print('cancel_callback called')
+        if self.cancelled is not None and self.cancelled():
+            if self.cancel_play is None:
+                self.cancel_play = self.plays_started
+            if not self.play_boundary or self.plays_started > self.cancel_play:
+                self.shutdown_requested = True
         return self.shutdown_requested
 
     def finished_callback(self, runner):
@@ -169,12 +505,23 @@ class PlaybookRunner:
         self.shutdown = True
 
     def runner_process_message(self, data):
+        # This is the event_handler of ansible-runner.  It is called before
+        # the event is written to the job_events of the artifacts and
+        # returning False tells ansible-runner not to write it.
         # if data.get('event', '') == 'runner_on_ok':
         # print("runner message:\n{}".format(pformat(data)))
-        self.message_processor(data)
+        if data.get('event', '') == 'playbook_on_play_start':
+            self.plays_started += 1
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(data)
+        if self.event_filter is None or self.event_filter.accept(data):
+            self.message_processor(data)
+        return False
         # print(data.get('stdout', ''))
 
     def read_result(self):
+        if self.rc is not None:
+            return 0 == self.rc
         artifacts = glob.glob(os.path.join(
             self.temp_dir, 'artifacts', '*-*-*-*-*'))
         if len(artifacts) != 1:
@@ -203,18 +550,13 @@ def find_tasks(file_or_collection):
     return task_file
 
 
-def desired_state_diff(monitor, secrets, project_src, current_desired_state, new_desired_state, rules, inventory, explain):
+def build_apply_plays(current_desired_state, new_desired_state, rules, diff, explain):
     '''
-    desired_state_diff creates playbooks and runs them with ansible-runner to implement the differences
-    between two version of state: current_desired_state and new_desired_state.
+    build_apply_plays finds the rules that match the difference between two
+    states and builds a play for each of them.  Returns the plays, the vars for
+    each play, and the rules that will be run.
     '''
 
-    # Find the difference between states
-
-    diff = DeepDiff(current_desired_state,
-                    new_desired_state, ignore_order=True)
-    print(diff)
-
     # Find matching rules
 
     matching_rules = select_rules_recursive(
@@ -239,7 +581,8 @@ def desired_state_diff(monitor, secrets, project_src, current_desired_state, new
 
     for matching_rule in dedup_matching_rules:
         change_type, rule, match, value = matching_rule
-        changed_subtree_path = match.groups()[0]
+        path = match_path(match)
+        changed_subtree_path = format_path(path)
         action, subtree = get_rule_action_subtree(matching_rule,
                                                   current_desired_state,
                                                   new_desired_state)
@@ -249,10 +592,7 @@ def desired_state_diff(monitor, secrets, project_src, current_desired_state, new
 
         # Experiment: Build the vars using destructuring
 
-        destructured_vars = {}
-
-        for name, extract_path in rule.get('vars', {}).items():
-            destructured_vars[name] = extract(subtree, extract_path)
+        destructured_vars = destructure_vars(rule, subtree)
 
         # Experiment: Make the subtree available as node
         destructured_vars['node'] = subtree
@@ -261,14 +601,13 @@ def desired_state_diff(monitor, secrets, project_src, current_desired_state, new
 
         # Determine the inventory to run on
 
-        inventory_selector = build_inventory_selector(
-            rule.get('inventory_selector'))
+        inventory_selector = compile_rule_paths(rule).inventory_selector
         if inventory_selector:
             try:
-                inventory_name = extract(subtree, inventory_selector)
+                inventory_name = inventory_selector.get(subtree)
             except KeyError:
                 raise Exception(
-                    f'Invalid inventory_selector {inventory_selector}')
+                    f'Invalid inventory_selector {inventory_selector.path_string}')
 
         print('inventory_name', inventory_name)
 
@@ -298,45 +637,263 @@ def desired_state_diff(monitor, secrets, project_src, current_desired_state, new
             destructured_vars_list.append(destructured_vars)
 
             ran_rules.append(
-                (rule, changed_subtree_path, subtree, inventory_name))
+                RanRule(rule, changed_subtree_path, subtree, inventory_name, path))
+
+    return plays, destructured_vars_list, ran_rules
 
-    def runner_process_message(data):
-        monitor.stream.put_message(Stdout(0, now(), data.get('stdout', '')))
 
-    PlaybookRunner(runner_process_message,
-                   new_desired_state,
-                   diff,
-                   destructured_vars_list,
-                   plays,
-                   secrets,
-                   project_src,
-                   inventory).run()
+Plan = namedtuple('Plan', ['current_desired_state', 'new_desired_state', 'tree', 'diff',
+                           'plays', 'destructured_vars_list', 'ran_rules'])
+
+
+def plan_desired_state(current_tree, desired_state, rules):
+    '''
+    Parses the YAML desired_state and finds the diff and the apply plays to
+    reconcile it from the state of current_tree.   This does not use the
+    caches of the monitor so that it can run in a thread while the monitor
+    runs a playbook (see DesiredStateMonitor.speculate).   The compiled rule
+    caches in rule.py are shared with the monitor and are locked.
+    '''
+
+    new_desired_state = yaml.safe_load(desired_state)
+    tree = StateTree(new_desired_state)
+    diff = diff_trees(current_tree, tree, rules)
+    plays, destructured_vars_list, ran_rules = [], [], []
+    if diff:
+        plays, destructured_vars_list, ran_rules = build_apply_plays(current_tree.state,
+                                                                     new_desired_state,
+                                                                     rules,
+                                                                     diff,
+                                                                     False)
+    return Plan(current_tree.state, new_desired_state, tree, diff, plays, destructured_vars_list, ran_rules)
+
+
+def planned_apply_plays(monitor, current_desired_state, new_desired_state, rules, diff, explain):
+    '''
+    Returns the apply plays from the plan of the monitor if it was made for
+    the same states or builds them with build_apply_plays.
+    '''
+
+    plan = monitor.plan
+    monitor.plan = None
+    if (plan is not None and not explain and
+            plan.current_desired_state is current_desired_state and
+            plan.new_desired_state is new_desired_state):
+        print('using speculative plan')
+        return plan.plays, plan.destructured_vars_list, plan.ran_rules
+    return build_apply_plays(current_desired_state, new_desired_state, rules, diff, explain)
+
+
+def desired_state_diff(monitor, secrets, project_src, current_desired_state, new_desired_state, rules, inventory, explain):
+    '''
+    desired_state_diff creates playbooks and runs them with ansible-runner to implement the differences
+    between two version of state: current_desired_state and new_desired_state.
+    '''
+
+    # Find the difference between states
+
+    diff = monitor.diffs.get(current_desired_state, new_desired_state, rules)
+
+    plays, destructured_vars_list, ran_rules = planned_apply_plays(monitor,
+                                                                   current_desired_state,
+                                                                   new_desired_state,
+                                                                   rules,
+                                                                   diff,
+                                                                   explain)
+
+    run_apply_plays(monitor, secrets, project_src, new_desired_state, diff,
+                    plays, destructured_vars_list, ran_rules, rules, inventory, explain)
 
     return ran_rules
 
 
-def desired_state_discovery(monitor, secrets, project_src, current_desired_state, new_desired_state, ran_rules, inventory, explain):
+def desired_state_retry(monitor, secrets, project_src, current_desired_state, new_desired_state, rules, inventory, delay, retry_rules):
+    '''
+    desired_state_retry waits for delay seconds and runs the apply plays of
+    the rules in retry_rules again.   Returns the rules that were run.   If
+    the run is cancelled while it waits retry_rules are returned so that
+    their subtrees are discovered again after the preemption.
+    '''
 
-    # Discovers the state of a subset of a system
+    gevent.sleep(delay)
+
+    if monitor.run_cancelled(monitor.run_id):
+        monitor.failed_hosts = set()
+        return retry_rules
+
+    diff = monitor.diffs.get(current_desired_state, new_desired_state, rules)
+
+    plays, destructured_vars_list, ran_rules = build_apply_plays(current_desired_state,
+                                                                 new_desired_state,
+                                                                 rules,
+                                                                 diff,
+                                                                 False)
+
+    retry = set((ran_rule.changed_subtree_path, ran_rule.inventory_name) for ran_rule in retry_rules)
+    selected = [i for i, ran_rule in enumerate(ran_rules)
+                if (ran_rule.changed_subtree_path, ran_rule.inventory_name) in retry]
+    plays = [plays[i] for i in selected]
+    destructured_vars_list = [destructured_vars_list[i] for i in selected]
+    ran_rules = [ran_rules[i] for i in selected]
+
+    run_apply_plays(monitor, secrets, project_src, new_desired_state, diff,
+                    plays, destructured_vars_list, ran_rules, rules, inventory, False)
+
+    return ran_rules
+
+
+def run_apply_plays(monitor, secrets, project_src, new_desired_state, diff, plays, destructured_vars_list, ran_rules, rules, inventory, explain):
+    '''
+    Runs the apply plays and records the hosts that failed in
+    `monitor.failed_hosts`, the hosts that were run on in
+    `monitor.processed_hosts`, and the hosts that the circuit breaker
+    excluded in `monitor.excluded_hosts`.
+    '''
+
+    touched = set()
+    processed = set()
+    failed = set()
+    excluded = excluded_hosts(monitor, ran_rules)
+
+    def runner_process_message(data):
+        stats = touched_hosts(data)
+        if stats is not None:
+            touched.update(stats[0])
+            processed.update(stats[1])
+            failed.update(failed_hosts(data))
+        monitor.events.put(data.get('stdout', ''))
+
+    # Run independent plays in parallel runs of ansible-runner
+
+    parallel_runs = rules.get('parallel_runs', 1)
+    if parallel_runs > 1:
+        units = group_plays(plays, ran_rules, inventory_hosts(inventory))
+    else:
+        units = [list(range(len(plays)))] if plays else []
+
+    if explain:
+        print('units', units)
+
+    def run_unit(unit):
+        if monitor.run_cancelled(monitor.run_id):
+            return False
+        if all(ran_rules[i].inventory_name in excluded for i in unit):
+            # Every play of the unit runs on an excluded host
+            return True
+        runner = PlaybookRunner(runner_process_message,
+                                new_desired_state,
+                                diff,
+                                [destructured_vars_list[i] for i in unit],
+                                [plays[i] for i in unit],
+                                secrets,
+                                project_src,
+                                inventory,
+                                full_state=uses_full_state([ran_rules[i].rule for i in unit]),
+                                job_timeout=job_deadline(rules, [ran_rules[i].rule for i in unit]),
+                                **runner_options(monitor))
+        try:
+            return runner.run()
+        finally:
+            runner.release()
+
+    results = run_units(units, run_unit, parallel_runs)
+
+    if monitor.discovery_cache is not None:
+        monitor.discovery_cache.applied(ran_rules, touched, processed, all(results), new_desired_state)
+
+    if not all(results) and not failed:
+        # The run failed without host results
+        failed.update(ran_rule.inventory_name for ran_rule in ran_rules
+                      if ran_rule.inventory_name not in excluded)
+    monitor.failed_hosts = failed
+    monitor.processed_hosts = processed
+    monitor.excluded_hosts = excluded
+
+
+def excluded_hosts(monitor, ran_rules):
+    '''
+    Returns the hosts of ran_rules that the circuit breaker of the monitor
+    excludes from runs.
+    '''
+
+    if monitor.circuit_breaker is None:
+        return set()
+    return monitor.circuit_breaker.open_hosts() & set(ran_rule.inventory_name for ran_rule in ran_rules)
 
-    diff = DeepDiff(current_desired_state,
-                    new_desired_state, ignore_order=True)
 
-    # deep copy
-    new_discovered_state = yaml.safe_load(yaml.safe_dump(new_desired_state))
+def converged_state(state_trees, current_desired_state, new_desired_state, ran_rules):
+    '''
+    Returns a copy of current_desired_state with the subtrees of ran_rules
+    from new_desired_state.   Items added to the end of a list are appended.
+    Subtrees that cannot be set without moving other subtrees, such as items
+    inserted into or removed from a list, are not set.
+    '''
+
+    tree = state_trees.get(current_desired_state).copy()
+    for ran_rule in ran_rules:
+        path = ran_rule.path
+        if not path:
+            continue
+        try:
+            value = get_path(new_desired_state, path)
+            container = get_path(tree.state, path[:-1])
+        except (KeyError, IndexError, TypeError):
+            continue
+        if isinstance(container, list) and isinstance(path[-1], int) and path[-1] == len(container):
+            tree.set(path[:-1], container + [copy.deepcopy(value)])
+            continue
+        if isinstance(container, list) and not (isinstance(path[-1], int) and path[-1] < len(container)):
+            continue
+        if not isinstance(container, (dict, list)):
+            continue
+        tree.set(path, copy.deepcopy(value))
+    state_trees.add(tree)
+    return tree.state
+
+
+def desired_state_prewarm(monitor, secrets, project_src, inventory):
+    '''
+    desired_state_prewarm opens the connections to every host in the inventory
+    so that the first reconciliation reuses them (see connection.py).
+    '''
+
+    def runner_process_message(data):
+        monitor.events.put(data.get('stdout', ''))
+
+    runner = PlaybookRunner(runner_process_message,
+                            {},
+                            {},
+                            [{}],
+                            [monitor.connections.prewarm_play()],
+                            secrets,
+                            project_src,
+                            inventory,
+                            full_state=[False],
+                            job_timeout=job_deadline(monitor.rules, []),
+                            **runner_options(monitor))
+    try:
+        return runner.run()
+    finally:
+        runner.release()
+
+
+def build_discovery_plays(ran_rules, tasks_key='tasks'):
+    '''
+    build_discovery_plays builds a play that runs the retrieve tasks for each
+    rule that was run.   Returns the plays, the vars for each play, and the
+    subtrees that will be discovered.   With tasks_key 'digest_tasks' the
+    plays run the retrieve digest tasks instead.
+    '''
 
     plays = []
 
     destructured_vars_list = []
     discovered_rules = []
 
-    for discovery_id, (rule, changed_subtree_path, subtree, inventory_name) in enumerate(ran_rules):
+    for discovery_id, (rule, changed_subtree_path, subtree, inventory_name, path) in enumerate(ran_rules):
 
         # Experiment: Build the vars using destructuring
-        destructured_vars = {}
-
-        for name, extract_path in rule.get('vars', {}).items():
-            destructured_vars[name] = extract(subtree, extract_path)
+        destructured_vars = destructure_vars(rule, subtree)
 
         # Experiment: Make the subtree available as node
         destructured_vars['node'] = subtree
@@ -351,24 +908,65 @@ def desired_state_discovery(monitor, secrets, project_src, current_desired_state
                 'gather_facts': False,
                 'tasks': []}
 
-        if 'tasks' in rule.get(ACTION_RULES[Action.RETRIEVE], {}):
+        if tasks_key in rule.get(ACTION_RULES[Action.RETRIEVE], {}):
             play['tasks'].append({'include_tasks':
                                   {'file': find_tasks(
-                                      rule.get(ACTION_RULES[Action.RETRIEVE]).get('tasks'))},
-                                  'name': 'include retrieve'})
+                                      rule.get(ACTION_RULES[Action.RETRIEVE]).get(tasks_key))},
+                                  'name': 'include retrieve' if tasks_key == 'tasks' else 'include retrieve digest'})
 
             print(play)
 
             plays.append(play)
             destructured_vars_list.append(destructured_vars)
             discovered_rules.append(
-                [discovery_id, changed_subtree_path, subtree])
+                [discovery_id, changed_subtree_path, subtree, path])
+
+    return plays, destructured_vars_list, discovered_rules
+
+
+def desired_state_discovery(monitor, secrets, project_src, current_desired_state, new_desired_state, ran_rules, inventory, explain):
+
+    # Discovers the state of a subset of a system
+    # The ran rules whose subtrees were discovered are recorded in monitor.discovered_rules
+
+    diff = monitor.diffs.get(current_desired_state, new_desired_state, monitor.rules)
+
+    # deep copy that shares the hash tree of the new desired state
+    new_discovered_tree = monitor.state_trees.get(new_desired_state).copy()
+
+    plays, destructured_vars_list, discovered_rules = build_discovery_plays(ran_rules)
+    discovery_ids = set(rule[0] for rule in discovered_rules)
+
+    if monitor.discovery_cache is not None:
+        plays, destructured_vars_list, discovered_rules = use_cached_discovery(monitor.discovery_cache,
+                                                                               new_desired_state,
+                                                                               new_discovered_tree,
+                                                                               ran_rules,
+                                                                               plays,
+                                                                               destructured_vars_list,
+                                                                               discovered_rules)
+
+    if any('digest_tasks' in ran_rules[rule[0]].rule.get(ACTION_RULES[Action.RETRIEVE], {}) for rule in discovered_rules):
+        matched = discover_digests(monitor, secrets, project_src, new_desired_state, diff, ran_rules,
+                                   discovered_rules, new_discovered_tree, inventory)
+        plays, destructured_vars_list, discovered_rules = skip_discovery(plays,
+                                                                         destructured_vars_list,
+                                                                         discovered_rules,
+                                                                         matched)
+
+    # Cached subtrees and subtrees with matching digests are discovered
+    discovered = discovery_ids - set(rule[0] for rule in discovered_rules)
 
     if not plays:
-        return new_discovered_state
+        monitor.discovered_rules = [ran_rules[i] for i in sorted(discovered)]
+        monitor.state_trees.add(new_discovered_tree)
+        return new_discovered_tree.state
+
+    published = set()
 
     def runner_process_message(data):
-        monitor.stream.put_message(Stdout(0, now(), data.get('stdout', '')))
+        published.update(apply_published_states(new_discovered_tree, discovered_rules, data))
+        monitor.events.put(data.get('stdout', ''))
 
     runner = PlaybookRunner(runner_process_message,
                             new_desired_state,
@@ -377,19 +975,190 @@ def desired_state_discovery(monitor, secrets, project_src, current_desired_state
                             plays,
                             secrets,
                             project_src,
-                            inventory)
-    result = runner.run()
+                            inventory,
+                            full_state=uses_full_state([ran_rules[rule[0]].rule for rule in discovered_rules]),
+                            job_timeout=job_deadline(monitor.rules, [ran_rules[rule[0]].rule for rule in discovered_rules]),
+                            **runner_options(monitor))
+    try:
+        result = runner.run()
+
+        if result:
+
+            for discovery_id, changed_subtree_path, subtree, path in discovered_rules:
+                if discovery_id not in published:
+                    if update_discovered_state(
+                            new_discovered_tree, runner.temp_dir, discovery_id, changed_subtree_path, subtree, path):
+                        published.add(discovery_id)
+            if monitor.discovery_cache is not None:
+                cache_discovered_states(monitor.discovery_cache, new_desired_state, new_discovered_tree,
+                                        ran_rules, discovered_rules, published)
+            discovered.update(published)
+        else:
+            new_discovered_tree = monitor.state_trees.get(new_desired_state).copy()
+            discovered = set()
+    finally:
+        runner.release()
 
-    if result:
+    monitor.discovered_rules = [ran_rules[i] for i in sorted(discovered)]
+    monitor.state_trees.add(new_discovered_tree)
+    return new_discovered_tree.state
 
-        for discovery_id, changed_subtree_path, subtree in discovered_rules:
-            update_discovered_state(
-                new_discovered_state, runner.temp_dir, discovery_id, changed_subtree_path, subtree)
 
-    return new_discovered_state
+def discover_digests(monitor, secrets, project_src, new_desired_state, diff, ran_rules, discovered_rules, new_discovered_tree, inventory):
+    '''
+    Runs the retrieve digest tasks of the rules that have them and returns the
+    discovery ids of the subtrees whose digest matches the digest of the
+    subtree in the discovered tree.   Those subtrees do not need to be
+    retrieved.   Digest tasks publish the digest of the retrieved subtree:
+
+        - set_stats:
+            data:
+              "discovered_digest_{{ discovery_id }}": "{{ retrieved | to_json(sort_keys=True) | hash('sha256') }}"
+    '''
+
+    needed = set(rule[0] for rule in discovered_rules)
+    plays, destructured_vars_list, digest_rules = skip_discovery(*build_discovery_plays(ran_rules, 'digest_tasks'),
+                                                                 set(range(len(ran_rules))) - needed)
+
+    digests = {}
+
+    def runner_process_message(data):
+        digests.update(published_stats(data, 'discovered_digest'))
+        monitor.events.put(data.get('stdout', ''))
+
+    runner = PlaybookRunner(runner_process_message,
+                            new_desired_state,
+                            diff,
+                            destructured_vars_list,
+                            plays,
+                            secrets,
+                            project_src,
+                            inventory,
+                            full_state=uses_full_state([ran_rules[rule[0]].rule for rule in digest_rules]),
+                            job_timeout=job_deadline(monitor.rules, [ran_rules[rule[0]].rule for rule in digest_rules]),
+                            **runner_options(monitor))
+    try:
+        result = runner.run()
+    finally:
+        runner.release()
+
+    matched = set()
+    if not result:
+        return matched
+    for discovery_id, changed_subtree_path, subtree, path in digest_rules:
+        try:
+            state = get_path(new_discovered_tree.state, path)
+        except (KeyError, IndexError, TypeError):
+            continue
+        if discovery_id in digests and digests[discovery_id] == state_digest(state):
+            print('digest matched', changed_subtree_path)
+            matched.add(discovery_id)
+            if monitor.discovery_cache is not None:
+                ran_rule = ran_rules[discovery_id]
+                monitor.discovery_cache.set(ran_rule.rule, path, ran_rule.inventory_name, new_desired_state, state)
+    return matched
+
+
+def skip_discovery(plays, destructured_vars_list, discovered_rules, discovery_ids):
+    '''
+    Returns the plays, vars, and discovered rules without the ones with
+    discovery ids in discovery_ids.
+    '''
+
+    kept = [], [], []
+    for play, destructured_vars, discovered_rule in zip(plays, destructured_vars_list, discovered_rules):
+        if discovered_rule[0] not in discovery_ids:
+            kept[0].append(play)
+            kept[1].append(destructured_vars)
+            kept[2].append(discovered_rule)
+    return kept
+
+
+def published_stats(data, name):
+    '''
+    Returns the discovery ids and values of the stats named name_<discovery_id>
+    that a task published with set_stats in an ansible-runner event.
+    '''
 
+    if data.get('event', '') != 'runner_on_ok':
+        return []
+    event_data = data.get('event_data', {})
+    if event_data.get('task_action', '') not in SET_STATS_ACTIONS:
+        return []
+    values = []
+    for key, value in event_data.get('res', {}).get('ansible_stats', {}).get('data', {}).items():
+        prefix, _, discovery_id = key.rpartition('_')
+        if prefix == name and discovery_id.isdigit():
+            values.append((int(discovery_id), value))
+    return values
 
-def update_discovered_state(new_discovered_state, temp_dir, discovery_id, changed_subtree_path, subtree):
+
+def published_states(data):
+    '''
+    Returns the discovery ids and states that a retrieve task published with
+    set_stats in an ansible-runner event:
+
+        - set_stats:
+            data:
+              "discovered_state_{{ discovery_id }}": "{{ node }}"
+    '''
+
+    return published_stats(data, 'discovered_state')
+
+
+def apply_published_states(new_discovered_tree, discovered_rules, data):
+    '''
+    Sets the states published in an ansible-runner event in the discovered
+    tree as the events arrive.  Returns the discovery ids that were set.
+    '''
+
+    applied = []
+    for discovery_id, discovered_subtree_state in published_states(data):
+        for rule_discovery_id, changed_subtree_path, subtree, path in discovered_rules:
+            if rule_discovery_id == discovery_id:
+                if not path:
+                    assert False, f"type of changed_subtree_path not supported {changed_subtree_path}"
+                new_discovered_tree.set(path, discovered_subtree_state)
+                applied.append(discovery_id)
+    return applied
+
+
+def use_cached_discovery(discovery_cache, new_desired_state, new_discovered_tree, ran_rules, plays, destructured_vars_list, discovered_rules):
+    '''
+    Sets the fresh subtrees in discovery_cache in the discovered tree and
+    returns the plays, vars, and discovered rules of the subtrees that still
+    need to be discovered.   The paths of the rules are paths in
+    new_desired_state.
+    '''
+
+    cached_ids = set()
+    for discovery_id, changed_subtree_path, subtree, path in discovered_rules:
+        ran_rule = ran_rules[discovery_id]
+        cached = discovery_cache.get(ran_rule.rule, path, ran_rule.inventory_name, new_desired_state)
+        if cached is not None:
+            print('cached discovery', changed_subtree_path, ran_rule.inventory_name)
+            new_discovered_tree.set(path, cached[0])
+            cached_ids.add(discovery_id)
+    return skip_discovery(plays, destructured_vars_list, discovered_rules, cached_ids)
+
+
+def cache_discovered_states(discovery_cache, new_desired_state, new_discovered_tree, ran_rules, discovered_rules, discovered):
+    '''
+    Adds the subtrees with discovery ids in discovered to discovery_cache.
+    '''
+
+    for discovery_id, changed_subtree_path, subtree, path in discovered_rules:
+        if discovery_id in discovered:
+            ran_rule = ran_rules[discovery_id]
+            discovery_cache.set(ran_rule.rule, path, ran_rule.inventory_name, new_desired_state,
+                                get_path(new_discovered_tree.state, path))
+
+
+def update_discovered_state(new_discovered_tree, temp_dir, discovery_id, changed_subtree_path, subtree, path):
+    '''
+    Sets the state that a retrieve task wrote to discovered_state_N.yml in the
+    discovered tree.  Returns True if the file was found.
+    '''
 
     discovered_state_file = os.path.join(
         temp_dir, 'project', f'discovered_state_{discovery_id}.yml')
@@ -400,46 +1169,38 @@ def update_discovered_state(new_discovered_state, temp_dir, discovery_id, change
             print(yaml.safe_dump(discovered_subtree_state, default_flow_style=False))
             print(yaml.safe_dump(subtree, default_flow_style=False))
 
-        # List case
-        match_list = re.match(r"(.*)\[(\d+)\]$", changed_subtree_path)
-        if match_list:
-            parent_path = match_list.groups()[0]
-            index = int(match_list.groups()[1])
-            extract(new_discovered_state, parent_path)[
-                index] = discovered_subtree_state
-
-        # Dict case
-        match_dict = re.match(r"(.*)\['(\S+)'\]$", changed_subtree_path)
-        if match_dict and not match_list:
-            parent_path = match_dict.groups()[0]
-            index = match_dict.groups()[1]
-            extract(new_discovered_state, parent_path)[
-                index] = discovered_subtree_state
-
-        if not match_dict and not match_list:
+        if not path:
             assert False, f"type of changed_subtree_path not supported {changed_subtree_path}"
+        new_discovered_tree.set(path, discovered_subtree_state)
 
-        print(yaml.safe_dump(new_discovered_state, default_flow_style=False))
+        print(yaml.safe_dump(new_discovered_tree.state, default_flow_style=False))
+        return True
+    return False
 
 
 def destructure_vars(rule, subtree):
 
     destructured_vars = {}
 
-    for name, extract_path in rule.get('vars', {}).items():
-        destructured_vars[name] = extract(subtree, extract_path)
+    for name, accessor in compile_rule_paths(rule).vars:
+        destructured_vars[name] = accessor.get(subtree)
 
     return destructured_vars
 
 
-def desired_state_validation(monitor, secrets, project_src, current_state, ran_rules, inventory, explain):
+def build_validation_plays(ran_rules):
+    '''
+    build_validation_plays builds a play that runs the validate tasks for each
+    rule that was run.   Returns the plays, the vars for each play, and the
+    rules and subtrees that will be validated.
+    '''
 
     plays = []
 
     destructured_vars_list = []
     validated_rules = []
 
-    for rule, changed_subtree_path, subtree, inventory_name in ran_rules:
+    for rule, changed_subtree_path, subtree, inventory_name, path in ran_rules:
 
         # Experiment: Build the vars using destructuring
         destructured_vars = destructure_vars(rule, subtree)
@@ -466,22 +1227,37 @@ def desired_state_validation(monitor, secrets, project_src, current_state, ran_r
 
             plays.append(play)
             destructured_vars_list.append(destructured_vars)
-            validated_rules.append([changed_subtree_path, subtree])
+            validated_rules.append([rule, changed_subtree_path, subtree])
 
-    def runner_process_message(data):
-        if data.get('event', '') == 'runner_on_ok':
-            event_data = data.get('event_data', {})
-            if event_data.get('task_action', '') not in ['include_tasks', 'include_vars']:
-                monitor.stream.put_message(ValidationTask(0, now(), event_data.get('host'),
-                                                          event_data.get(
-                                                              'task_action', ''),
-                                                          'ok'))
-        if data.get('event', '') == 'playbook_on_stats':
-            event_data = data.get('event_data', {})
-            for host in event_data.get('ok', {}).keys():
-                monitor.stream.put_message(ValidationResult(0, now(), host, 'ok'))
+    return plays, destructured_vars_list, validated_rules
 
-        monitor.stream.put_message(Stdout(0, now(), data.get('stdout', '')))
+
+def process_validation_message(monitor, data):
+    '''
+    Sends the validation task results and the validation results per host in
+    an ansible-runner event to the stream.
+    '''
+
+    if data.get('event', '') == 'runner_on_ok':
+        event_data = data.get('event_data', {})
+        if event_data.get('task_action', '') not in ['include_tasks', 'include_vars']:
+            monitor.stream.put_message(ValidationTask(0, now(), event_data.get('host'),
+                                                      event_data.get(
+                                                          'task_action', ''),
+                                                      'ok'))
+    if data.get('event', '') == 'playbook_on_stats':
+        event_data = data.get('event_data', {})
+        for host in event_data.get('ok', {}).keys():
+            monitor.stream.put_message(ValidationResult(0, now(), host, 'ok'))
+
+
+def desired_state_validation(monitor, secrets, project_src, current_state, ran_rules, inventory, explain):
+
+    plays, destructured_vars_list, validated_rules = build_validation_plays(ran_rules)
+
+    def runner_process_message(data):
+        process_validation_message(monitor, data)
+        monitor.events.put(data.get('stdout', ''))
 
     if not plays:
         return None
@@ -493,7 +1269,116 @@ def desired_state_validation(monitor, secrets, project_src, current_state, ran_r
                             plays,
                             secrets,
                             project_src,
-                            inventory)
-    result = runner.run()
+                            inventory,
+                            full_state=uses_full_state([rule[0] for rule in validated_rules]),
+                            job_timeout=job_deadline(monitor.rules, [rule[0] for rule in validated_rules]),
+                            **runner_options(monitor))
+    try:
+        return runner.run()
+    finally:
+        runner.release()
+
+
+PipelineResult = namedtuple('PipelineResult', ['ran_rules', 'discovered_actual_state', 'operational_actual_state'])
+
+
+def desired_state_pipeline(monitor, secrets, project_src, current_desired_state, new_desired_state, rules, inventory, explain):
+    '''
+    desired_state_pipeline implements the differences between two states like
+    desired_state_diff but also runs the retrieve plays of desired_state_discovery
+    and the validate plays of desired_state_validation in the same playbook so that
+    ansible-runner is started once per reconciliation.   The results are returned
+    in a PipelineResult for the Discover1 and Validate1 states.   The
+    discovered state of the result is None if the run failed.
+    '''
+
+    diff = monitor.diffs.get(current_desired_state, new_desired_state, rules)
+
+    plays, destructured_vars_list, ran_rules = planned_apply_plays(monitor,
+                                                                   current_desired_state,
+                                                                   new_desired_state,
+                                                                   rules,
+                                                                   diff,
+                                                                   explain)
+    discovery_plays, discovery_vars_list, discovered_rules = build_discovery_plays(ran_rules)
+    validation_plays, validation_vars_list, validated_rules = build_validation_plays(ran_rules)
+
+    validation_play_names = set(play['name'] for play in validation_plays)
+    validation_hosts = set(play['hosts'] for play in validation_plays)
+
+    new_discovered_tree = monitor.state_trees.get(new_desired_state).copy()
+    published = set()
+    touched = set()
+    processed = set()
+    failed = set()
+    excluded = excluded_hosts(monitor, ran_rules)
+
+    def runner_process_message(data):
+        published.update(apply_published_states(new_discovered_tree, discovered_rules, data))
+        stats = touched_hosts(data)
+        if stats is not None:
+            touched.update(stats[0])
+            processed.update(stats[1])
+            failed.update(failed_hosts(data))
+        event_data = data.get('event_data', {})
+        if data.get('event', '') == 'playbook_on_stats':
+            stats = {'ok': {host: count for host, count in event_data.get('ok', {}).items()
+                            if host in validation_hosts}}
+            process_validation_message(monitor, dict(data, event_data=stats))
+        elif event_data.get('play') in validation_play_names:
+            process_validation_message(monitor, data)
+        monitor.events.put(data.get('stdout', ''))
 
-    return result
+    runner = PlaybookRunner(runner_process_message,
+                            new_desired_state,
+                            diff,
+                            destructured_vars_list + discovery_vars_list + validation_vars_list,
+                            plays + discovery_plays + validation_plays,
+                            secrets,
+                            project_src,
+                            inventory,
+                            full_state=uses_full_state([rule.rule for rule in ran_rules] +
+                                                       [ran_rules[rule[0]].rule for rule in discovered_rules] +
+                                                       [rule[0] for rule in validated_rules]),
+                            job_timeout=job_deadline(monitor.rules,
+                                                     [rule.rule for rule in ran_rules] +
+                                                     [ran_rules[rule[0]].rule for rule in discovered_rules] +
+                                                     [rule[0] for rule in validated_rules]),
+                            **runner_options(monitor))
+    try:
+        result = runner.run()
+
+        if monitor.discovery_cache is not None:
+            monitor.discovery_cache.applied(ran_rules, touched, processed, result, new_desired_state)
+
+        if not result and not failed:
+            # The run failed without host results
+            failed.update(ran_rule.inventory_name for ran_rule in ran_rules
+                          if ran_rule.inventory_name not in excluded)
+        monitor.failed_hosts = failed
+        monitor.processed_hosts = processed
+        monitor.excluded_hosts = excluded
+
+        if result:
+            for discovery_id, changed_subtree_path, subtree, path in discovered_rules:
+                if discovery_id not in published:
+                    if update_discovered_state(
+                            new_discovered_tree, runner.temp_dir, discovery_id, changed_subtree_path, subtree, path):
+                        published.add(discovery_id)
+            if monitor.discovery_cache is not None:
+                cache_discovered_states(monitor.discovery_cache, new_desired_state, new_discovered_tree,
+                                        ran_rules, discovered_rules, published)
+    finally:
+        runner.release()
+
+    if not result:
+        # Ansible skips the retrieve plays of the hosts that failed so the
+        # state is discovered again by Discover1
+        monitor.discovered_rules = []
+        return PipelineResult(ran_rules, None, None)
+
+    monitor.discovered_rules = [ran_rules[i] for i in sorted(published)]
+    monitor.state_trees.add(new_discovered_tree)
+    return PipelineResult(ran_rules,
+                          new_discovered_tree.state,
+                          result if validation_plays else None)
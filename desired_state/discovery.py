@@ -0,0 +1,190 @@
+'''
+Caching and digest checks of discovered subtrees.
+
+Discovery runs the retrieve tasks of every rule that was run even when the
+apply play did not change anything on the host.   A DiscoveryCache keeps the
+subtree that was discovered for a rule, subtree path, and host for ttl seconds
+so that the retrieve play is skipped while the subtree is fresh.   An apply
+that changes or fails on a host invalidates the cached subtrees of the paths it
+touched on that host.
+
+The items of a list are identified by the list_key of the list in the paths
+of the cache since their indexes change when items are inserted or removed.
+Subtrees in lists without a list_key are not cached.
+
+The rules file enables the cache with the number of seconds a discovered
+subtree is kept:
+
+    discovery_ttl: 60
+
+Rules can also retrieve a digest of the discovered subtree with digest_tasks
+in their retrieve section.   The subtree is only retrieved when the digest is
+different from the state_digest of the desired subtree.
+
+    retrieve:
+      tasks: retrieve.yml
+      digest_tasks: retrieve_digest.yml
+'''
+
+import copy
+import json
+import datetime
+import time
+import hashlib
+
+from .path import INDEX
+from .keyed_diff import build_list_keys
+
+
+# playbook_on_stats counters of hosts that may be in a different state after a run
+TOUCHED_STATS = ['changed', 'failures', 'dark', 'rescued', 'ignored']
+
+
+def touched_hosts(data):
+    '''
+    Returns the hosts that changed or failed in a playbook_on_stats event and
+    all the hosts in the event.   Returns None for other events.
+    '''
+
+    if data.get('event', '') != 'playbook_on_stats':
+        return None
+    event_data = data.get('event_data', {})
+    touched = set()
+    for counter in TOUCHED_STATS:
+        touched.update(host for host, count in (event_data.get(counter) or {}).items() if count)
+    return touched, set(event_data.get('processed') or {})
+
+
+def ansible_json(value):
+    '''
+    Converts the values that JSON does not support like the to_json filter in
+    Ansible which writes dates in ISO format.
+    '''
+
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def state_digest(state):
+    '''
+    Returns the SHA-256 digest of the state as JSON with sorted keys which is
+    the same digest as `state | to_json(sort_keys=True) | hash('sha256')` in
+    Ansible.   The digests of the merkle trees are not used since they cannot
+    be computed in a playbook.
+    '''
+
+    return hashlib.sha256(json.dumps(state, sort_keys=True, default=ansible_json).encode()).hexdigest()
+
+
+def identity_path(state, path, list_keys):
+    '''
+    Returns path with the indexes of items in lists with a list_key replaced
+    by the list_key and its value in the item of state.   The path stops at
+    the first index that cannot be replaced.
+    '''
+
+    identity = []
+    pattern = []
+    for part in path:
+        if isinstance(part, int):
+            key = list_keys.get(tuple(pattern))
+            if key is None or not isinstance(state, list) or not 0 <= part < len(state):
+                break
+            state = state[part]
+            if not isinstance(state, dict) or key not in state:
+                break
+            identity.append((key, state[key]))
+            pattern.append(INDEX)
+        else:
+            identity.append(part)
+            pattern.append(part)
+            state = state.get(part) if isinstance(state, dict) else None
+    return tuple(identity)
+
+
+def overlaps(path, other):
+    n = min(len(path), len(other))
+    return tuple(path[:n]) == tuple(other[:n])
+
+
+class DiscoveryCache(object):
+
+    '''
+    DiscoveryCache maps (rule, identity path, host) to the subtree that was
+    discovered less than ttl seconds ago.   Paths are the index paths of
+    subtrees in state which are converted to identity paths with the
+    list_keys of the rules.   The subtrees are copied in and out of the cache.
+    '''
+
+    def __init__(self, ttl, clock=time.monotonic, list_keys=None):
+        self.ttl = ttl
+        self.clock = clock
+        self.list_keys = list_keys or {}
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, rule, path, host, state):
+        identity = identity_path(state, path, self.list_keys)
+        if len(identity) != len(path):
+            return None
+        return (rule.get('rule_selector'), identity, host)
+
+    def get(self, rule, path, host, state):
+        '''
+        Returns a tuple with the discovered subtree or None if the subtree is
+        not cached or expired.
+        '''
+
+        key = self.key(rule, path, host, state)
+        entry = self.entries.get(key)
+        if entry is not None and self.clock() - entry[0] > self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return (copy.deepcopy(entry[1]),)
+
+    def set(self, rule, path, host, state, subtree):
+        key = self.key(rule, path, host, state)
+        if key is not None:
+            self.entries[key] = (self.clock(), copy.deepcopy(subtree))
+
+    def invalidate(self, path, host=None, state=None):
+        '''
+        Removes the subtrees that overlap the index path in state on host or on
+        every host if host is None.   A path that cannot be fully identified
+        removes every subtree under the part that can.
+        '''
+
+        identity = identity_path(state, path, self.list_keys)
+        for key in list(self.entries):
+            if (host is None or key[2] == host) and overlaps(key[1], identity):
+                del self.entries[key]
+
+    def applied(self, ran_rules, touched, processed, result, state):
+        '''
+        Invalidates the subtrees of the rules that were run on hosts that
+        changed or failed.   Hosts that are not in the stats of the run, such
+        as groups, invalidate the subtree on every host.
+        '''
+
+        for rule, changed_subtree_path, subtree, inventory_name, path in ran_rules:
+            if not result or inventory_name not in processed:
+                self.invalidate(path, None, state)
+            elif inventory_name in touched:
+                self.invalidate(path, inventory_name, state)
+
+
+def build_discovery_cache(rules):
+    '''
+    Returns a DiscoveryCache if the rules file sets discovery_ttl.
+    '''
+
+    ttl = rules.get('discovery_ttl')
+    if not ttl:
+        return None
+    return DiscoveryCache(ttl, list_keys=build_list_keys(rules))
@@ -0,0 +1,195 @@
+'''
+Processing of ansible-runner events before they reach the monitor.
+
+Most consumers of the stream only need task results and stats while ansible
+sends an event for every line of output.   An EventFilter drops the events
+that are not needed before they are converted to messages and counts what it
+dropped.   The rules file selects the events to keep:
+
+    verbosity: 0
+    event_filter:
+      events: [runner_on_ok, runner_on_failed, runner_on_unreachable]
+      actions: [command, shell]
+      hosts: [R1, R2]
+
+Each list is optional.  actions and hosts only apply to events that have a
+task action or a host.   playbook_on_stats events and the results of set_stats
+tasks are always kept since the results of runs are built from them.
+
+The output of each event that is kept is sent to the stream in a Stdout
+message.   With event_batch in the rules file the output is sent in
+StdoutBatch messages by an EventBatcher instead.   The batcher sends from its
+own green thread so that a slow stream never blocks the playbook run.   A
+batch is sent every window seconds or when max_events lines are waiting.
+While the stream is busy lines wait for the next batch up to max_pending lines
+and then the policy drops the oldest or the newest lines:
+
+    event_batch:
+      window: 0.1
+      max_events: 100
+      max_pending: 10000
+      policy: drop_oldest
+'''
+
+from collections import Counter, deque
+
+import gevent
+from gevent.event import Event
+
+from .messages import Stdout, StdoutBatch, now
+
+
+ALWAYS_KEEP = frozenset(['playbook_on_stats'])
+SET_STATS_ACTIONS = frozenset(['set_stats', 'ansible.builtin.set_stats'])
+
+
+class EventFilter(object):
+
+    '''
+    EventFilter keeps the events that match all of its lists and counts the
+    dropped events by event type in `dropped`.
+    '''
+
+    def __init__(self, events=None, actions=None, hosts=None):
+        self.events = frozenset(events) if events is not None else None
+        self.actions = frozenset(actions) if actions is not None else None
+        self.hosts = frozenset(hosts) if hosts is not None else None
+        self.dropped = Counter()
+
+    def accept(self, data):
+        event = data.get('event', '')
+        event_data = data.get('event_data', {})
+        if event in ALWAYS_KEEP or event_data.get('task_action') in SET_STATS_ACTIONS:
+            return True
+        if self.events is not None and event not in self.events:
+            self.dropped[event] += 1
+            return False
+        if self.actions is not None:
+            action = event_data.get('task_action')
+            if action is not None and action not in self.actions:
+                self.dropped[event] += 1
+                return False
+        if self.hosts is not None:
+            host = event_data.get('host')
+            if host is not None and host not in self.hosts:
+                self.dropped[event] += 1
+                return False
+        return True
+
+
+def build_event_filter(rules):
+    '''
+    Returns the EventFilter for the event_filter in the rules file or None if
+    all events are kept.
+    '''
+
+    event_filter = rules.get('event_filter')
+    if event_filter is None:
+        return None
+    return EventFilter(events=event_filter.get('events'),
+                       actions=event_filter.get('actions'),
+                       hosts=event_filter.get('hosts'))
+
+
+class StdoutSender(object):
+
+    '''
+    StdoutSender sends the output of each event in a Stdout message.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.dropped = 0
+
+    def put(self, stdout):
+        self.stream.put_message(Stdout(0, now(), stdout))
+
+    def close(self):
+        pass
+
+
+class EventBatcher(object):
+
+    '''
+    EventBatcher coalesces the output of events into StdoutBatch messages.
+    `dropped` counts the lines that were dropped because the stream was slow.
+    '''
+
+    def __init__(self, stream, window=0.1, max_events=100, max_pending=10000, policy='drop_oldest'):
+        if policy not in ('drop_oldest', 'drop_newest'):
+            raise Exception(f'Invalid event batch policy {policy} expected drop_oldest or drop_newest')
+        self.stream = stream
+        self.window = window
+        self.max_events = max_events
+        self.max_pending = max_pending
+        self.policy = policy
+        self.pending = deque()
+        self.pending_dropped = 0
+        self.dropped = 0
+        self.full = Event()
+        self.closing = False
+        self.thread = None
+
+    def put(self, stdout):
+        '''
+        Adds the output of one event to the next batch.  Never blocks.
+        '''
+
+        if not stdout:
+            return
+        if len(self.pending) >= self.max_pending:
+            self.pending_dropped += 1
+            self.dropped += 1
+            if self.policy == 'drop_newest':
+                return
+            self.pending.popleft()
+        self.pending.append(stdout)
+        if len(self.pending) >= self.max_events:
+            self.full.set()
+        if self.thread is None:
+            self.thread = gevent.spawn(self.send_batches)
+
+    def send_batches(self):
+        try:
+            while self.pending:
+                if not self.closing:
+                    self.full.wait(self.window)
+                self.full.clear()
+                self.send_batch()
+        finally:
+            self.thread = None
+
+    def send_batch(self):
+        batch = [self.pending.popleft() for _ in range(min(len(self.pending), self.max_events))]
+        dropped, self.pending_dropped = self.pending_dropped, 0
+        self.stream.put_message(StdoutBatch(0, now(), batch, dropped))
+
+    def close(self):
+        '''
+        Sends the lines that are waiting without waiting for the window.   The
+        sender finishes the batch it is sending and the rest before this
+        returns.
+        '''
+
+        self.closing = True
+        self.full.set()
+        if self.thread is not None:
+            self.thread.join()
+        while self.pending or self.pending_dropped:
+            self.send_batch()
+
+
+def build_event_batcher(rules, stream):
+    '''
+    Returns the EventBatcher for the event_batch settings in the rules file
+    or a StdoutSender if the rules file does not set event_batch.
+    '''
+
+    event_batch = rules.get('event_batch')
+    if event_batch is None:
+        return StdoutSender(stream)
+    return EventBatcher(stream,
+                        window=event_batch.get('window', 0.1),
+                        max_events=event_batch.get('max_events', 100),
+                        max_pending=event_batch.get('max_pending', 10000),
+                        policy=event_batch.get('policy', 'drop_oldest'))
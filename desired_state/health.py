@@ -0,0 +1,131 @@
+'''
+Host health tracking and job deadlines.
+
+A CircuitBreaker counts the runs of a monitor in which each host was
+unreachable or failed from the playbook_on_stats events of the runs.   When a
+host fails in threshold runs in a row its circuit opens and the host is
+excluded from the runs with --limit for cooldown seconds.   After the
+cool-down the host is run on again and a success closes its circuit while
+another failure opens it for another cool-down.   The subtrees of the rules that were excluded are reconciled
+after the cool-down (see reconciliation_fsm.py).
+
+The rules file enables the circuit breaker:
+
+    circuit_breaker:
+      threshold: 1
+      cooldown: 60
+
+Rules can set a deadline in seconds for the runs of their plays.   A run of
+several plays has the sum of their deadlines and no deadline if one of the
+plays has none.   The deadline at the top level of the rules file is the
+default for every rule.
+
+    deadline: 300
+    rules:
+      - rule_selector: root.routers.index
+        deadline: 60
+'''
+
+import time
+from collections import Counter
+
+from .retry import failed_hosts
+
+
+class CircuitBreaker(object):
+
+    '''
+    CircuitBreaker tracks the consecutive failures of each host and the time
+    at which the circuit of a host opened.
+    '''
+
+    def __init__(self, threshold=1, cooldown=60, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = Counter()
+        self.opened = {}
+
+    def record(self, data):
+        '''
+        Updates the health of the hosts in the playbook_on_stats event of a
+        run.   A host fails once per run if it was unreachable or had failed
+        tasks and succeeds if it is in the stats without failures.   Tasks
+        that run on the controller such as include_vars are ok even when the
+        host is down so the ok events of tasks are not a success.
+        '''
+
+        failed = failed_hosts(data)
+        if failed is None:
+            return
+        for host in failed:
+            self.failure(host)
+        for host in data.get('event_data', {}).get('processed') or {}:
+            if host not in failed:
+                self.success(host)
+
+    def failure(self, host):
+        self.failures[host] += 1
+        if self.failures[host] >= self.threshold:
+            if host not in self.opened:
+                print('circuit opened for', host)
+            self.opened[host] = self.clock()
+
+    def success(self, host):
+        self.failures.pop(host, None)
+        if self.opened.pop(host, None) is not None:
+            print('circuit closed for', host)
+
+    def open_hosts(self):
+        '''
+        Returns the hosts that are in their cool-down.
+        '''
+
+        now = self.clock()
+        return set(host for host, opened in self.opened.items() if now - opened < self.cooldown)
+
+    def reopens_in(self, hosts):
+        '''
+        Returns the seconds until the first of hosts is run on again.
+        '''
+
+        now = self.clock()
+        return max(0, min((self.opened[host] + self.cooldown - now for host in hosts if host in self.opened),
+                          default=0))
+
+
+def limit_pattern(excluded_hosts):
+    '''
+    Returns the --limit pattern that excludes excluded_hosts or None.
+    '''
+
+    if not excluded_hosts:
+        return None
+    return ':'.join(['all'] + ['!' + host for host in sorted(excluded_hosts)])
+
+
+def job_deadline(rules, rule_list):
+    '''
+    Returns the deadline in seconds of a run of the plays of the rules in
+    rule_list or 0 for no deadline.
+    '''
+
+    default = rules.get('deadline', 0)
+    deadlines = [rule.get('deadline', default) for rule in rule_list]
+    if not deadlines:
+        return default
+    if not all(deadlines):
+        return 0
+    return sum(deadlines)
+
+
+def build_circuit_breaker(rules):
+    '''
+    Returns a CircuitBreaker if the rules file enables it.
+    '''
+
+    circuit_breaker = rules.get('circuit_breaker')
+    if circuit_breaker is None:
+        return None
+    return CircuitBreaker(threshold=circuit_breaker.get('threshold', 1),
+                          cooldown=circuit_breaker.get('cooldown', 60))
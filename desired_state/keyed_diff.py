@@ -0,0 +1,206 @@
+'''
+A structural diff engine for desired states.
+
+DeepDiff with ignore_order=True compares every unmatched list item against
+every other unmatched item to find the closest pairs which becomes very slow on
+states with thousands of items in lists.   This engine instead identifies list
+items by a key declared in the rules file (e.g. `name`) and matches unkeyed
+list items by their hashed contents so that each level of the state is
+compared in linear time.   When the hash trees of the states are available
+(see merkle.py) subtrees with equal digests are skipped without being walked.
+
+The result uses the same change categories and path strings as DeepDiff so
+that it can be consumed by select_rules_recursive and convert_diff:
+
+    values_changed, type_changes, dictionary_item_added, dictionary_item_removed,
+    iterable_item_added, iterable_item_removed
+'''
+
+from .path import INDEX, format_path
+from .util import parse_rule_selector
+
+
+def build_list_keys(rules):
+    '''
+    Builds a mapping from list path patterns to the key that identifies the
+    items in that list.   A rule declares the key of the list it selects
+    items from with `list_key`:
+
+        rules:
+        - rule_selector: root.routers.index
+          list_key: name
+
+    The pattern is the tuple of the selector parts after root with `index`
+    standing for any list index, e.g. ('routers',) for the rule above.
+    '''
+
+    list_keys = {}
+
+    for rule in rules.get('rules', []):
+        if 'list_key' not in rule:
+            continue
+        parts = parse_rule_selector(rule['rule_selector'])
+        if parts[0] != 'root' or parts[-1] != INDEX:
+            raise Exception(
+                f"list_key requires a rule_selector of the form root[.key]...index not {rule['rule_selector']}")
+        list_keys[tuple(parts[1:-1])] = rule['list_key']
+
+    return list_keys
+
+
+def hashable(value):
+    '''
+    Converts a state value into a hashable value that compares equal for
+    states that DeepDiff with ignore_order=True considers equal.
+    '''
+
+    if isinstance(value, dict):
+        return frozenset((k, hashable(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return frozenset(hashable(v) for v in value)
+    return (type(value), value)
+
+
+class KeyedDiff(object):
+
+    '''
+    KeyedDiff walks two states at the same time and records the differences
+    between them in `result`.
+    '''
+
+    def __init__(self, list_keys=None):
+        self.list_keys = list_keys or {}
+        self.result = {}
+
+    def diff(self, t1, t2, node1=None, node2=None):
+        self.diff_value(t1, t2, (), (), node1, node2)
+        return self.result
+
+    def report(self, change_type, path, value):
+        self.result.setdefault(change_type, {})[format_path(path)] = value
+
+    def report_item(self, change_type, path):
+        self.result.setdefault(change_type, []).append(format_path(path))
+
+    def diff_value(self, t1, t2, path, pattern, node1=None, node2=None):
+        if t1 is t2:
+            return
+        if node1 is None or node2 is None:
+            node1 = node2 = None
+        elif node1.digest == node2.digest:
+            return
+        if type(t1) is not type(t2):
+            self.report('type_changes', path, {'old_type': type(t1),
+                                               'new_type': type(t2),
+                                               'old_value': t1,
+                                               'new_value': t2})
+        elif isinstance(t1, dict):
+            self.diff_dict(t1, t2, path, pattern, node1, node2)
+        elif isinstance(t1, list):
+            key = self.list_keys.get(pattern)
+            if key is None or not self.diff_keyed_list(t1, t2, key, path, pattern, node1, node2):
+                self.diff_unkeyed_list(t1, t2, path, pattern, node1, node2)
+        elif t1 != t2:
+            self.report('values_changed', path, {'new_value': t2,
+                                                 'old_value': t1})
+
+    def diff_dict(self, t1, t2, path, pattern, node1, node2):
+        for key, value in t2.items():
+            if key in t1:
+                self.diff_value(t1[key], value, path + (key,), pattern + (key,),
+                                child(node1, key), child(node2, key))
+            else:
+                self.report_item('dictionary_item_added', path + (key,))
+        for key in t1:
+            if key not in t2:
+                self.report_item('dictionary_item_removed', path + (key,))
+
+    def diff_keyed_list(self, t1, t2, key, path, pattern, node1, node2):
+        '''
+        Matches the items of two lists by the value of `key` in each item.
+        Returns False if the items cannot be identified by key.
+        '''
+
+        old_items = item_index(t1, key)
+        new_items = item_index(t2, key)
+        if old_items is None or new_items is None:
+            return False
+
+        pattern = pattern + (INDEX,)
+        for item_key, j in new_items.items():
+            i = old_items.get(item_key)
+            if i is None:
+                self.report('iterable_item_added', path + (j,), t2[j])
+            else:
+                self.diff_value(t1[i], t2[j], path + (j,), pattern,
+                                child(node1, i), child(node2, j))
+        for item_key, i in old_items.items():
+            if item_key not in new_items:
+                self.report('iterable_item_removed', path + (i,), t1[i])
+        return True
+
+    def diff_unkeyed_list(self, t1, t2, path, pattern, node1, node2):
+        '''
+        Matches the items of two lists by their contents ignoring the order
+        of the items.   Items that are left over on both sides are paired up in
+        order and compared to each other.
+        '''
+
+        old_items = {}
+        for i, item in enumerate(t1):
+            old_items.setdefault(item_hash(item, child(node1, i)), i)
+        new_items = {}
+        for j, item in enumerate(t2):
+            new_items.setdefault(item_hash(item, child(node2, j)), j)
+
+        removed = [i for h, i in old_items.items() if h not in new_items]
+        added = [j for h, j in new_items.items() if h not in old_items]
+
+        pattern = pattern + (INDEX,)
+        for i, j in zip(removed, added):
+            self.diff_value(t1[i], t2[j], path + (j,), pattern,
+                            child(node1, i), child(node2, j))
+        for j in added[len(removed):]:
+            self.report('iterable_item_added', path + (j,), t2[j])
+        for i in removed[len(added):]:
+            self.report('iterable_item_removed', path + (i,), t1[i])
+
+
+def child(node, key):
+    if node is None:
+        return None
+    return node.children[key]
+
+
+def item_hash(item, node):
+    if node is None:
+        return hashable(item)
+    return node.digest
+
+
+def item_index(items, key):
+    '''
+    Builds a mapping from the key value of each item to its index in the list.
+    Returns None if an item is missing the key or the key values are not unique.
+    '''
+
+    index = {}
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or key not in item:
+            return None
+        try:
+            if item[key] in index:
+                return None
+            index[item[key]] = i
+        except TypeError:
+            return None
+    return index
+
+
+def keyed_diff(t1, t2, list_keys=None, node1=None, node2=None):
+    '''
+    Finds the differences between two states using list keys to match the
+    items in lists.   node1 and node2 are the optional hash trees of the states.
+    '''
+
+    return KeyedDiff(list_keys).diff(t1, t2, node1, node2)
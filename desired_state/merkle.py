@@ -0,0 +1,142 @@
+'''
+Merkle hashed state trees.
+
+A StateTree wraps a state and keeps a content digest for every subtree of the
+state in a parallel tree of HashNodes.   Two subtrees with the same digest are
+equal so the diff engine can skip them without walking them and two states
+with the same root digest have no differences at all.
+
+The digests of lists do not depend on the order of the items to match the
+ignore_order semantics of the diff engines.
+'''
+
+import copy
+import hashlib
+from collections import OrderedDict
+
+
+class HashNode(object):
+
+    '''
+    HashNode holds the digest of one subtree of a state and the nodes of its
+    children.  Children is a dict for dicts, a list for lists, and None for
+    scalar values.   Nodes are never modified after they are built so they can
+    be shared between trees.
+    '''
+
+    __slots__ = ('digest', 'children')
+
+    def __init__(self, digest, children=None):
+        self.digest = digest
+        self.children = children
+
+
+def _digest(*parts):
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
+
+def dict_node(children):
+    entries = sorted((repr(k).encode(), child.digest) for k, child in children.items())
+    return HashNode(_digest(b'dict', *(k + b'=' + v for k, v in entries)), children)
+
+
+def list_node(children):
+    return HashNode(_digest(b'list', *sorted(set(child.digest for child in children))), children)
+
+
+def build_node(value):
+    '''
+    Builds the hash tree for a value.
+    '''
+
+    if isinstance(value, dict):
+        return dict_node({k: build_node(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return list_node([build_node(v) for v in value])
+    return HashNode(_digest(type(value).__name__.encode(), b':', repr(value).encode()))
+
+
+class StateTree(object):
+
+    '''
+    StateTree wraps a state with its hash tree.  Changes to the state must be
+    made with `set` to keep the digests up to date.
+    '''
+
+    def __init__(self, state, node=None):
+        self.state = state
+        self.node = node if node is not None else build_node(state)
+
+    @property
+    def digest(self):
+        return self.node.digest
+
+    def copy(self):
+        '''
+        Returns a deep copy of the state that shares the hash tree with this one.
+        '''
+
+        return StateTree(copy.deepcopy(self.state), self.node)
+
+    def set(self, path, value):
+        '''
+        Replaces the subtree at path with value and rehashes the nodes from the
+        new subtree up to the root.   Path is a tuple of keys and indexes.
+        '''
+
+        if not path:
+            self.state = value
+            self.node = build_node(value)
+            return
+
+        parents = []
+        container = self.state
+        node = self.node
+        for part in path[:-1]:
+            parents.append((container, node, part))
+            container = container[part]
+            node = node.children[part]
+        container[path[-1]] = value
+        parents.append((container, node, path[-1]))
+
+        child = build_node(value)
+        for container, node, part in reversed(parents):
+            if isinstance(container, dict):
+                children = dict(node.children)
+                children[part] = child
+                child = dict_node(children)
+            else:
+                children = list(node.children)
+                children[part] = child
+                child = list_node(children)
+        self.node = child
+
+
+class StateTreeCache(object):
+
+    '''
+    StateTreeCache keeps the hash trees of the most recently used states so
+    that a state is hashed once no matter how many times it is diffed.  States
+    are found by identity so a cached state must not be modified except
+    through its StateTree.
+    '''
+
+    def __init__(self, size=8):
+        self.size = size
+        self.trees = OrderedDict()
+
+    def get(self, state):
+        tree = self.trees.get(id(state))
+        if tree is None or tree.state is not state:
+            tree = StateTree(state)
+        self.add(tree)
+        return tree
+
+    def add(self, tree):
+        self.trees[id(tree.state)] = tree
+        self.trees.move_to_end(id(tree.state))
+        while len(self.trees) > self.size:
+            self.trees.popitem(last=False)
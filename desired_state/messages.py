@@ -59,6 +59,7 @@ ValidationResult = namedtuple('ValidationResult', ['seq_num', 'timestamp', 'host
 ValidationTask = namedtuple(
     'ValidationTask', ['seq_num', 'timestamp', 'host', 'task_action', 'result'])
 Stdout = namedtuple('Stdout', ['seq_num', 'timestamp', 'stdout'])
+StdoutBatch = namedtuple('StdoutBatch', ['seq_num', 'timestamp', 'stdout', 'dropped'])
 
 
 DesiredState = namedtuple('DesiredState', ['seq_num', 'timestamp', 'id', 'client_id', 'desired_state'])
@@ -81,6 +82,7 @@ DesiredSystemState = namedtuple(
     'DesiredSystemState', ['id', 'client_id', 'desired_state'])
 
 Shutdown = namedtuple('Shutdown', [])
+PlaybookFinished = namedtuple('PlaybookFinished', ['run_id', 'result', 'error'])
 
 ServiceInstance = namedtuple('ServiceInstance', ['id',
                                                  'service_id',
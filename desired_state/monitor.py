@@ -2,12 +2,21 @@
 
 import gevent
 import yaml
+from collections import namedtuple
 from gevent.queue import Queue
 from gevent_fsm.fsm import FSMController, Channel
 
 from . import reconciliation_fsm
+from .merkle import StateTreeCache
+from .diff import DiffCache, desired_state_prewarm, plan_desired_state
+from .connection import build_connection_cache
+from .retention import build_run_retention
+from .events import build_event_filter, build_event_batcher
+from .discovery import build_discovery_cache
+from .retry import build_retry_scheduler
+from .health import build_circuit_breaker
 
-from .messages import Inventory, Rules, DesiredState, now
+from .messages import Inventory, Rules, DesiredState, PlaybookFinished, now
 
 
 def convert_inventory(inventory):
@@ -18,6 +27,35 @@ def convert_inventory(inventory):
     return inventory
 
 
+class DesiredStateQueue(Queue):
+
+    '''
+    DesiredStateQueue buffers the messages that the FSM cannot handle in its
+    current state.   Only the newest DesiredState message is kept since the
+    older desired states are stale by the time the FSM gets to them.
+    `skipped` counts the DesiredState messages that were replaced.
+    `on_desired_state` is called with each DesiredState that is buffered.
+    '''
+
+    def __init__(self, on_desired_state=None):
+        Queue.__init__(self)
+        self.skipped = 0
+        self.on_desired_state = on_desired_state
+
+    def put(self, item, block=True, timeout=None):
+        if isinstance(item, DesiredState):
+            stale = [message for message in self.queue if isinstance(message, DesiredState)]
+            for message in stale:
+                self.queue.remove(message)
+            self.skipped += len(stale)
+        Queue.put(self, item, block, timeout)
+        if isinstance(item, DesiredState) and self.on_desired_state is not None:
+            self.on_desired_state(item)
+
+
+Speculation = namedtuple('Speculation', ['message', 'result'])
+
+
 class DesiredStateMonitor(object):
 
     '''
@@ -25,6 +63,17 @@ class DesiredStateMonitor(object):
     desired state configuration defined by one schema.   The FSM is defined by
     the reconciliation_fsm.py file.  The monitor receives state changes from
     its `queue` and sends status messages out of its `stream`.
+
+    Playbooks are run in their own green thread with `start_run` so that the
+    monitor keeps receiving messages while a playbook runs.   If the rules
+    file sets preempt to cancel or play a newer desired state cancels the
+    apply run that is in progress (see reconciliation_fsm.py).  If the
+    rules file sets speculative_planning the diff and plays for a buffered
+    desired state are found in a thread during the run with `speculate`.
+    If the rules file sets retry the rules that failed on some hosts are run
+    again with backoff before the monitor reverts (see retry.py).  If the
+    rules file sets circuit_breaker the subtrees of hosts that are excluded
+    from a run are reconciled after their cool-down with `defer_desired_state`.
     '''
 
     def __init__(self, tracer, fsm_id, secrets, project_src, rules, current_desired_state, inventory, stream):
@@ -32,14 +81,36 @@ class DesiredStateMonitor(object):
         self.project_src = project_src
         self.rules = rules
         self.ran_rules = []
+        self.discovered_rules = []
+        self.pipeline_result = None
+        self.run_id = 0
+        self.run_thread = None
+        self.prewarm_thread = None
+        self.cancelled_run_id = None
+        self.preempted = False
+        self.speculation = None
+        self.plan = None
+        self.failed_hosts = set()
+        self.processed_hosts = set()
+        self.excluded_hosts = set()
+        self.desired_state_message = None
         self.new_desired_state = None
         self.current_desired_state = current_desired_state
         self.discovered_actual_state = None
         self.operational_actual_state = None
+        self.state_trees = StateTreeCache()
+        self.diffs = DiffCache(self.state_trees)
+        self.connections = build_connection_cache(rules, project_src)
+        self.retention = build_run_retention(rules)
+        self.event_filter = build_event_filter(rules)
+        self.discovery_cache = build_discovery_cache(rules)
+        self.retries = build_retry_scheduler(rules)
+        self.circuit_breaker = build_circuit_breaker(rules)
         self.inventory = inventory
         self.tracer = tracer
         self.stream = stream
-        self.buffered_messages = Queue()
+        self.events = build_event_batcher(rules, stream)
+        self.buffered_messages = DesiredStateQueue(self.speculate)
         self.controller = FSMController(
             self, "reconciliation_fsm", fsm_id, reconciliation_fsm.Start, self.tracer, self.tracer)
         self.controller.outboxes['default'] = Channel(
@@ -49,3 +120,96 @@ class DesiredStateMonitor(object):
         self.stream.put_message(Rules(0, now(), rules))
         self.stream.put_message(DesiredState(0, now(), 0, 0, current_desired_state))
         self.thread = gevent.spawn(self.controller.receive_messages)
+        if self.connections is not None and rules.get('prewarm_connections', False):
+            self.prewarm_thread = gevent.spawn(desired_state_prewarm, self, secrets, project_src, inventory)
+
+    def start_run(self, function, *args):
+        '''
+        Calls function with this monitor and args in a new green thread and
+        sends a PlaybookFinished message with the result or the error to the
+        FSM when it returns.   Returns the id of the run.
+        '''
+
+        self.run_id += 1
+        run_id = self.run_id
+
+        def run():
+            try:
+                result = function(self, *args)
+            except Exception as e:
+                self.queue.put(PlaybookFinished(run_id, None, e))
+            else:
+                self.queue.put(PlaybookFinished(run_id, result, None))
+
+        self.run_thread = gevent.spawn(run)
+        return run_id
+
+    def cancel_run(self):
+        '''
+        Asks the PlaybookRunners of the current run to stop.   The run still
+        sends a PlaybookFinished message when it returns.
+        '''
+
+        if self.run_thread is not None:
+            self.cancelled_run_id = self.run_id
+
+    def run_cancelled(self, run_id):
+        return self.cancelled_run_id == run_id
+
+    def speculate(self, message):
+        '''
+        Plans the reconciliation of a buffered DesiredState message in a
+        thread.   The plan assumes that the reconciliation in progress
+        succeeds and is only used if it does (see `take_plan`).   Before the
+        first reconciliation the plan is from the current desired state.
+        '''
+
+        if not self.rules.get('speculative_planning', False):
+            return
+        if self.new_desired_state is None:
+            current_tree = self.state_trees.get(self.current_desired_state)
+        else:
+            current_tree = self.state_trees.get(self.new_desired_state)
+        self.speculation = Speculation(message,
+                                       gevent.get_hub().threadpool.spawn(plan_desired_state,
+                                                                         current_tree,
+                                                                         message.desired_state,
+                                                                         self.rules))
+
+    def take_plan(self, message):
+        '''
+        Returns the speculative plan for a DesiredState message or None if
+        there is no plan for the message.   Waits for the planning to finish.
+        '''
+
+        speculation = self.speculation
+        if speculation is None or speculation.message is not message:
+            return None
+        self.speculation = None
+        try:
+            plan = speculation.result.get()
+        except Exception as e:
+            print('speculative planning failed', e)
+            return None
+        self.state_trees.add(plan.tree)
+        return plan
+
+    def defer_desired_state(self, hosts):
+        '''
+        Sends the current DesiredState message to the FSM again when the first
+        of hosts is run on again unless a newer desired state arrived in the
+        meantime.
+        '''
+
+        message = self.desired_state_message
+        delay = self.circuit_breaker.reopens_in(hosts)
+        print('deferring hosts', sorted(hosts), 'for', delay)
+
+        def resend():
+            if self.desired_state_message is not message:
+                return
+            if any(isinstance(buffered, DesiredState) for buffered in self.buffered_messages.queue):
+                return
+            self.queue.put(message)
+
+        gevent.spawn_later(delay, resend)
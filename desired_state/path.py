@@ -0,0 +1,110 @@
+'''
+Paths into a state.
+
+A path is a tuple of the dict keys and list indexes from the root of a state
+to a subtree e.g. ('routers', 0, 'name').   DeepDiff and the rules use the
+string form of a path e.g. root['routers'][0]['name'].
+'''
+
+import re
+import ast
+from functools import lru_cache
+from deepdiff import extract
+
+ROOTS = ('root', 'node')
+
+INDEX = 'index'
+
+PATH_PART = re.compile(r"\[(\d+)\]|\['((?:[^'\\]|\\.)*)'\]|\[\"((?:[^\"\\]|\\.)*)\"\]")
+
+
+def format_path(path):
+    '''
+    Formats a path tuple as a DeepDiff path string e.g. root['routers'][0]
+    '''
+
+    parts = ['root']
+    for part in path:
+        if isinstance(part, str):
+            parts.append(f'[{part!r}]')
+        else:
+            parts.append(f'[{part}]')
+    return ''.join(parts)
+
+
+def parse_path(path):
+    '''
+    Parses a DeepDiff path string e.g. root['routers'][0] into a path tuple.
+    Paths relative to a subtree may start with node instead of root.
+    '''
+
+    if not path.startswith(ROOTS):
+        raise Exception(f'Invalid path {path}')
+    parts = []
+    position = 4
+    while position < len(path):
+        match = PATH_PART.match(path, position)
+        if match is None:
+            raise Exception(f'Invalid path {path}')
+        index, single_quoted, double_quoted = match.groups()
+        if index is not None:
+            parts.append(int(index))
+        else:
+            # The key is a Python string literal as written by repr
+            parts.append(ast.literal_eval(match.group(0)[1:-1]))
+        position = match.end()
+    return tuple(parts)
+
+
+def get_path(state, path):
+    '''
+    Returns the subtree of state at path.
+    '''
+
+    for part in path:
+        state = state[part]
+    return state
+
+
+def set_path(state, path, value):
+    '''
+    Replaces the subtree of state at path with value.
+    '''
+
+    get_path(state, path[:-1])[path[-1]] = value
+
+
+class PathAccessor(object):
+
+    '''
+    PathAccessor is a compiled getter and setter for one path.  Paths that
+    cannot be parsed into a path tuple fall back to deepdiff.extract.
+    '''
+
+    __slots__ = ('path_string', 'path')
+
+    def __init__(self, path_string):
+        self.path_string = path_string
+        try:
+            self.path = parse_path(path_string)
+        except Exception:
+            self.path = None
+
+    def get(self, state):
+        if self.path is None:
+            return extract(state, self.path_string)
+        return get_path(state, self.path)
+
+    def set(self, state, value):
+        if self.path is None:
+            raise Exception(f'Cannot set unsupported path {self.path_string}')
+        set_path(state, self.path, value)
+
+
+@lru_cache(maxsize=4096)
+def compile_path(path_string):
+    '''
+    Returns the PathAccessor for a path string parsing each path only once.
+    '''
+
+    return PathAccessor(path_string)
@@ -1,15 +1,115 @@
 from gevent_fsm.fsm import State, transitions
 
 import yaml
-from deepdiff import DeepDiff
 from pprint import pprint
-from .diff import desired_state_diff, desired_state_discovery, desired_state_validation, convert_diff
+from .diff import desired_state_diff, desired_state_discovery, desired_state_validation, desired_state_pipeline, convert_diff
+from .diff import desired_state_retry, converged_state
+from .path import get_path
+from .retry import failed_rules
 from .messages import FSMState, DesiredState, Diff, now
 
 
+def finished_run(monitor, message):
+    '''
+    Returns True if a PlaybookFinished message is from the current run of the
+    monitor.  Raises the error of the run if the run failed.
+    '''
+
+    if message.run_id != monitor.run_id:
+        return False
+    monitor.run_thread = None
+    if message.error is not None:
+        raise message.error
+    return True
+
+
+def preempt_run(monitor, message):
+    '''
+    Buffers a DesiredState message that arrived during an apply run and
+    cancels the run if the rules allow preemption.   The subtrees of the
+    rules that were run are discovered before the newest desired state is
+    reconciled.
+    '''
+
+    monitor.buffered_messages.put(message)
+    if monitor.rules.get('preempt') and monitor.run_thread is not None and not monitor.preempted:
+        print('preempting run', monitor.run_id)
+        monitor.preempted = True
+        monitor.cancel_run()
+
+
+def end_preemption(monitor):
+    '''
+    Sets the subtrees that were discovered after a preempted run in the
+    current desired state so that the newest desired state is reconciled
+    against it.   Subtrees that were not discovered, such as the subtrees of
+    rules without a retrieve action or of a failed discovery, keep their
+    values in the current desired state since they may not have been applied.
+    '''
+
+    monitor.preempted = False
+    monitor.current_desired_state = converged_state(monitor.state_trees,
+                                                    monitor.current_desired_state,
+                                                    monitor.discovered_actual_state,
+                                                    monitor.discovered_rules)
+
+
+def should_retry(monitor):
+    '''
+    Returns True if the rules file enables retries and the last apply run
+    failed on some hosts.   The subtrees of the rules that succeeded become
+    part of the current desired state so that only the failed rules are
+    retried or reverted.
+    '''
+
+    if monitor.retries is None or monitor.preempted or not monitor.failed_hosts:
+        return False
+    failed = failed_rules(monitor.ran_rules, monitor.failed_hosts, monitor.processed_hosts)
+    succeeded = [ran_rule for ran_rule in monitor.ran_rules if ran_rule not in failed]
+    monitor.current_desired_state = converged_state(monitor.state_trees,
+                                                    monitor.current_desired_state,
+                                                    monitor.new_desired_state,
+                                                    succeeded)
+    monitor.pipeline_result = None
+    return True
+
+
+def defer_excluded_hosts(monitor, base_state):
+    '''
+    Reconciles the subtrees of the rules that ran on hosts that the circuit
+    breaker excluded, or that failed and opened their circuit, after their
+    cool-down.   The new desired state becomes base_state with the subtrees
+    of the other rules so that the rest of the hosts converge now.
+    '''
+
+    if monitor.circuit_breaker is None or monitor.preempted or monitor.desired_state_message is None:
+        return
+    hosts = monitor.excluded_hosts | (monitor.failed_hosts & monitor.circuit_breaker.open_hosts())
+    deferred = [ran_rule for ran_rule in monitor.ran_rules if ran_rule.inventory_name in hosts]
+    if not deferred:
+        return
+    monitor.failed_hosts = monitor.failed_hosts - hosts
+    applied = [ran_rule for ran_rule in monitor.ran_rules if ran_rule not in deferred]
+    monitor.new_desired_state = converged_state(monitor.state_trees,
+                                                base_state,
+                                                monitor.new_desired_state,
+                                                applied)
+    monitor.ran_rules = [ran_rule for ran_rule in applied if has_subtree(monitor.new_desired_state, ran_rule.path)]
+    monitor.pipeline_result = None
+    monitor.defer_desired_state(hosts)
+
+
+def has_subtree(state, path):
+    try:
+        get_path(state, path)
+    except (KeyError, IndexError, TypeError):
+        return False
+    return True
+
+
 class _Validate1(State):
 
-    @transitions('Diff2')
+    @transitions('Waiting')
     def start(self, controller):
         controller.context.stream.put_message(FSMState(0, now(), 'Validate1'))
 
@@ -18,13 +118,30 @@ class _Validate1(State):
 
         monitor = controller.context
 
-        monitor.operational_actual_state = desired_state_validation(monitor,
-                                                                    monitor.secrets,
-                                                                    monitor.project_src,
-                                                                    monitor.new_desired_state,
-                                                                    monitor.ran_rules,
-                                                                    monitor.inventory,
-                                                                    False)
+        if monitor.pipeline_result is not None:
+            # Validation already ran in the pipelined playbook
+            monitor.operational_actual_state = monitor.pipeline_result.operational_actual_state
+            monitor.pipeline_result = None
+            controller.changeState(Waiting)
+            return
+
+        monitor.start_run(desired_state_validation,
+                          monitor.secrets,
+                          monitor.project_src,
+                          monitor.new_desired_state,
+                          monitor.ran_rules,
+                          monitor.inventory,
+                          False)
+
+    @transitions('Waiting')
+    def onPlaybookFinished(self, controller, message_type, message):
+
+        monitor = controller.context
+
+        if not finished_run(monitor, message):
+            return
+
+        monitor.operational_actual_state = message.result
         controller.changeState(Waiting)
 
 
@@ -42,15 +159,35 @@ class _Discover1(State):
 
         monitor = controller.context
 
-        monitor.discovered_actual_state = desired_state_discovery(monitor,
-                                                                  monitor.secrets,
-                                                                  monitor.project_src,
-                                                                  monitor.current_desired_state,
-                                                                  monitor.new_desired_state,
-                                                                  monitor.ran_rules,
-                                                                  monitor.inventory,
-                                                                  False)
+        if monitor.pipeline_result is not None:
+            # Discovery already ran in the pipelined playbook
+            monitor.discovered_actual_state = monitor.pipeline_result.discovered_actual_state
+            controller.changeState(Diff2)
+            return
+
+        monitor.start_run(desired_state_discovery,
+                          monitor.secrets,
+                          monitor.project_src,
+                          monitor.current_desired_state,
+                          monitor.new_desired_state,
+                          monitor.ran_rules,
+                          monitor.inventory,
+                          False)
+
+    @transitions('Diff2')
+    @transitions('Waiting')
+    def onPlaybookFinished(self, controller, message_type, message):
+
+        monitor = controller.context
 
+        if not finished_run(monitor, message):
+            return
+
+        monitor.discovered_actual_state = message.result
+        if monitor.preempted:
+            end_preemption(monitor)
+            controller.changeState(Waiting)
+            return
         controller.changeState(Diff2)
 
 
@@ -59,35 +196,77 @@ Discover1 = _Discover1()
 
 class _Help(State):
 
+    @transitions('Waiting')
     def start(self, controller):
         controller.context.stream.put_message(FSMState(0, now(), 'Help'))
 
+        # The failed subtrees keep their values in the current desired state
+        # so the next desired state tries them again
+        monitor = controller.context
+        print('reconciliation failed on hosts', sorted(monitor.failed_hosts))
+        monitor.pipeline_result = None
+        controller.changeState(Waiting)
+
 
 Help = _Help()
 
 
 class _Reconcile1(State):
 
-    @transitions('Discover1')
-    @transitions('Retry')
     def start(self, controller):
         controller.context.stream.put_message(FSMState(0, now(), 'Reconcile1'))
 
         monitor = controller.context
 
-        monitor.ran_rules = desired_state_diff(monitor,
-                                               monitor.secrets,
-                                               monitor.project_src,
-                                               monitor.current_desired_state,
-                                               monitor.new_desired_state,
-                                               monitor.rules,
-                                               monitor.inventory,
-                                               False)
+        if monitor.rules.get('pipeline', False):
+            # Run the apply, retrieve, and validate plays in one playbook
+            monitor.start_run(desired_state_pipeline,
+                              monitor.secrets,
+                              monitor.project_src,
+                              monitor.current_desired_state,
+                              monitor.new_desired_state,
+                              monitor.rules,
+                              monitor.inventory,
+                              False)
+        else:
+            monitor.start_run(desired_state_diff,
+                              monitor.secrets,
+                              monitor.project_src,
+                              monitor.current_desired_state,
+                              monitor.new_desired_state,
+                              monitor.rules,
+                              monitor.inventory,
+                              False)
 
-        if True:
-            controller.changeState(Discover1)
+    @transitions('Discover1')
+    @transitions('Retry')
+    def onPlaybookFinished(self, controller, message_type, message):
+
+        monitor = controller.context
+
+        if not finished_run(monitor, message):
+            return
+
+        if monitor.rules.get('pipeline', False):
+            monitor.pipeline_result = message.result
+            monitor.ran_rules = monitor.pipeline_result.ran_rules
         else:
+            monitor.ran_rules = message.result
+
+        if monitor.pipeline_result is not None and (monitor.preempted or
+                                                    monitor.failed_hosts or
+                                                    monitor.pipeline_result.discovered_actual_state is None):
+            # The pipelined discovery did not finish or skipped the failed hosts
+            monitor.pipeline_result = None
+
+        defer_excluded_hosts(monitor, monitor.current_desired_state)
+        if should_retry(monitor):
             controller.changeState(Retry)
+        else:
+            controller.changeState(Discover1)
+
+    def onDesiredState(self, controller, message_type, message):
+        preempt_run(controller.context, message)
 
 
 Reconcile1 = _Reconcile1()
@@ -95,26 +274,38 @@ Reconcile1 = _Reconcile1()
 
 class _Reconcile2(State):
 
-    @transitions('Discover1')
-    @transitions('Retry')
     def start(self, controller):
         controller.context.stream.put_message(FSMState(0, now(), 'Reconcile2'))
 
         monitor = controller.context
 
-        result = desired_state_diff(monitor,
-                                    monitor.secrets,
-                                    monitor.project_src,
-                                    monitor.discovered_actual_state,
-                                    monitor.new_desired_state,
-                                    monitor.rules,
-                                    monitor.inventory,
-                                    False)
+        monitor.start_run(desired_state_diff,
+                          monitor.secrets,
+                          monitor.project_src,
+                          monitor.discovered_actual_state,
+                          monitor.new_desired_state,
+                          monitor.rules,
+                          monitor.inventory,
+                          False)
 
-        if result:
-            controller.changeState(Discover1)
-        else:
+    @transitions('Discover1')
+    @transitions('Retry')
+    def onPlaybookFinished(self, controller, message_type, message):
+
+        monitor = controller.context
+
+        if not finished_run(monitor, message):
+            return
+
+        monitor.ran_rules = message.result
+        defer_excluded_hosts(monitor, monitor.discovered_actual_state)
+        if should_retry(monitor):
             controller.changeState(Retry)
+        else:
+            controller.changeState(Discover1)
+
+    def onDesiredState(self, controller, message_type, message):
+        preempt_run(controller.context, message)
 
 
 Reconcile2 = _Reconcile2()
@@ -122,26 +313,34 @@ Reconcile2 = _Reconcile2()
 
 class _Reconcile3(State):
 
-    @transitions('Discover1')
-    @transitions('Retry')
     def start(self, controller):
         controller.context.stream.put_message(FSMState(0, now(), 'Reconcile3'))
 
         monitor = controller.context
 
-        result = desired_state_diff(monitor,
-                                    monitor.secrets,
-                                    monitor.project_src,
-                                    monitor.discovered_actual_state,
-                                    monitor.current_desired_state,
-                                    monitor.rules,
-                                    monitor.inventory,
-                                    False)
+        monitor.start_run(desired_state_diff,
+                          monitor.secrets,
+                          monitor.project_src,
+                          monitor.discovered_actual_state,
+                          monitor.current_desired_state,
+                          monitor.rules,
+                          monitor.inventory,
+                          False)
 
-        if result:
-            controller.changeState(Discover2)
+    @transitions('Discover2')
+    @transitions('Help')
+    def onPlaybookFinished(self, controller, message_type, message):
+
+        monitor = controller.context
+
+        if not finished_run(monitor, message):
+            return
+
+        monitor.ran_rules = message.result
+        if monitor.failed_hosts:
+            controller.changeState(Help)
         else:
-            controller.changeState(Retry)
+            controller.changeState(Discover2)
 
 
 Reconcile3 = _Reconcile3()
@@ -152,7 +351,14 @@ class _Waiting(State):
     def start(self, controller):
         controller.context.stream.put_message(FSMState(0, now(), 'Waiting'))
         print("reconciliation_fsm buffered_messages",
-              len(controller.context.buffered_messages))
+              len(controller.context.buffered_messages),
+              "skipped desired states",
+              controller.context.buffered_messages.skipped)
+        if controller.context.event_filter is not None:
+            print("reconciliation_fsm dropped events",
+                  dict(controller.context.event_filter.dropped))
+        print("reconciliation_fsm dropped output lines",
+              controller.context.events.dropped)
         if not controller.context.buffered_messages.empty():
             controller.context.queue.put(
                 controller.context.buffered_messages.get())
@@ -160,8 +366,18 @@ class _Waiting(State):
     @transitions('Diff1')
     def onDesiredState(self, controller, message_type, message):
         print('Waiting.onDesiredState')
-        controller.context.new_desired_state = yaml.safe_load(
-            message.desired_state)
+        monitor = controller.context
+        monitor.desired_state_message = message
+        plan = monitor.take_plan(message)
+        if plan is None:
+            controller.context.new_desired_state = yaml.safe_load(
+                message.desired_state)
+        else:
+            monitor.new_desired_state = plan.new_desired_state
+            if plan.current_desired_state is monitor.current_desired_state:
+                # The reconciliation that the plan was made for succeeded
+                monitor.diffs.add(plan.current_desired_state, plan.new_desired_state, plan.diff, monitor.rules)
+                monitor.plan = plan
         controller.context.stream.put_message(
             DesiredState(0, now(), 0, 0, controller.context.new_desired_state))
         controller.changeState(Diff1)
@@ -178,8 +394,17 @@ class _Waiting(State):
         controller.changeState(Discover2)
 
     def onShutdown(self, controller, message_type, message):
+        if controller.context.prewarm_thread is not None:
+            controller.context.prewarm_thread.kill()
+        if controller.context.connections is not None:
+            controller.context.connections.close()
+        controller.context.events.close()
         controller.context.thread.kill()
 
+    def onPlaybookFinished(self, controller, message_type, message):
+        # A run that is no longer current finished
+        pass
+
 
 Waiting = _Waiting()
 
@@ -190,8 +415,9 @@ class _Diff1(State):
     @transitions('Waiting')
     def start(self, controller):
         controller.context.stream.put_message(FSMState(0, now(), 'Diff1'))
-        controller.context.diff = DeepDiff(
-            controller.context.current_desired_state, controller.context.new_desired_state, ignore_order=True)
+        controller.context.diff = controller.context.diffs.get(controller.context.current_desired_state,
+                                                               controller.context.new_desired_state,
+                                                               controller.context.rules)
         pprint(controller.context.diff)
         controller.context.stream.put_message(
             Diff(0, now(), convert_diff(controller.context.diff)))
@@ -210,15 +436,35 @@ class _Revert(State):
     def start(self, controller):
         controller.context.stream.put_message(FSMState(0, now(), 'Revert'))
 
-    @transitions('Help')
-    def failure(self, controller, message_type, message):
+        monitor = controller.context
 
-        controller.changeState(Help)
+        # Apply the current desired state to the subtrees that failed
+        monitor.start_run(desired_state_diff,
+                          monitor.secrets,
+                          monitor.project_src,
+                          monitor.new_desired_state,
+                          monitor.current_desired_state,
+                          monitor.rules,
+                          monitor.inventory,
+                          False)
 
+    @transitions('Help')
     @transitions('Discover1')
-    def success(self, controller, message_type, message):
+    def onPlaybookFinished(self, controller, message_type, message):
 
-        controller.changeState(Discover1)
+        monitor = controller.context
+
+        if not finished_run(monitor, message):
+            return
+
+        if monitor.failed_hosts:
+            controller.changeState(Help)
+        else:
+            monitor.new_desired_state = monitor.current_desired_state
+            # The subtrees that the revert removed are not discovered
+            monitor.ran_rules = [ran_rule for ran_rule in message.result
+                                 if has_subtree(monitor.new_desired_state, ran_rule.path)]
+            controller.changeState(Discover1)
 
 
 Revert = _Revert()
@@ -230,8 +476,9 @@ class _Diff3(State):
     @transitions('Waiting')
     def start(self, controller):
         controller.context.stream.put_message(FSMState(0, now(), 'Diff3'))
-        controller.context.diff = DeepDiff(
-            controller.context.discovered_actual_state, controller.context.current_desired_state, ignore_order=True)
+        controller.context.diff = controller.context.diffs.get(controller.context.discovered_actual_state,
+                                                               controller.context.current_desired_state,
+                                                               controller.context.rules)
         print(controller.context.diff)
 
         if controller.context.diff:
@@ -275,13 +522,16 @@ class _Diff2(State):
     @transitions('Validate1')
     def start(self, controller):
         controller.context.stream.put_message(FSMState(0, now(), 'Diff2'))
-        controller.context.diff = DeepDiff(
-            controller.context.new_desired_state, controller.context.discovered_actual_state, ignore_order=True)
+        controller.context.diff = controller.context.diffs.get(controller.context.new_desired_state,
+                                                               controller.context.discovered_actual_state,
+                                                               controller.context.rules)
         print(controller.context.diff)
         controller.context.stream.put_message(
             Diff(0, now(), convert_diff(controller.context.diff)))
 
         if controller.context.diff:
+            # The pipelined validation is for a state that did not converge
+            controller.context.pipeline_result = None
             controller.changeState(Reconcile2)
         else:
             controller.context.current_desired_state = controller.context.new_desired_state
@@ -293,18 +543,49 @@ Diff2 = _Diff2()
 
 class _Retry(State):
 
+    @transitions('Revert')
     def start(self, controller):
         controller.context.stream.put_message(FSMState(0, now(), 'Retry'))
 
-    @transitions('Revert')
-    def failure(self, controller, message_type, message):
+        monitor = controller.context
 
-        controller.changeState(Revert)
+        if monitor.retries is None or monitor.retries.exhausted():
+            if monitor.retries is not None:
+                monitor.retries.reset()
+            controller.changeState(Revert)
+            return
+
+        delay = monitor.retries.next_delay()
+        print('retrying failed hosts', sorted(monitor.failed_hosts), 'in', delay)
+        monitor.start_run(desired_state_retry,
+                          monitor.secrets,
+                          monitor.project_src,
+                          monitor.current_desired_state,
+                          monitor.new_desired_state,
+                          monitor.rules,
+                          monitor.inventory,
+                          delay,
+                          failed_rules(monitor.ran_rules, monitor.failed_hosts, monitor.processed_hosts))
 
+    @transitions('Retry')
     @transitions('Discover1')
-    def success(self, controller, message_type, message):
+    def onPlaybookFinished(self, controller, message_type, message):
+
+        monitor = controller.context
+
+        if not finished_run(monitor, message):
+            return
 
-        controller.changeState(Discover1)
+        monitor.ran_rules = message.result
+        defer_excluded_hosts(monitor, monitor.current_desired_state)
+        if should_retry(monitor):
+            controller.changeState(Retry)
+        else:
+            monitor.retries.reset()
+            controller.changeState(Discover1)
+
+    def onDesiredState(self, controller, message_type, message):
+        preempt_run(controller.context, message)
 
 
 Retry = _Retry()
@@ -0,0 +1,127 @@
+'''
+Retention of PlaybookRunner directories.
+
+Every PlaybookRunner run has its own private data directory with the staged
+project, the generated vars files, and the ansible-runner artifacts.   A
+RunRetention keeps the directories of recent runs for debugging and removes
+older ones in a background thread so that the directories do not fill up the
+temp directory.
+
+The rules file can set the retention policy of a monitor:
+
+    retention:
+      keep: 20                  # number of runs to keep
+      max_bytes: 100000000      # total size of the runs to keep
+      keep_failed_only: true    # remove successful runs right away
+      export_dir: /var/log/desired-state
+      export: failed            # copy artifacts of failed (or all) runs before removal
+'''
+
+import os
+import shutil
+from collections import deque
+
+import gevent
+
+
+def run_size(path):
+    '''
+    Returns the number of bytes used only by the files in path.  Files that are
+    hardlinked from the staged project snapshot are not counted.
+    '''
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if stat.st_nlink == 1:
+                size += stat.st_size
+    return size
+
+
+def remove_run(path, export_dir=None):
+    '''
+    Copies the artifacts of the run in path to export_dir if it is set and
+    removes path.
+    '''
+
+    artifacts = os.path.join(path, 'artifacts')
+    if export_dir is not None and os.path.isdir(artifacts):
+        shutil.copytree(artifacts, os.path.join(export_dir, os.path.basename(path)), dirs_exist_ok=True)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class RunRetention(object):
+
+    '''
+    RunRetention keeps at most `keep` runs using at most `max_bytes` and
+    removes the oldest runs first.
+    '''
+
+    def __init__(self, keep=20, max_bytes=None, keep_failed_only=False, export_dir=None, export='failed'):
+        if export not in ('failed', 'all'):
+            raise Exception(f'Invalid retention export {export} expected failed or all')
+        self.keep = keep
+        self.max_bytes = max_bytes
+        self.keep_failed_only = keep_failed_only
+        self.export_dir = export_dir
+        self.export = export
+        self.runs = deque()
+        self.total_bytes = 0
+        self.pending = []
+
+    def add(self, path, result):
+        '''
+        Adds the directory of a finished run.  Result is the result of the run
+        which is True for a successful run.
+        '''
+
+        if self.keep_failed_only and result:
+            self.remove(path, result)
+            return
+        size = run_size(path)
+        self.runs.append((path, result, size))
+        self.total_bytes += size
+        while self.runs and (len(self.runs) > self.keep or
+                             (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            path, result, size = self.runs.popleft()
+            self.total_bytes -= size
+            self.remove(path, result)
+
+    def remove(self, path, result):
+        export_dir = None
+        if self.export_dir is not None and (self.export == 'all' or not result):
+            export_dir = self.export_dir
+        self.pending = [job for job in self.pending if not job.ready()]
+        self.pending.append(gevent.get_hub().threadpool.spawn(remove_run, path, export_dir))
+
+    def join(self):
+        '''
+        Waits for the pending removals to finish.
+        '''
+
+        for job in self.pending:
+            job.get()
+        self.pending = []
+
+
+def build_run_retention(rules):
+    '''
+    Returns the RunRetention for the retention policy in the rules file or
+    the shared default RunRetention if there is no policy.
+    '''
+
+    retention = rules.get('retention')
+    if retention is None:
+        return run_retention
+    return RunRetention(keep=retention.get('keep', 20),
+                        max_bytes=retention.get('max_bytes'),
+                        keep_failed_only=retention.get('keep_failed_only', False),
+                        export_dir=retention.get('export_dir'),
+                        export=retention.get('export', 'failed'))
+
+
+run_retention = RunRetention()
@@ -0,0 +1,95 @@
+'''
+Retries of the rules that failed on some hosts.
+
+When an apply run fails on some hosts the subtrees of the rules that
+succeeded are converged and only the rules that were run on the failed hosts
+are run again.   The retries wait longer after each failure with exponential
+backoff and random jitter so that retries of many monitors do not run at the
+same time.   When the retries are exhausted the monitor reverts to the current
+desired state (see reconciliation_fsm.py).
+
+The rules file enables retries:
+
+    retry:
+      max_attempts: 3
+      base_delay: 1
+      max_delay: 60
+      jitter: 0.5       # fraction of the delay that is random
+'''
+
+import random
+
+
+# playbook_on_stats counters of hosts that failed
+FAILED_STATS = ['failures', 'dark']
+
+
+def failed_hosts(data):
+    '''
+    Returns the hosts that failed or were unreachable in a playbook_on_stats
+    event or None for other events.
+    '''
+
+    if data.get('event', '') != 'playbook_on_stats':
+        return None
+    event_data = data.get('event_data', {})
+    failed = set()
+    for counter in FAILED_STATS:
+        failed.update(host for host, count in (event_data.get(counter) or {}).items() if count)
+    return failed
+
+
+def failed_rules(ran_rules, failed, processed):
+    '''
+    Returns the ran rules that were run on a failed host.  Rules that were run
+    on hosts that are not in the stats of the run, such as groups, are
+    returned if any host failed.
+    '''
+
+    return [ran_rule for ran_rule in ran_rules
+            if ran_rule.inventory_name in failed or (failed and ran_rule.inventory_name not in processed)]
+
+
+class RetryScheduler(object):
+
+    '''
+    RetryScheduler counts the retries of one reconciliation and returns the
+    delay before each retry.
+    '''
+
+    def __init__(self, max_attempts=3, base_delay=1, max_delay=60, jitter=0.5, random=random.random):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.random = random
+        self.attempts = 0
+
+    def exhausted(self):
+        return self.attempts >= self.max_attempts
+
+    def next_delay(self):
+        '''
+        Returns the delay before the next retry and counts the retry.
+        '''
+
+        delay = min(self.max_delay, self.base_delay * 2 ** self.attempts)
+        self.attempts += 1
+        return delay * (1 - self.jitter + self.jitter * self.random())
+
+    def reset(self):
+        self.attempts = 0
+
+
+def build_retry_scheduler(rules):
+    '''
+    Returns a RetryScheduler if the rules file enables retries.
+    '''
+
+    retry = rules.get('retry')
+    if retry is None:
+        return None
+    return RetryScheduler(max_attempts=retry.get('max_attempts', 3),
+                          base_delay=retry.get('base_delay', 1),
+                          max_delay=retry.get('max_delay', 60),
+                          jitter=retry.get('jitter', 0.5))
@@ -1,10 +1,11 @@
 
 
 import re
-from .util import make_matcher, build_rule_selector
+from .util import make_matcher, build_rule_selector, build_inventory_selector, parse_rule_selector
+from .path import INDEX, format_path, parse_path, get_path, compile_path
 from enum import Enum
-from deepdiff import extract
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from gevent.monkey import get_original
 
 
 class Action(Enum):
@@ -25,110 +26,234 @@ ACTION_RULES = {Action.CREATE: 'create',
                 Action.VALIDATE: 'validate'}
 
 
+class PathMatch(object):
+
+    '''
+    PathMatch is the result of matching a path against a rule selector.  It
+    stands in for the re.Match that was used before the selectors were compiled
+    so groups()[0] is the path string of the subtree selected by the rule.
+    '''
+
+    __slots__ = ('path', '_path_string')
+
+    def __init__(self, path):
+        self.path = path
+        self._path_string = None
+
+    def groups(self):
+        if self._path_string is None:
+            self._path_string = format_path(self.path)
+        return (self._path_string,)
+
+
+class SelectorNode(object):
+
+    __slots__ = ('children', 'index', 'rules')
+
+    def __init__(self):
+        self.children = {}
+        self.index = None
+        self.rules = []
+
+
+class RuleSelectorTrie(object):
+
+    '''
+    RuleSelectorTrie compiles the rule selectors of a rules file into one trie
+    of path parts so that a path is matched against all of the rules in a single
+    walk over its parts.  A selector matches a path when it is a prefix of the
+    path where `index` matches any integer part.   Selectors that do not start
+    with root never match a diff path.
+    '''
+
+    def __init__(self, rules):
+        self.root = SelectorNode()
+        for order, rule in enumerate(rules):
+            parts = parse_rule_selector(rule['rule_selector'])
+            if parts[0] != 'root':
+                continue
+            node = self.root
+            for part in parts[1:]:
+                if part == INDEX:
+                    if node.index is None:
+                        node.index = SelectorNode()
+                    node = node.index
+                else:
+                    node = node.children.setdefault(part, SelectorNode())
+            node.rules.append((order, rule))
+
+    def find(self, path):
+        '''
+        Returns the node for path or None if no selector continues along path.
+        '''
+
+        node = self.root
+        for part in path:
+            if isinstance(part, int):
+                node = node.index
+            else:
+                node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def match(self, path):
+        '''
+        Returns a list of (rule, PathMatch) for the rules that match path in
+        the order of the rules.
+        '''
+
+        matches = []
+        node = self.root
+        depth = 0
+        while node is not None:
+            for order, rule in node.rules:
+                matches.append((order, rule, depth))
+            if depth == len(path):
+                break
+            part = path[depth]
+            if isinstance(part, int):
+                node = node.index
+            else:
+                node = node.children.get(part)
+            depth += 1
+        if len(matches) > 1:
+            matches.sort(key=lambda x: x[0])
+        return [(rule, PathMatch(path[:depth])) for _, rule, depth in matches]
+
+
+_compiled_rules = OrderedDict()
+
+# The compiled rule caches are shared with the threads of speculative
+# planning.  The lock is a thread lock even when gevent patches threading.
+_compiled_lock = get_original('threading', 'Lock')()
+
+
+def compile_rules(rules):
+    '''
+    Returns the RuleSelectorTrie for a list of rules compiling it only once
+    for each list of rules.
+    '''
+
+    with _compiled_lock:
+        compiled = _compiled_rules.get(id(rules))
+        if compiled is None or compiled[0] is not rules:
+            compiled = (rules, RuleSelectorTrie(rules))
+            _compiled_rules[id(rules)] = compiled
+            while len(_compiled_rules) > 8:
+                _compiled_rules.popitem(last=False)
+    return compiled[1]
+
+
 def select_rules_recursive(diff, rules, current_desired_state, new_desired_state):
 
     matching_rules = []
-    matchers = [(make_matcher(build_rule_selector(
-        rule['rule_selector'])), rule) for rule in rules]
+    trie = compile_rules(rules)
+
+    def match(change_type, path, value):
+        for rule, path_match in trie.match(path):
+            matching_rules.append((change_type, rule, path_match, value))
 
     for key, value in diff.get('values_changed', {}).items():
-        for (matcher, rule) in matchers:
-            match = re.match(matcher, key)
-            if match:
-                matching_rules.append(('values_changed', rule, match, value))
+        match('values_changed', parse_path(key), value)
 
     for item in diff.get('dictionary_item_added', []):
-        for (matcher, rule) in matchers:
-            match = re.match(matcher, item)
-            if match:
-                matching_rules.append(
-                    ('dictionary_item_added', rule, match, None))
-            new_subtree = extract(new_desired_state, item)
-            select_rules_recursive_helper(
-                diff, matchers, matching_rules, item, new_subtree)
+        path = parse_path(item)
+        match('dictionary_item_added', path, None)
+        new_subtree = get_path(new_desired_state, path)
+        select_rules_recursive_helper(trie, matching_rules, path, new_subtree)
 
     for item in diff.get('dictionary_item_removed', []):
-        for (matcher, rule) in matchers:
-            match = re.match(matcher, item)
-            if match:
-                matching_rules.append(
-                    ('dictionary_item_removed', rule, match, None))
+        match('dictionary_item_removed', parse_path(item), None)
 
     for item in diff.get('iterable_item_added', []):
         print(item)
-        for (matcher, rule) in matchers:
-            match = re.match(matcher, item)
-            if match:
-                matching_rules.append(
-                    ('iterable_item_added', rule, match, None))
+        match('iterable_item_added', parse_path(item), None)
 
     for item in diff.get('iterable_item_removed', []):
         print(item)
-        for (matcher, rule) in matchers:
-            match = re.match(matcher, item)
-            if match:
-                matching_rules.append(
-                    ('iterable_item_removed', rule, match, None))
+        match('iterable_item_removed', parse_path(item), None)
 
     for key, value in diff.get('type_changes', {}).items():
+        path = parse_path(key)
         # Handles case in YAML where an empty list defaults to None type
         if value.get('old_type') == type(None) and value.get('new_type') == list:
             # Add a single new element to the key
             # TODO: this should probably loop over all the new elements in the list not just one
-            key += '[0]'
+            path += (0,)
         elif value.get('old_type') == list and value.get('new_type') == type(None):
             # Add a single new element to the key
-            key += '[0]'
-        for (matcher, rule) in matchers:
-            match = re.match(matcher, key)
-            if match:
-                matching_rules.append(('type_changes', rule, match, None))
+            path += (0,)
+        match('type_changes', path, None)
 
         # Handles case in YAML where an empty dict defaults to None type on the old state
         if value.get('old_type') == type(None) and value.get('new_type') == dict:
             # Try the matcher against all the keys in the dict
             for dict_key in value.get('new_value').keys():
-                new_key = f"{key}['{dict_key}']"
-                for (matcher, rule) in matchers:
-                    match = re.match(matcher, new_key)
-                    if match:
-                        matching_rules.append(
-                            ('type_changes', rule, match, None))
+                match('type_changes', path + (dict_key,), None)
             select_rules_recursive_helper(
-                diff, matchers, matching_rules, key, value.get('new_value'))
+                trie, matching_rules, path, value.get('new_value'))
 
         # Handles case in YAML where an empty dict defaults to None type on the new state
         if value.get('old_type') == dict and value.get('new_type') == type(None):
             # Try the matcher against all the keys in the dict
             for dict_key in value.get('old_value').keys():
-                old_key = f"{key}['{dict_key}']"
-                for (matcher, rule) in matchers:
-                    match = re.match(matcher, old_key)
-                    if match:
-                        matching_rules.append(
-                            ('type_changes', rule, match, None))
+                match('type_changes', path + (dict_key,), None)
             select_rules_recursive_helper(
-                diff, matchers, matching_rules, key, value.get('old_value'))
+                trie, matching_rules, path, value.get('old_value'))
 
     return matching_rules
 
 
-def select_rules_recursive_helper(diff, matchers, matching_rules, path, value):
+def select_rules_recursive_helper(trie, matching_rules, path, value):
+    '''
+    Selects the rules that match the subtree value at path and every subtree
+    below it.   The walk only descends into the branches of value that lead to
+    a rule selector so the rest of the subtree is never visited.
+    '''
 
-    for (matcher, rule) in matchers:
-        match = re.match(matcher, path)
-        if match:
-            matching_rules.append(('subtree', rule, match, value))
+    for rule, path_match in trie.match(path):
+        matching_rules.append(('subtree', rule, path_match, value))
+
+    node = trie.find(path)
+    if node is not None:
+        select_rules_below(node, matching_rules, path, value)
+
+
+def select_rules_below(node, matching_rules, path, value):
+    '''
+    Selects the rules for the children of value.  The rules of the ancestors
+    of a child were already selected with the ancestor and selecting them again
+    would only add duplicates, so only the rules whose selectors end at the
+    child are added.
+    '''
 
     if type(value) is list:
+        child_node = node.index
+        if child_node is None:
+            return
         for i, item in enumerate(value):
-            select_rules_recursive_helper(
-                diff, matchers, matching_rules, f"{path}[{i}]", item)
+            select_rules_child(child_node, matching_rules, path + (i,), item)
 
     if type(value) is dict:
         for k, v in value.items():
-            select_rules_recursive_helper(
-                diff, matchers, matching_rules, f"{path}['{k}']", v)
+            if isinstance(k, int):
+                child_node = node.index
+            else:
+                child_node = node.children.get(k)
+            if child_node is not None:
+                select_rules_child(child_node, matching_rules, path + (k,), v)
+
+
+def select_rules_child(node, matching_rules, path, value):
+
+    if node.rules:
+        path_match = PathMatch(path)
+        for _, rule in node.rules:
+            matching_rules.append(('subtree', rule, path_match, value))
+
+    if node.index is not None or node.children:
+        select_rules_below(node, matching_rules, path, value)
 
 
 def select_rules(diff, rules):
@@ -185,6 +310,42 @@ def select_rules(diff, rules):
     return matching_rules
 
 
+def match_path(match):
+    '''
+    Returns the path tuple of the subtree selected by a PathMatch or re.Match.
+    '''
+
+    if isinstance(match, PathMatch):
+        return match.path
+    return parse_path(match.groups()[0])
+
+
+RulePaths = namedtuple('RulePaths', ['vars', 'inventory_selector'])
+
+_compiled_rule_paths = OrderedDict()
+
+
+def compile_rule_paths(rule):
+    '''
+    Returns the compiled PathAccessors for the vars and inventory_selector of a
+    rule compiling them only once for each rule.
+    '''
+
+    with _compiled_lock:
+        compiled = _compiled_rule_paths.get(id(rule))
+        if compiled is None or compiled[0] is not rule:
+            inventory_selector = rule.get('inventory_selector')
+            if inventory_selector:
+                inventory_selector = compile_path(build_inventory_selector(inventory_selector))
+            compiled = (rule, RulePaths([(name, compile_path(extract_path))
+                                         for name, extract_path in rule.get('vars', {}).items()],
+                                        inventory_selector))
+            _compiled_rule_paths[id(rule)] = compiled
+            while len(_compiled_rule_paths) > 1024:
+                _compiled_rule_paths.popitem(last=False)
+    return compiled[1]
+
+
 def deduplicate_rules(matching_rules):
     # Deduplicate the rules since some rules may match more than once when using recursive rule selection
 
@@ -192,7 +353,7 @@ def deduplicate_rules(matching_rules):
 
     for matching_rule in matching_rules:
         _, _, match, _ = matching_rule
-        changed_subtree_path = match.groups()[0]
+        changed_subtree_path = match_path(match)
         if changed_subtree_path not in dedup_matching_rules:
             dedup_matching_rules[changed_subtree_path] = matching_rule
 
@@ -208,15 +369,15 @@ def get_rule_action_subtree(matching_rule, current_desired_state, new_desired_st
     print('rule', rule)
     print('match', match)
     print('value', value)
-    changed_subtree_path = match.groups()[0]
+    changed_subtree_path = match_path(match)
     print('changed_subtree_path', changed_subtree_path)
     try:
-        new_subtree = extract(new_desired_state, changed_subtree_path)
+        new_subtree = get_path(new_desired_state, changed_subtree_path)
         new_subtree_missing = False
     except (KeyError, IndexError, TypeError):
         new_subtree_missing = True
     try:
-        old_subtree = extract(current_desired_state, changed_subtree_path)
+        old_subtree = get_path(current_desired_state, changed_subtree_path)
         old_subtree_missing = False
     except (KeyError, IndexError, TypeError):
         old_subtree_missing = True
@@ -0,0 +1,153 @@
+'''
+Scheduling of plays onto a pool of ansible-runner runs.
+
+Plays that change different hosts and different subtrees of the state do not
+depend on each other and can run at the same time.   group_plays splits the
+plays for a change into independent units and run_units runs each unit in its
+own PlaybookRunner with at most `size` runs at a time.
+
+Rules may add ordering hints with `sequence`.  All plays for rules with the same
+sequence name run in one unit in the order they were planned.
+'''
+
+import os
+import json
+import yaml
+import tempfile
+import gevent.pool
+import gevent.subprocess
+from collections import OrderedDict
+
+
+_resolved_inventories = OrderedDict()
+
+
+def resolve_inventory_hosts(inventory):
+    '''
+    Returns the set of host names in an inventory in any format that Ansible
+    reads using `ansible-inventory --list`.   The hosts of the most recently
+    used inventories are cached.   Returns an empty set if the inventory
+    cannot be resolved.
+    '''
+
+    hosts = _resolved_inventories.get(inventory)
+    if hosts is not None:
+        _resolved_inventories.move_to_end(inventory)
+        return hosts
+    fd, path = tempfile.mkstemp(prefix='desired_state_inventory')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(inventory)
+        output = gevent.subprocess.check_output(['ansible-inventory', '-i', path, '--list'],
+                                                stdin=gevent.subprocess.DEVNULL,
+                                                stderr=gevent.subprocess.DEVNULL)
+        data = json.loads(output)
+    except (OSError, ValueError, gevent.subprocess.CalledProcessError) as e:
+        print('cannot resolve the hosts of the inventory', e)
+        return set()
+    finally:
+        os.unlink(path)
+    hosts = set(data.get('_meta', {}).get('hostvars', {}))
+    for name, group in data.items():
+        if name != '_meta' and isinstance(group, dict):
+            hosts.update(group.get('hosts', []))
+    _resolved_inventories[inventory] = hosts
+    while len(_resolved_inventories) > 8:
+        _resolved_inventories.popitem(last=False)
+    return hosts
+
+
+def inventory_hosts(inventory):
+    '''
+    Returns the set of host names defined in an inventory.   YAML inventories
+    are read directly and other inventories such as INI inventories are
+    resolved with ansible-inventory.
+    '''
+
+    hosts = set()
+
+    def add_hosts(group):
+        if not isinstance(group, dict):
+            return
+        if isinstance(group.get('hosts'), dict):
+            hosts.update(group['hosts'].keys())
+        for child in (group.get('children') or {}).values():
+            add_hosts(child)
+
+    try:
+        data = yaml.safe_load(inventory)
+    except yaml.YAMLError:
+        data = None
+    if not isinstance(data, dict):
+        print('inventory is not YAML, resolving its hosts with ansible-inventory')
+        return resolve_inventory_hosts(inventory)
+    for group in data.values():
+        add_hosts(group)
+    return hosts
+
+
+def group_plays(plays, ran_rules, hosts):
+    '''
+    Groups plays into units of plays that must run in order.   Two plays are in
+    the same unit if they run on the same host, if the path of one subtree
+    contains the other, or if their rules have the same sequence.   A play
+    that runs on a group or pattern instead of a host in `hosts` may touch any
+    host so all plays run in one unit.
+
+    Returns a list of units each of which is a sorted list of play indexes.
+    '''
+
+    if any(play['hosts'] not in hosts for play in plays):
+        return [list(range(len(plays)))] if plays else []
+
+    parent = list(range(len(plays)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        i, j = find(i), find(j)
+        if i != j:
+            parent[max(i, j)] = min(i, j)
+
+    by_host = {}
+    by_sequence = {}
+    by_path = {}
+    by_prefix = {}
+
+    for i, (play, ran_rule) in enumerate(zip(plays, ran_rules)):
+        union(i, by_host.setdefault(play['hosts'], i))
+        sequence = ran_rule.rule.get('sequence')
+        if sequence is not None:
+            union(i, by_sequence.setdefault(sequence, i))
+        path = ran_rule.path
+        # A planned subtree that is below this one
+        if path in by_prefix:
+            union(i, by_prefix[path])
+        # A planned subtree that is above this one
+        for k in range(len(path)):
+            if path[:k] in by_path:
+                union(i, by_path[path[:k]])
+        by_path.setdefault(path, i)
+        for k in range(len(path) + 1):
+            by_prefix.setdefault(path[:k], i)
+
+    units = {}
+    for i in range(len(plays)):
+        units.setdefault(find(i), []).append(i)
+    return list(units.values())
+
+
+def run_units(units, run_unit, size):
+    '''
+    Calls run_unit for each unit with at most size units running at once and
+    returns the results in the order of the units.
+    '''
+
+    if size <= 1 or len(units) <= 1:
+        return [run_unit(unit) for unit in units]
+    pool = gevent.pool.Pool(size)
+    return pool.map(run_unit, units)
@@ -0,0 +1,129 @@
+'''
+Staging of the project directory for ansible-runner.
+
+Every run of a PlaybookRunner needs a copy of the project files in its private
+data directory.   Instead of copying the project for every run the project is
+copied once into a snapshot for each version of its contents and each run gets
+a directory of hardlinks to the snapshot.   Only the files that are written for
+a run (playbook, vars files) are real files in the run directory.
+
+Files in a staged project must be replaced instead of modified in place since
+they are shared with the snapshot.  See `replace_file`.
+'''
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+from .util import ensure_directory
+
+
+def fingerprint(src):
+    '''
+    Returns a fingerprint of the contents of a directory tree built from the
+    path, size, modification time, and mode of every file in the tree.
+    '''
+
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(src, followlinks=True):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            h.update(f'{os.path.relpath(path, src)}\0{stat.st_size}\0{stat.st_mtime_ns}\0{stat.st_mode}\n'.encode())
+    return h.hexdigest()
+
+
+def link_tree(src, dest):
+    '''
+    Recreates the directory tree of src in dest with hardlinks to the files
+    in src.   Files are copied if they cannot be linked.
+    '''
+
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dest, os.path.relpath(root, src))
+        ensure_directory(target)
+        for name in files:
+            try:
+                os.link(os.path.join(root, name), os.path.join(target, name))
+            except OSError:
+                shutil.copy2(os.path.join(root, name), os.path.join(target, name))
+
+
+def replace_file(path):
+    '''
+    Removes path if it exists so that a new file can be written in its place
+    without changing a file shared with a snapshot.
+    '''
+
+    if os.path.lexists(path):
+        os.unlink(path)
+    return path
+
+
+class ProjectStaging(object):
+
+    '''
+    ProjectStaging keeps one snapshot of each project source directory for the
+    latest version of its contents and stages it into run directories.
+    '''
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or os.path.join(
+            tempfile.gettempdir(), 'desired_state_staging')
+        self.snapshots = dict()
+
+    def snapshot(self, src):
+        '''
+        Returns the snapshot directory for the current contents of src copying
+        src only if its contents changed since the last snapshot.
+        '''
+
+        src = os.path.abspath(src)
+        snapshot = os.path.join(self.cache_dir, fingerprint(src))
+        if not os.path.isdir(snapshot):
+            ensure_directory(self.cache_dir)
+            temp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.snapshot')
+            try:
+                shutil.copytree(src, os.path.join(temp_dir, 'project'))
+                try:
+                    os.rename(os.path.join(temp_dir, 'project'), snapshot)
+                except OSError:
+                    # Another runner made the same snapshot first
+                    if not os.path.isdir(snapshot):
+                        raise
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        previous = self.snapshots.get(src)
+        if previous is not None and previous != snapshot:
+            shutil.rmtree(previous, ignore_errors=True)
+        self.snapshots[src] = snapshot
+        return snapshot
+
+    def stage(self, src, dest):
+        '''
+        Stages the contents of src into the existing directory dest.
+        '''
+
+        link_tree(self.snapshot(src), dest)
+
+
+project_staging = ProjectStaging()
+
+stagings = dict()
+
+
+def project_staging_for(root):
+    '''
+    Returns the ProjectStaging for run directories created in root.  The
+    snapshots are kept in root so that they can be hardlinked into the run
+    directories when root is a different file system.
+    '''
+
+    if root is None:
+        return project_staging
+    staging = stagings.get(root)
+    if staging is None:
+        staging = stagings[root] = ProjectStaging(os.path.join(root, 'desired_state_staging'))
+    return staging
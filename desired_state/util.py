@@ -80,3 +80,12 @@ def build_rule_selector(dotted_selector):
 
 
 build_inventory_selector = build_rule_selector
+
+
+def parse_rule_selector(dotted_selector):
+    '''
+    Parses a dotted selector with the same form as build_rule_selector into
+    a tuple of its parts e.g. ('root', 'key', 'index').
+    '''
+
+    return tuple(dotted_selector.split('.'))
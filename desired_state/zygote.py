@@ -0,0 +1,339 @@
+'''
+A pre-forked ansible-playbook process.
+
+Starting ansible-playbook imports Ansible and loads its plugins before it runs
+a single task which is most of the time of a run for a small change.   The
+zygote is a server process that does this once and then forks a copy of
+itself for each playbook run.
+
+ansible-runner runs a small client script in place of ansible-playbook (see
+`AnsibleZygote.binary`).   The client passes its arguments, environment,
+working directory, and standard streams to the zygote and waits for the forked
+playbook to finish so that ansible-runner handles the output, events, and
+artifacts of the run the same way as for ansible-playbook.
+
+The become password is prompted for by the client where ansible-runner answers
+it from env/passwords like it does for ansible-playbook and is passed to the
+forked playbook over the socket.
+
+Ansible reads its configuration when it is imported so the zygote imports
+Ansible with the environment that ansible-runner sets for every run.   Runs
+with a different Ansible configuration (ANSIBLE_* environment variables or an
+ansible.cfg in the project) are started with ansible-playbook instead.
+
+This module only imports the standard library at the top level since the
+client imports it for every run.
+'''
+
+import os
+import sys
+import json
+import array
+import time
+import signal
+import socket
+import selectors
+import subprocess
+
+# Settings that Ansible reads when a run needs them instead of when it is imported
+RUN_SETTINGS = ('ANSIBLE_CACHE_PLUGIN_CONNECTION',
+                'ANSIBLE_SSH_ARGS',
+                'ANSIBLE_SSH_CONTROL_PATH_DIR')
+
+# Options of ansible-playbook that prompt for the become password
+ASK_BECOME_PASS = ('--ask-become-pass', '-K')
+
+PRELOAD_MODULES = ['ansible.cli.playbook',
+                   'ansible.executor.playbook_executor',
+                   'ansible.executor.task_queue_manager',
+                   'ansible.inventory.manager',
+                   'ansible.vars.manager',
+                   'ansible.parsing.dataloader',
+                   'ansible.playbook',
+                   'ansible.template']
+
+CLIENT = '''#!{python}
+import sys
+sys.path.insert(0, {path!r})
+from desired_state.zygote import client
+client({socket!r})
+'''
+
+SERVER = '''
+import sys
+sys.path.insert(0, {path!r})
+from desired_state.zygote import serve
+serve({socket!r})
+'''
+
+
+def ansible_settings(env):
+    return {k: v for k, v in env.items() if k.startswith('ANSIBLE_') and k not in RUN_SETTINGS}
+
+
+def send_message(conn, message):
+    conn.sendall(json.dumps(message).encode() + b'\n')
+
+
+def receive_message(stream):
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def send_fds(conn, fds):
+    conn.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+
+def receive_fds(conn, count):
+    fds = array.array('i')
+    _, ancdata, _, _ = conn.recvmsg(1, socket.CMSG_LEN(count * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    return list(fds)
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def cold_start(argv):
+    '''
+    Replaces this process with ansible-playbook.
+    '''
+
+    os.execvp('ansible-playbook', ['ansible-playbook'] + argv[1:])
+
+
+def client(socket_path):
+    '''
+    Runs a playbook in a process forked from the zygote listening on
+    socket_path and exits with the return code of the playbook.
+    '''
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except OSError:
+        cold_start(sys.argv)
+    request = dict(argv=sys.argv, env=dict(os.environ), cwd=os.getcwd())
+    if any(option in sys.argv for option in ASK_BECOME_PASS):
+        import getpass
+        request['become_password'] = getpass.getpass('BECOME password: ')
+    send_fds(conn, [0, 1, 2])
+    send_message(conn, request)
+    stream = conn.makefile('rb')
+    reply = receive_message(stream)
+    if reply is None or reply.get('cold'):
+        conn.close()
+        cold_start(sys.argv)
+
+    def forward(signum, frame):
+        try:
+            os.killpg(reply['pid'], signum)
+        except OSError:
+            pass
+
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, forward)
+
+    reply = receive_message(stream)
+    sys.exit(reply['rc'] if reply is not None else 1)
+
+
+def run_playbook(argv, env, cwd, fds, become_password=None):
+    '''
+    Runs ansible-playbook in this forked process.  Does not return.
+    '''
+
+    code = 1
+    try:
+        os.setsid()
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdin = open(0, closefd=False)
+        sys.stdout = open(1, 'w', buffering=1, closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, closefd=False)
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(env)
+        sys.argv = argv
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        from ansible.cli import CLI
+        from ansible.cli.playbook import PlaybookCLI
+        if become_password is not None:
+            # The client already prompted for the become password
+            CLI.ask_passwords = staticmethod(lambda: (None, become_password))
+        if hasattr(PlaybookCLI, 'cli_executor'):
+            PlaybookCLI.cli_executor(argv)
+        else:
+            sys.exit(PlaybookCLI(argv).run())
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException as e:
+        print(e, file=sys.stderr)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def serve(socket_path):
+    '''
+    Imports Ansible and forks a playbook process for each connection to
+    socket_path.
+    '''
+
+    import importlib
+    for name in PRELOAD_MODULES:
+        importlib.import_module(name)
+
+    settings = ansible_settings(os.environ)
+    parent = os.getppid()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server.bind(socket_path + '.new')
+    server.listen(64)
+    # Clients connect only after Ansible is imported
+    os.rename(socket_path + '.new', socket_path)
+
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    runs = {}
+
+    # Exit when the process that started the zygote exits
+    while os.getppid() == parent:
+        for key, _ in selector.select(timeout=0.5):
+            if key.fileobj is server:
+                conn, _ = server.accept()
+                try:
+                    fds = receive_fds(conn, 3)
+                    request = receive_message(conn.makefile('rb'))
+                except (OSError, ValueError):
+                    conn.close()
+                    continue
+                if (request is None or
+                        ansible_settings(request['env']) != settings or
+                        os.path.exists(os.path.join(request['cwd'], 'ansible.cfg'))):
+                    for fd in fds:
+                        os.close(fd)
+                    send_message(conn, dict(cold=True))
+                    conn.close()
+                    continue
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    selector.close()
+                    server.close()
+                    conn.close()
+                    run_playbook(request['argv'], request['env'], request['cwd'], fds,
+                                 request.get('become_password'))
+                for fd in fds:
+                    os.close(fd)
+                send_message(conn, dict(pid=pid))
+                selector.register(conn, selectors.EVENT_READ, pid)
+                runs[pid] = conn
+            elif not key.fileobj.recv(1):
+                # The client exited before the playbook finished
+                selector.unregister(key.fileobj)
+                try:
+                    os.killpg(key.data, signal.SIGKILL)
+                except OSError:
+                    pass
+        while runs:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            conn = runs.pop(pid, None)
+            if conn is None:
+                continue
+            try:
+                selector.unregister(conn)
+            except KeyError:
+                pass
+            try:
+                send_message(conn, dict(rc=exit_code(status)))
+            except OSError:
+                pass
+            conn.close()
+
+
+class AnsibleZygote(object):
+
+    '''
+    AnsibleZygote starts and stops the zygote server process and writes the
+    client script that ansible-runner runs instead of ansible-playbook.
+    '''
+
+    def __init__(self, directory=None, timeout=30):
+        self.directory = directory
+        self.timeout = timeout
+        self.process = None
+
+    @property
+    def socket_path(self):
+        return os.path.join(self.directory, 'zygote.sock')
+
+    def binary(self):
+        '''
+        Returns the path of the client script and starts the zygote if it is
+        not running.
+        '''
+
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        return os.path.join(self.directory, 'ansible-playbook')
+
+    def start(self):
+        import tempfile
+        from ansible_runner.config.runner import RunnerConfig
+
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='desired_state_zygote')
+
+        # Find the environment that ansible-runner sets for a run
+        warm = os.path.join(self.directory, 'warm')
+        os.makedirs(os.path.join(warm, 'project'), exist_ok=True)
+        config = RunnerConfig(private_data_dir=warm, playbook='playbook.yml')
+        config.prepare()
+        env = {k: v for k, v in config.env.items() if isinstance(v, str)}
+
+        path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        client_file = os.path.join(self.directory, 'ansible-playbook')
+        with open(client_file, 'w') as f:
+            f.write(CLIENT.format(python=sys.executable, path=path, socket=self.socket_path))
+        os.chmod(client_file, 0o755)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        with open(os.path.join(self.directory, 'zygote.log'), 'a') as log:
+            self.process = subprocess.Popen([sys.executable, '-c', SERVER.format(path=path, socket=self.socket_path)],
+                                            env=env,
+                                            cwd=self.directory,
+                                            stdin=subprocess.DEVNULL,
+                                            stdout=log,
+                                            stderr=log,
+                                            start_new_session=True)
+        deadline = time.time() + self.timeout
+        while not os.path.exists(self.socket_path):
+            if self.process.poll() is not None or time.time() > deadline:
+                raise Exception(f'Ansible zygote failed to start see {self.directory}/zygote.log')
+            time.sleep(0.05)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.process = None
+
+
+ansible_zygote = AnsibleZygote()
@@ -0,0 +1,45 @@
+import os
+
+from desired_state.connection import ConnectionCache, build_connection_cache, configured_ssh_args
+
+
+def test_build_connection_cache():
+    assert build_connection_cache({'rules': []}) is None
+    assert build_connection_cache({'control_persist': 600}).persist == 600
+
+
+def test_envvars_stable_directory():
+    connections = ConnectionCache(600)
+    envvars = connections.envvars()
+    try:
+        assert os.path.isdir(envvars['ANSIBLE_SSH_CONTROL_PATH_DIR'])
+        assert 'ControlPersist=600s' in envvars['ANSIBLE_SSH_ARGS']
+        assert connections.envvars() == envvars
+    finally:
+        connections.close()
+    assert not os.path.exists(envvars['ANSIBLE_SSH_CONTROL_PATH_DIR'])
+
+
+def test_prewarm_play():
+    play = ConnectionCache(600).prewarm_play()
+    play['tasks'].insert(0, {'name': 'include vars'})
+    assert ConnectionCache(600).prewarm_play()['tasks'] == [{'ping': None, 'name': 'open connection'}]
+
+
+def test_envvars_keep_ssh_args():
+    connections = ConnectionCache(600, ssh_args='-o ControlPersist=30s -o ForwardAgent=yes')
+    try:
+        ssh_args = connections.envvars()['ANSIBLE_SSH_ARGS']
+    finally:
+        connections.close()
+    assert ssh_args == '-o ControlPersist=30s -o ForwardAgent=yes -o ControlMaster=auto -o ControlPersist=600s'
+
+
+def test_configured_ssh_args(tmp_path, monkeypatch):
+    monkeypatch.delenv('ANSIBLE_SSH_ARGS', raising=False)
+    monkeypatch.delenv('ANSIBLE_CONFIG', raising=False)
+    (tmp_path / 'ansible.cfg').write_text('[ssh_connection]\nssh_args = -o ForwardAgent=yes ; agent\n')
+    assert configured_ssh_args(str(tmp_path)) == '-o ForwardAgent=yes'
+    assert build_connection_cache({'control_persist': 600}, str(tmp_path)).ssh_args == '-o ForwardAgent=yes'
+    monkeypatch.setenv('ANSIBLE_SSH_ARGS', '-o User=admin')
+    assert configured_ssh_args(str(tmp_path)) == '-o User=admin'
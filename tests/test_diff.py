@@ -5,6 +5,9 @@ from deepdiff import DeepDiff, extract
 import yaml
 import re
 
+from desired_state.diff import PlaybookRunner
+from desired_state.events import EventFilter
+
 def test_same():
     t1 = {1:1, 2:2, 3:3}
     t2 = t1.copy()
@@ -124,3 +127,179 @@ def test_extract_and_modify():
     extract(t1, parent)[index] = [{'name': 'R5'}, {'name': 'R2'}]
 
     assert extract(t1, "root") == {'routers': [{'name': 'R5'}, {'name': 'R2'}]}
+
+
+def test_diff_cache_reuses_diff():
+
+    from desired_state.diff import DiffCache
+    from desired_state.merkle import StateTreeCache
+
+    t1 = yaml.safe_load('''
+    routers:
+        - name: R1
+        - name: R2
+    ''')
+
+    t2 = yaml.safe_load('''
+    routers:
+        - name: R1
+        - name: R3
+    ''')
+
+    rules = {}
+    diffs = DiffCache(StateTreeCache())
+    diff = diffs.get(t1, t2, rules)
+    assert diff == {'values_changed': {"root['routers'][1]['name']": {'new_value': 'R3', 'old_value': 'R2'}}}
+    assert diffs.get(t1, t2, rules) is diff
+    assert diffs.get(t2, t1, rules) is not diff
+    assert diffs.get(t1, t2, {'diff_engine': 'keyed'}) is not diff
+
+
+def test_diff_cache_list_order():
+
+    from desired_state.diff import DiffCache
+    from desired_state.merkle import StateTreeCache
+
+    rules = {}
+    diffs = DiffCache(StateTreeCache())
+    diffs.get({'r': [{'name': 'R1'}, {'name': 'R2', 'x': 1}]},
+              {'r': [{'name': 'R1'}, {'name': 'R2', 'x': 2}]}, rules)
+    diff = diffs.get({'r': [{'name': 'R2', 'x': 1}, {'name': 'R1'}]},
+                     {'r': [{'name': 'R2', 'x': 2}, {'name': 'R1'}]}, rules)
+    assert list(diff['values_changed']) == ["root['r'][0]['x']"]
+
+
+def test_convert_diff_does_not_modify():
+
+    from desired_state.diff import convert_diff
+
+    diff = DeepDiff({'a': None}, {'a': {'b': 1}, 'c': 1}, ignore_order=True)
+    converted = convert_diff(diff)
+    assert converted == {'dictionary_item_added': ["root['c']"], 'type_changes': ["root['a']"]}
+    assert isinstance(diff['type_changes'], dict)
+
+
+def test_convert_diff_yaml():
+
+    from desired_state.diff import convert_diff
+
+    diff = DeepDiff({'a': 1, 'r': [{'n': 1}]}, {'a': 2, 'r': [{'n': 1}, {'n': 3}]}, ignore_order=True)
+    converted = yaml.safe_load(yaml.safe_dump(convert_diff(diff)))
+    assert converted == {'values_changed': {"root['a']": {'new_value': 2, 'old_value': 1}},
+                         'iterable_item_added': {"root['r'][1]": {'n': 3}}}
+
+
+def test_write_minimal_vars(tmp_path):
+
+    import os
+    import json
+    import datetime
+    from desired_state.diff import uses_full_state
+
+    plays = [{'name': 'a', 'hosts': 'R1', 'tasks': []},
+             {'name': 'b', 'hosts': 'R2', 'tasks': []}]
+    runner = PlaybookRunner(None, {'routers': [{'name': 'R1'}]}, {}, [{'node': 1}, {'node': datetime.date(2024, 1, 2)}], plays,
+                            {'become': ''}, str(tmp_path), '', data_root=str(tmp_path),
+                            minimal_vars=True,
+                            full_state=uses_full_state([{}, {'full_state': True}]))
+    runner.build_project_directory()
+    runner.write_minimal_vars()
+    project = os.path.join(runner.temp_dir, 'project')
+    with open(os.path.join(project, 'destructured_vars_1.json')) as f:
+        assert json.load(f) == {'node': '2024-01-02'}
+    with open(os.path.join(project, 'state_vars.json')) as f:
+        assert json.load(f) == {'routers': [{'name': 'R1'}]}
+    assert [task['name'] for task in plays[0]['tasks']] == ['include destructured_vars']
+    assert [task['name'] for task in plays[1]['tasks']] == ['include destructured_vars',
+                                                            'include diff_vars',
+                                                            'include state_vars']
+
+    runner.full_state = [False, False]
+    runner.build_project_directory()
+    runner.write_minimal_vars()
+    assert not os.path.exists(os.path.join(runner.temp_dir, 'project', 'state_vars.json'))
+
+
+def test_apply_published_states():
+
+    from desired_state.diff import published_states, apply_published_states
+    from desired_state.merkle import StateTreeCache
+
+    def set_stats_event(data, action='set_stats'):
+        return {'event': 'runner_on_ok',
+                'event_data': {'task_action': action,
+                               'res': {'ansible_stats': {'data': data}}}}
+
+    assert published_states({'event': 'runner_on_ok', 'event_data': {'task_action': 'copy'}}) == []
+    assert published_states(set_stats_event({'discovered_state_1': 'x', 'other': 'y'})) == [(1, 'x')]
+
+    tree = StateTreeCache().get({'routers': [{'name': 'R1'}, {'name': 'R2'}]}).copy()
+    discovered_rules = [[0, "root['routers'][0]", {'name': 'R1'}, ('routers', 0)],
+                        [1, "root['routers'][1]", {'name': 'R2'}, ('routers', 1)]]
+    event = set_stats_event({'discovered_state_1': {'name': 'R2', 'up': True}}, 'ansible.builtin.set_stats')
+    assert apply_published_states(tree, discovered_rules, event) == [1]
+    assert tree.state == {'routers': [{'name': 'R1'}, {'name': 'R2', 'up': True}]}
+
+
+def test_cancel_callback_play_boundary():
+
+    cancelled = []
+    runner = PlaybookRunner(lambda data: None, {}, {}, [], [], {}, '.', '',
+                            cancelled=lambda: bool(cancelled), play_boundary=True)
+    runner.runner_process_message({'event': 'playbook_on_play_start'})
+    assert not runner.cancel_callback()
+    cancelled.append(True)
+    assert not runner.cancel_callback()
+    runner.runner_process_message({'event': 'playbook_on_play_start'})
+    assert runner.cancel_callback()
+
+    runner = PlaybookRunner(lambda data: None, {}, {}, [], [], {}, '.', '', cancelled=lambda: True)
+    assert runner.cancel_callback()
+
+
+def test_runner_process_message_event_filter():
+
+    messages = []
+    runner = PlaybookRunner(messages.append, {}, {}, [], [], {}, '.', '',
+                            event_filter=EventFilter(events=['runner_on_ok']))
+    assert runner.runner_process_message({'event': 'verbose'}) is False
+    assert runner.runner_process_message({'event': 'runner_on_ok'}) is False
+    assert messages == [{'event': 'runner_on_ok'}]
+    assert runner.event_filter.dropped == {'verbose': 1}
+
+
+def test_release_before_run():
+
+    class Retention(object):
+
+        def __init__(self):
+            self.runs = []
+
+        def add(self, path, result):
+            self.runs.append((path, result))
+
+    retention = Retention()
+    runner = PlaybookRunner(lambda data: None, {}, {}, [], [], {}, '.', '', retention=retention)
+    runner.release()
+    assert retention.runs == []
+    runner.temp_dir = '/tmp/desired_state_playbook'
+    runner.release()
+    assert retention.runs == [('/tmp/desired_state_playbook', None)]
+
+
+def test_cooperative_runner_no_job_events(tmp_path):
+
+    import os
+    import glob
+
+    events = []
+    plays = [{'name': 'ping', 'hosts': 'localhost', 'gather_facts': False,
+              'tasks': [{'name': 'ok', 'debug': {'msg': 'ok'}}]}]
+    project_src = tmp_path / 'project'
+    project_src.mkdir()
+    runner = PlaybookRunner(events.append, {}, {}, [{}], plays, {'become': ''}, str(project_src),
+                            'all:\n  hosts:\n    localhost:\n      ansible_connection: local\n',
+                            staging=None, cooperative=True, retention=None, data_root=str(tmp_path))
+    assert runner.run()
+    assert 'playbook_on_stats' in [event.get('event') for event in events]
+    assert glob.glob(os.path.join(runner.temp_dir, 'artifacts', '*', 'job_events', '*')) == []
@@ -0,0 +1,131 @@
+from desired_state.diff import RanRule, use_cached_discovery, cache_discovered_states
+from desired_state.discovery import DiscoveryCache, touched_hosts, build_discovery_cache, identity_path
+from desired_state.merkle import StateTreeCache
+
+
+RULE = {'rule_selector': 'root.routers.index', 'list_key': 'name'}
+
+LIST_KEYS = {('routers',): 'name'}
+
+STATE = {'routers': [{'name': 'R1'}, {'name': 'R2'}, {'name': 'R3'}]}
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        return self.time
+
+
+def test_touched_hosts():
+    assert touched_hosts({'event': 'runner_on_ok'}) is None
+    stats = {'event': 'playbook_on_stats',
+             'event_data': {'changed': {'R1': 1, 'R2': 0},
+                            'dark': {'R3': 1},
+                            'failures': {},
+                            'processed': {'R1': 1, 'R2': 1, 'R3': 1}}}
+    assert touched_hosts(stats) == ({'R1', 'R3'}, {'R1', 'R2', 'R3'})
+
+
+def test_identity_path():
+    assert identity_path(STATE, ('routers', 1), LIST_KEYS) == ('routers', ('name', 'R2'))
+    assert identity_path(STATE, ('routers', 1), {}) == ('routers',)
+    assert identity_path(STATE, ('routers', 5, 'x'), LIST_KEYS) == ('routers',)
+
+
+def test_discovery_cache_ttl():
+    clock = Clock()
+    cache = DiscoveryCache(10, clock, LIST_KEYS)
+    subtree = {'name': 'R1'}
+    cache.set(RULE, ('routers', 0), 'R1', STATE, subtree)
+    subtree['up'] = True
+    cached = cache.get(RULE, ('routers', 0), 'R1', STATE)
+    assert cached == ({'name': 'R1'},)
+    cached[0]['up'] = True
+    assert cache.get(RULE, ('routers', 0), 'R1', STATE) == ({'name': 'R1'},)
+    assert cache.get(RULE, ('routers', 0), 'R2', STATE) is None
+    clock.time = 11
+    assert cache.get(RULE, ('routers', 0), 'R1', STATE) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_discovery_cache_identity():
+    cache = DiscoveryCache(10, list_keys=LIST_KEYS)
+    cache.set(RULE, ('routers', 1), 'localhost', STATE, {'name': 'R2', 'up': True})
+    # R0 is inserted before R2
+    state = {'routers': [{'name': 'R0'}, {'name': 'R1'}, {'name': 'R2'}]}
+    assert cache.get(RULE, ('routers', 1), 'localhost', state) is None
+    assert cache.get(RULE, ('routers', 2), 'localhost', state) == ({'name': 'R2', 'up': True},)
+    # Lists without a list_key are not cached
+    cache = DiscoveryCache(10)
+    cache.set(RULE, ('routers', 1), 'localhost', STATE, {'name': 'R2'})
+    assert cache.entries == {}
+
+
+def test_discovery_cache_applied():
+    cache = DiscoveryCache(10, list_keys=LIST_KEYS)
+    cache.set(RULE, ('routers', 0), 'R1', STATE, 1)
+    cache.set(RULE, ('routers', 1), 'R2', STATE, 2)
+    cache.set(RULE, ('routers', 2, 'interfaces'), 'R3', STATE, 3)
+    ran_rules = [RanRule(RULE, '', None, 'R1', ('routers', 0)),
+                 RanRule(RULE, '', None, 'R2', ('routers', 1)),
+                 RanRule(RULE, '', None, 'all', ('routers', 2))]
+    cache.applied(ran_rules[:2], {'R1'}, {'R1', 'R2'}, True, STATE)
+    assert cache.get(RULE, ('routers', 0), 'R1', STATE) is None
+    assert cache.get(RULE, ('routers', 1), 'R2', STATE) == (2,)
+    cache.applied(ran_rules[2:], set(), {'R3'}, True, STATE)
+    assert cache.get(RULE, ('routers', 2, 'interfaces'), 'R3', STATE) is None
+    cache.applied(ran_rules[:2], set(), {'R1', 'R2'}, False, STATE)
+    assert cache.entries == {}
+    assert build_discovery_cache({}) is None
+    assert build_discovery_cache({'discovery_ttl': 5, 'rules': [RULE]}).list_keys == LIST_KEYS
+
+
+def test_use_cached_discovery():
+    cache = DiscoveryCache(10, list_keys=LIST_KEYS)
+    state = {'routers': [{'name': 'R1'}, {'name': 'R2'}]}
+    tree = StateTreeCache().get(state).copy()
+    ran_rules = [RanRule(RULE, "root['routers'][0]", {'name': 'R1'}, 'R1', ('routers', 0)),
+                 RanRule(RULE, "root['routers'][1]", {'name': 'R2'}, 'R2', ('routers', 1))]
+    discovered_rules = [[0, "root['routers'][0]", {'name': 'R1'}, ('routers', 0)],
+                        [1, "root['routers'][1]", {'name': 'R2'}, ('routers', 1)]]
+    cache.set(RULE, ('routers', 1), 'R2', state, {'name': 'R2', 'up': True})
+    plays, destructured_vars_list, uncached = use_cached_discovery(cache, state, tree, ran_rules,
+                                                                   ['play0', 'play1'],
+                                                                   ['vars0', 'vars1'],
+                                                                   discovered_rules)
+    assert (plays, destructured_vars_list, uncached) == (['play0'], ['vars0'], discovered_rules[:1])
+    assert tree.state == {'routers': [{'name': 'R1'}, {'name': 'R2', 'up': True}]}
+    cache_discovered_states(cache, state, tree, ran_rules, discovered_rules, {0})
+    assert cache.get(RULE, ('routers', 0), 'R1', state) == ({'name': 'R1'},)
+
+
+def test_state_digest():
+    from desired_state.discovery import state_digest
+    assert state_digest({'b': 1, 'a': [1, 2]}) == state_digest({'a': [1, 2], 'b': 1})
+    assert state_digest({'a': 1}) != state_digest({'a': 2})
+    import datetime
+    assert state_digest({'a': datetime.datetime(2024, 1, 2, 3, 4)}) == state_digest({'a': '2024-01-02T03:04:00'})
+
+
+def test_published_stats():
+    from desired_state.diff import published_stats
+    event = {'event': 'runner_on_ok',
+             'event_data': {'task_action': 'set_stats',
+                            'res': {'ansible_stats': {'data': {'discovered_digest_2': 'abc',
+                                                               'discovered_state_1': {}}}}}}
+    assert published_stats(event, 'discovered_digest') == [(2, 'abc')]
+
+
+def test_build_digest_discovery_plays(tmp_path):
+    from desired_state.diff import build_discovery_plays, skip_discovery
+    tasks = str(tmp_path)
+    ran_rules = [RanRule({'retrieve': {'tasks': tasks, 'digest_tasks': tasks}}, '', {}, 'R1', ('routers', 0)),
+                 RanRule({'retrieve': {'tasks': tasks}}, '', {}, 'R2', ('routers', 1))]
+    plays, destructured_vars_list, discovered_rules = build_discovery_plays(ran_rules, 'digest_tasks')
+    assert [rule[0] for rule in discovered_rules] == [0]
+    assert plays[0]['tasks'][0]['name'] == 'include retrieve digest'
+    plays, destructured_vars_list, discovered_rules = build_discovery_plays(ran_rules)
+    assert [rule[0] for rule in skip_discovery(plays, destructured_vars_list, discovered_rules, {0})[2]] == [1]
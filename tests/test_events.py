@@ -0,0 +1,120 @@
+import gevent
+
+from desired_state.events import EventFilter, build_event_filter, EventBatcher, build_event_batcher, StdoutSender
+from desired_state.messages import Stdout
+
+
+def make_event(event, action=None, host=None):
+    event_data = {}
+    if action is not None:
+        event_data['task_action'] = action
+    if host is not None:
+        event_data['host'] = host
+    return {'event': event, 'event_data': event_data}
+
+
+def test_event_filter_events():
+    event_filter = EventFilter(events=['runner_on_ok'])
+    assert event_filter.accept(make_event('runner_on_ok', 'shell', 'R1'))
+    assert not event_filter.accept(make_event('verbose'))
+    assert not event_filter.accept(make_event('verbose'))
+    assert event_filter.accept(make_event('playbook_on_stats'))
+    assert event_filter.dropped == {'verbose': 2}
+
+
+def test_event_filter_actions_hosts():
+    event_filter = EventFilter(actions=['shell'], hosts=['R1'])
+    assert event_filter.accept(make_event('runner_on_ok', 'shell', 'R1'))
+    assert not event_filter.accept(make_event('runner_on_ok', 'ping', 'R1'))
+    assert not event_filter.accept(make_event('runner_on_failed', 'shell', 'R2'))
+    assert event_filter.accept(make_event('playbook_on_start'))
+    assert event_filter.dropped == {'runner_on_ok': 1, 'runner_on_failed': 1}
+
+
+def test_build_event_filter():
+    assert build_event_filter({}) is None
+    event_filter = build_event_filter({'event_filter': {'hosts': ['R1']}})
+    assert event_filter.events is None
+    assert event_filter.hosts == {'R1'}
+
+
+class ListStream(object):
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.messages = []
+
+    def put_message(self, message):
+        gevent.sleep(self.delay)
+        self.messages.append(message)
+
+
+def test_event_batcher():
+    stream = ListStream()
+    batcher = EventBatcher(stream, window=0.01, max_events=3)
+    for i in range(5):
+        batcher.put(str(i))
+    batcher.put('')
+    assert stream.messages == []
+    gevent.sleep(0.1)
+    assert [m.stdout for m in stream.messages] == [['0', '1', '2'], ['3', '4']]
+    assert batcher.thread is None
+
+
+def test_event_batcher_slow_stream():
+    stream = ListStream(delay=0.05)
+    batcher = EventBatcher(stream, window=0.01, max_events=10, max_pending=4)
+    batcher.put('0')
+    gevent.sleep(0.02)
+    for i in range(1, 7):
+        batcher.put(str(i))
+    assert len(batcher.pending) == 4
+    gevent.sleep(0.2)
+    assert [m.stdout for m in stream.messages] == [['0'], ['3', '4', '5', '6']]
+    assert [m.dropped for m in stream.messages] == [0, 2]
+    assert batcher.dropped == 2
+
+
+def test_event_batcher_drop_newest():
+    stream = ListStream()
+    batcher = EventBatcher(stream, window=0.01, max_pending=2, policy='drop_newest')
+    for i in range(4):
+        batcher.put(str(i))
+    gevent.sleep(0.05)
+    assert [m.stdout for m in stream.messages] == [['0', '1']]
+    assert build_event_batcher({'event_batch': {}}, stream).policy == 'drop_oldest'
+
+
+def test_event_batcher_close():
+    stream = ListStream()
+    batcher = EventBatcher(stream, window=10)
+    batcher.put('0')
+    batcher.close()
+    assert [m.stdout for m in stream.messages] == [['0']]
+    assert batcher.thread is None
+
+
+def test_event_batcher_close_while_sending():
+    stream = ListStream(delay=0.05)
+    batcher = EventBatcher(stream, window=0.01, max_events=2)
+    for i in range(5):
+        batcher.put(str(i))
+    gevent.sleep(0.02)
+    batcher.close()
+    assert [m.stdout for m in stream.messages] == [['0', '1'], ['2', '3'], ['4']]
+    assert batcher.thread is None
+
+
+def test_event_filter_keeps_set_stats():
+    event_filter = EventFilter(events=['runner_on_failed'], hosts=['R1'])
+    assert event_filter.accept(make_event('runner_on_ok', 'set_stats', 'R2'))
+
+
+def test_stdout_sender():
+    stream = ListStream()
+    sender = build_event_batcher({}, stream)
+    assert isinstance(sender, StdoutSender)
+    sender.put('ok: [R1]')
+    sender.close()
+    assert [type(m) for m in stream.messages] == [Stdout]
+    assert stream.messages[0].stdout == 'ok: [R1]'
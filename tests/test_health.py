@@ -0,0 +1,77 @@
+from desired_state.health import CircuitBreaker, limit_pattern, job_deadline, build_circuit_breaker
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        return self.time
+
+
+def stats(processed, dark=None, failures=None):
+    return {'event': 'playbook_on_stats',
+            'event_data': {'processed': {host: 1 for host in processed},
+                           'dark': {host: 1 for host in dark or []},
+                           'failures': failures or {}}}
+
+
+def unreachable(host):
+    return stats([host], dark=[host])
+
+
+def test_circuit_breaker_cooldown():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=2, cooldown=10, clock=clock)
+    breaker.record(unreachable('R1'))
+    assert breaker.open_hosts() == set()
+    breaker.record(unreachable('R1'))
+    assert breaker.open_hosts() == {'R1'}
+    clock.time = 4
+    assert breaker.reopens_in({'R1', 'R2'}) == 6
+    clock.time = 10
+    assert breaker.open_hosts() == set()
+    # A host that fails after its cool-down opens its circuit again
+    breaker.record(unreachable('R1'))
+    assert breaker.open_hosts() == {'R1'}
+
+
+def test_circuit_breaker_success():
+    breaker = CircuitBreaker(threshold=1, cooldown=10)
+    breaker.record(unreachable('R1'))
+    breaker.record({'event': 'runner_on_ok', 'event_data': {'host': 'R1', 'task': 'include_vars'}})
+    breaker.record(stats(['R1', 'R2'], dark=['R1']))
+    assert breaker.open_hosts() == {'R1'}
+    breaker.record(stats(['R1']))
+    assert breaker.open_hosts() == set()
+
+
+def test_circuit_breaker_one_failure_per_run():
+    breaker = CircuitBreaker(threshold=2, cooldown=10)
+    # Several failed tasks in one run are one failure
+    breaker.record({'event': 'runner_on_failed', 'event_data': {'host': 'R1'}})
+    breaker.record({'event': 'runner_on_failed', 'event_data': {'host': 'R1'}})
+    breaker.record(stats(['R1'], failures={'R1': 2}))
+    assert breaker.open_hosts() == set()
+    breaker.record(stats(['R1'], failures={'R1': 1}))
+    assert breaker.open_hosts() == {'R1'}
+
+
+def test_limit_pattern():
+    assert limit_pattern(set()) is None
+    assert limit_pattern({'R2', 'R1'}) == 'all:!R1:!R2'
+
+
+def test_job_deadline():
+    assert job_deadline({}, [{}, {}]) == 0
+    assert job_deadline({}, [{'deadline': 10}, {'deadline': 20}]) == 30
+    assert job_deadline({}, [{'deadline': 10}, {}]) == 0
+    assert job_deadline({'deadline': 5}, [{'deadline': 10}, {}]) == 15
+    assert job_deadline({'deadline': 5}, []) == 5
+
+
+def test_build_circuit_breaker():
+    assert build_circuit_breaker({}) is None
+    breaker = build_circuit_breaker({'circuit_breaker': {'cooldown': 30}})
+    assert (breaker.threshold, breaker.cooldown) == (1, 30)
@@ -0,0 +1,121 @@
+from deepdiff import DeepDiff
+
+import pytest
+import yaml
+
+from desired_state.keyed_diff import keyed_diff, build_list_keys
+from desired_state.path import format_path
+from desired_state.rule import select_rules_recursive
+from desired_state.diff import deduplicate_rules, get_rule_action_subtree, diff_states
+
+from .util import load_rule, load_state
+
+
+def get_actions(diff, a, b, rules):
+    matching_rules = select_rules_recursive(diff, rules['rules'], a, b)
+    dedup_matching_rules = deduplicate_rules(matching_rules)
+    return [get_rule_action_subtree(x, a, b) for x in dedup_matching_rules]
+
+
+def test_format_path():
+    assert format_path(()) == 'root'
+    assert format_path(('routers', 1, 'name')) == "root['routers'][1]['name']"
+
+
+def test_build_list_keys():
+    rules = yaml.safe_load('''
+    rules:
+    - rule_selector: root.routers.index
+      list_key: name
+    - rule_selector: root.routers.index.interfaces.index
+      list_key: name
+    - rule_selector: root.switch
+    ''')
+    assert build_list_keys(rules) == {('routers',): 'name',
+                                      ('routers', 'index', 'interfaces'): 'name'}
+
+
+def test_build_list_keys_invalid():
+    with pytest.raises(Exception):
+        build_list_keys({'rules': [{'rule_selector': 'root.switch', 'list_key': 'name'}]})
+
+
+def test_same():
+    t1 = load_state('rename_item', 'A')
+    assert keyed_diff(t1, load_state('rename_item', 'A')) == {}
+
+
+def test_reorder_list():
+    assert keyed_diff(load_state('reorder_list', 'A'), load_state('reorder_list', 'B')) == {}
+
+
+def test_values_changed():
+    assert keyed_diff({'a': 1}, {'a': 2}) == {'values_changed': {"root['a']": {'new_value': 2, 'old_value': 1}}}
+
+
+def test_type_changes():
+    diff = keyed_diff({'a': None}, {'a': {'b': 1}})
+    assert diff == {'type_changes': {"root['a']": {'old_type': type(None),
+                                                   'new_type': dict,
+                                                   'old_value': None,
+                                                   'new_value': {'b': 1}}}}
+
+
+def test_dictionary_items():
+    diff = keyed_diff(load_state('rename_key2', 'A'), load_state('rename_key2', 'B'))
+    assert diff == {'dictionary_item_added': ["root['switch']"],
+                    'dictionary_item_removed': ["root['router']"]}
+
+
+def test_unkeyed_list_pairs_items():
+    t1 = {'routers': [{'name': 'R1'}, {'name': 'R2'}]}
+    t2 = {'routers': [{'name': 'R1'}, {'name': 'R3'}]}
+    assert keyed_diff(t1, t2) == DeepDiff(t1, t2, ignore_order=True)
+
+
+def test_keyed_list_add_remove():
+    t1 = {'routers': [{'name': 'R1'}, {'name': 'R2'}]}
+    t2 = {'routers': [{'name': 'R3'}, {'name': 'R1'}]}
+    diff = keyed_diff(t1, t2, {('routers',): 'name'})
+    assert diff == {'iterable_item_added': {"root['routers'][0]": {'name': 'R3'}},
+                    'iterable_item_removed': {"root['routers'][1]": {'name': 'R2'}}}
+
+
+def test_keyed_list_change_uses_new_index():
+    t1 = {'routers': [{'name': 'R1', 'asn': 1}, {'name': 'R2', 'asn': 2}]}
+    t2 = {'routers': [{'name': 'R2', 'asn': 2}, {'name': 'R1', 'asn': 3}]}
+    diff = keyed_diff(t1, t2, {('routers',): 'name'})
+    assert diff == {'values_changed': {"root['routers'][1]['asn']": {'new_value': 3, 'old_value': 1}}}
+
+
+def test_keyed_list_duplicate_keys_falls_back():
+    t1 = {'routers': [{'name': 'R1'}, {'name': 'R1', 'asn': 1}]}
+    t2 = {'routers': [{'name': 'R1'}]}
+    diff = keyed_diff(t1, t2, {('routers',): 'name'})
+    assert diff == {'iterable_item_removed': {"root['routers'][1]": {'name': 'R1', 'asn': 1}}}
+
+
+@pytest.mark.parametrize('name,rules', [('add_dict_value', 'routers_simple'),
+                                        ('add_list_value', 'routers_simple'),
+                                        ('delete_value', 'routers_simple'),
+                                        ('empty_add_item', 'routers_simple'),
+                                        ('rename_item', 'routers_simple'),
+                                        ('rename_key', 'routers_simple'),
+                                        ('rename_key2', 'router_switch'),
+                                        ('reorder_list', 'routers_simple')])
+def test_same_actions_as_deepdiff(name, rules):
+    rules = dict(load_rule(rules), diff_engine='keyed')
+    for a, b in [('A', 'B'), ('B', 'A')]:
+        t1 = load_state(name, a)
+        t2 = load_state(name, b)
+        expected = get_actions(DeepDiff(t1, t2, ignore_order=True), t1, t2, rules)
+        assert get_actions(diff_states(t1, t2, rules), t1, t2, rules) == expected
+
+
+def test_diff_engine_selection():
+    t1 = {'a': 1}
+    t2 = {'a': 2}
+    assert diff_states(t1, t2, {}) == DeepDiff(t1, t2, ignore_order=True)
+    assert diff_states(t1, t2, {'diff_engine': 'keyed'}) == keyed_diff(t1, t2)
+    with pytest.raises(Exception):
+        diff_states(t1, t2, {'diff_engine': 'missing'})
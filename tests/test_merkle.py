@@ -0,0 +1,76 @@
+import copy
+
+from desired_state.merkle import StateTree, StateTreeCache, build_node
+from desired_state.keyed_diff import keyed_diff
+from desired_state.diff import diff_states
+
+from .util import load_state
+
+
+def test_equal_states_same_digest():
+    t1 = load_state('rename_item', 'A')
+    t2 = load_state('rename_item', 'A')
+    assert StateTree(t1).digest == StateTree(t2).digest
+
+
+def test_different_states_different_digest():
+    t1 = load_state('rename_item', 'A')
+    t2 = load_state('rename_item', 'B')
+    assert StateTree(t1).digest != StateTree(t2).digest
+
+
+def test_list_order_ignored():
+    t1 = load_state('reorder_list', 'A')
+    t2 = load_state('reorder_list', 'B')
+    assert StateTree(t1).digest == StateTree(t2).digest
+
+
+def test_type_changes_digest():
+    assert build_node({'a': 1}).digest != build_node({'a': 1.0}).digest
+    assert build_node({'a': 1}).digest != build_node({'a': '1'}).digest
+
+
+def test_set_rehashes_path():
+    t1 = load_state('delete_value', 'A')
+    tree = StateTree(copy.deepcopy(t1)).copy()
+    tree.set(('routers', 0, 'interfaces', 0), {'name': 'eth1'})
+    assert tree.state == load_state('delete_value', 'B')
+    assert tree.digest == StateTree(load_state('delete_value', 'B')).digest
+    tree.set(('routers', 0, 'interfaces', 0), {'name': 'eth1', 'ip_address': '1.1.1.1'})
+    assert tree.digest == StateTree(t1).digest
+
+
+def test_copy_does_not_change_original():
+    tree = StateTree(load_state('delete_value', 'A'))
+    digest = tree.digest
+    tree_copy = tree.copy()
+    tree_copy.set(('routers', 0, 'name'), 'R2')
+    assert tree.digest == digest
+    assert tree.state['routers'][0]['name'] == 'R1'
+
+
+def test_cache_by_identity():
+    cache = StateTreeCache(size=2)
+    t1 = load_state('rename_item', 'A')
+    assert cache.get(t1) is cache.get(t1)
+    assert cache.get(t1) is not cache.get(load_state('rename_item', 'A'))
+    cache.get({})
+    cache.get([])
+    assert len(cache.trees) == 2
+
+
+def test_keyed_diff_skips_equal_subtrees():
+    t1 = {'routers': [{'name': 'R1', 'interfaces': [{'name': 'eth1'}]}, {'name': 'R2'}]}
+    t2 = {'routers': [{'name': 'R1', 'interfaces': [{'name': 'eth1'}]}, {'name': 'R3'}]}
+    expected = keyed_diff(t1, t2)
+    assert keyed_diff(t1, t2, None, build_node(t1), build_node(t2)) == expected
+
+
+def test_diff_states_equal_digests():
+    cache = StateTreeCache()
+    t1 = load_state('reorder_list', 'A')
+    t2 = load_state('reorder_list', 'B')
+    rules = {'diff_engine': 'keyed'}
+    assert diff_states(t1, t2, rules, cache) == {}
+    t3 = load_state('add_list_value', 'B')
+    assert diff_states(t1, t3, rules, cache) == keyed_diff(t1, t3)
@@ -0,0 +1,141 @@
+import gevent
+from gevent_fsm.fsm import NullTracer
+
+from desired_state.monitor import DesiredStateMonitor, DesiredStateQueue
+from desired_state.messages import PlaybookFinished, DesiredState, Poll
+from desired_state.reconciliation_fsm import end_preemption, Help, Reconcile1, Reconcile3, Waiting, Discover1
+from desired_state.diff import RanRule, PipelineResult
+
+
+class ListStream(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def put_message(self, message):
+        self.messages.append(message)
+
+
+def make_monitor():
+    monitor = DesiredStateMonitor(NullTracer, 0, {}, '.', {'rules': []}, {},
+                                  'all:\n  hosts: {}\n', ListStream())
+    monitor.thread.kill()
+    return monitor
+
+
+def test_start_run():
+    monitor = make_monitor()
+    run_id = monitor.start_run(lambda m, x: (m, x * 2), 21)
+    monitor.run_thread.join()
+    assert monitor.queue.get() == PlaybookFinished(run_id, (monitor, 42), None)
+
+
+def test_start_run_error():
+    monitor = make_monitor()
+    error = Exception('failed')
+
+    def fail(m):
+        raise error
+
+    first = monitor.start_run(fail)
+    monitor.run_thread.join()
+    assert monitor.queue.get() == PlaybookFinished(first, None, error)
+    assert monitor.start_run(fail) == first + 1
+
+
+def test_desired_state_queue():
+    queue = DesiredStateQueue()
+    for i in range(3):
+        queue.put(DesiredState(0, '', i, 0, ''))
+    queue.put(Poll())
+    queue.put(DesiredState(0, '', 3, 0, ''))
+    assert queue.skipped == 3
+    assert len(queue) == 2
+    assert queue.get() == Poll()
+    assert queue.get().id == 3
+
+
+def test_cancel_run():
+    monitor = make_monitor()
+    monitor.cancel_run()
+    assert not monitor.run_cancelled(0)
+    run_id = monitor.start_run(lambda m: gevent.sleep(0.01))
+    monitor.cancel_run()
+    assert monitor.run_cancelled(run_id)
+    monitor.run_thread.join()
+    assert not monitor.run_cancelled(monitor.start_run(lambda m: None))
+
+
+def test_speculative_plan():
+    monitor = make_monitor()
+    monitor.rules['speculative_planning'] = True
+    monitor.new_desired_state = {'routers': []}
+    message = DesiredState(0, '', 1, 0, 'routers:\n- name: R1\n')
+    monitor.buffered_messages.put(message)
+    assert monitor.take_plan(DesiredState(0, '', 2, 0, '')) is None
+    plan = monitor.take_plan(message)
+    assert plan.current_desired_state is monitor.new_desired_state
+    assert plan.new_desired_state == {'routers': [{'name': 'R1'}]}
+    assert plan.diff
+    assert monitor.state_trees.get(plan.new_desired_state) is plan.tree
+    assert monitor.take_plan(message) is None
+
+
+def test_end_preemption():
+    monitor = make_monitor()
+    rule = {'rule_selector': 'root.routers.index'}
+    monitor.preempted = True
+    monitor.current_desired_state = {'routers': [{'name': 'R1', 'x': 1}, {'name': 'R2', 'x': 1}]}
+    monitor.discovered_actual_state = {'routers': [{'name': 'R1', 'x': 2}, {'name': 'R2', 'x': 2}]}
+    # Only the subtree of R1 was discovered
+    monitor.discovered_rules = [RanRule(rule, "root['routers'][0]", {}, 'R1', ('routers', 0))]
+    end_preemption(monitor)
+    assert not monitor.preempted
+    assert monitor.current_desired_state == {'routers': [{'name': 'R1', 'x': 2}, {'name': 'R2', 'x': 1}]}
+
+
+def test_speculative_plan_first_desired_state():
+    monitor = make_monitor()
+    monitor.rules['speculative_planning'] = True
+    message = DesiredState(0, '', 1, 0, 'routers:\n- name: R1\n')
+    monitor.buffered_messages.put(message)
+    plan = monitor.take_plan(message)
+    assert plan.current_desired_state is monitor.current_desired_state
+
+
+def test_help_returns_to_waiting():
+    monitor = make_monitor()
+    monitor.failed_hosts = {'R1'}
+    message = DesiredState(0, '', 1, 0, 'routers: []\n')
+    monitor.buffered_messages.put(message)
+    monitor.controller.changeState(Help)
+    assert monitor.controller.state is Waiting
+    assert [m.state for m in monitor.stream.messages if hasattr(m, 'state')][-2:] == ['Help', 'Waiting']
+    # The buffered desired state is handled after the failure
+    assert monitor.queue.get() is message
+
+
+def test_reconcile3_no_rules_succeeds():
+    monitor = make_monitor()
+    monitor.controller.state = Reconcile3
+    monitor.run_id = 1
+    monitor.failed_hosts = set()
+    monitor.controller.handle_message('PlaybookFinished', PlaybookFinished(1, [], None))
+    assert 'Retry' not in [m.state for m in monitor.stream.messages if hasattr(m, 'state')]
+    assert monitor.controller.state is Waiting
+
+
+def test_pipeline_failed_hosts_discover_again():
+    monitor = make_monitor()
+    monitor.rules['pipeline'] = True
+    monitor.controller.state = Reconcile1
+    monitor.run_id = 1
+    monitor.failed_hosts = {'R2'}
+    monitor.new_desired_state = {'routers': [{'name': 'R1'}, {'name': 'R2'}]}
+    result = PipelineResult([], monitor.new_desired_state, None)
+    monitor.controller.handle_message('PlaybookFinished', PlaybookFinished(1, result, None))
+    # Discover1 runs the retrieve plays instead of using the pipelined result
+    assert monitor.controller.state is Discover1
+    assert monitor.pipeline_result is None
+    assert monitor.run_thread is not None
+    monitor.run_thread.kill()
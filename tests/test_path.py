@@ -0,0 +1,59 @@
+import pytest
+
+from desired_state.path import format_path, parse_path, get_path, set_path, compile_path
+from desired_state.rule import compile_rule_paths
+from desired_state.diff import destructure_vars
+
+
+def test_parse_path():
+    assert parse_path("root") == ()
+    assert parse_path("root['routers'][0]['name']") == ('routers', 0, 'name')
+    assert parse_path("node['name']") == ('name',)
+    assert parse_path('root["it\'s"]') == ("it's",)
+    assert parse_path("root['café']['a\\nb']") == ('café', 'a\nb')
+
+
+def test_parse_path_invalid():
+    with pytest.raises(Exception):
+        parse_path("root.routers")
+    with pytest.raises(Exception):
+        parse_path("['routers']")
+
+
+def test_format_parse_round_trip():
+    for path in [(), ('routers', 10, 'interfaces', 0, 'ip_address'), ("it's", 'a\\b'), ('café', 'x')]:
+        assert parse_path(format_path(path)) == path
+
+
+def test_get_set_path():
+    state = {'routers': [{'name': 'R1'}]}
+    assert get_path(state, ('routers', 0, 'name')) == 'R1'
+    set_path(state, ('routers', 0), {'name': 'R2'})
+    assert state == {'routers': [{'name': 'R2'}]}
+
+
+def test_compile_path():
+    accessor = compile_path("root['routers'][0]")
+    assert accessor is compile_path("root['routers'][0]")
+    state = {'routers': [{'name': 'R1'}]}
+    assert accessor.get(state) == {'name': 'R1'}
+    accessor.set(state, {'name': 'R2'})
+    assert state == {'routers': [{'name': 'R2'}]}
+
+
+def test_compile_path_fallback():
+    accessor = compile_path("root[1.5]")
+    assert accessor.path is None
+    assert accessor.get({1.5: 'a'}) == 'a'
+
+
+def test_compile_rule_paths():
+    rule = {'rule_selector': 'root.routers.index',
+            'inventory_selector': 'node.name',
+            'vars': {'router_name': "root['name']",
+                     'first_interface': "root['interfaces'][0]['name']"}}
+    paths = compile_rule_paths(rule)
+    assert paths is compile_rule_paths(rule)
+    subtree = {'name': 'R1', 'interfaces': [{'name': 'eth1'}]}
+    assert paths.inventory_selector.get(subtree) == 'R1'
+    assert destructure_vars(rule, subtree) == {'router_name': 'R1', 'first_interface': 'eth1'}
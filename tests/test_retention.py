@@ -0,0 +1,56 @@
+import os
+
+from desired_state.retention import RunRetention, build_run_retention, run_retention, run_size
+
+
+def make_run(tmp_path, name, size=10):
+    path = tmp_path / name
+    os.makedirs(path / 'artifacts' / 'job')
+    with open(path / 'artifacts' / 'job' / 'rc', 'w') as f:
+        f.write('0' * size)
+    return str(path)
+
+
+def test_keep_last(tmp_path):
+    retention = RunRetention(keep=2)
+    runs = [make_run(tmp_path, f'run{i}') for i in range(4)]
+    for run in runs:
+        retention.add(run, True)
+    retention.join()
+    assert [os.path.exists(run) for run in runs] == [False, False, True, True]
+
+
+def test_max_bytes(tmp_path):
+    retention = RunRetention(max_bytes=25)
+    runs = [make_run(tmp_path, f'run{i}') for i in range(3)]
+    for run in runs:
+        retention.add(run, True)
+    retention.join()
+    assert [os.path.exists(run) for run in runs] == [False, True, True]
+    assert retention.total_bytes == 20
+
+
+def test_keep_failed_only_and_export(tmp_path):
+    export_dir = str(tmp_path / 'export')
+    retention = RunRetention(keep=1, keep_failed_only=True, export_dir=export_dir)
+    passed = make_run(tmp_path, 'passed')
+    failed = [make_run(tmp_path, 'failed1'), make_run(tmp_path, 'failed2')]
+    retention.add(passed, True)
+    for run in failed:
+        retention.add(run, False)
+    retention.join()
+    assert not os.path.exists(passed)
+    assert not os.path.exists(failed[0])
+    assert os.path.exists(failed[1])
+    assert os.listdir(export_dir) == ['failed1']
+
+
+def test_run_size_skips_links(tmp_path):
+    run = make_run(tmp_path, 'run')
+    os.link(os.path.join(run, 'artifacts', 'job', 'rc'), str(tmp_path / 'snapshot_rc'))
+    assert run_size(run) == 0
+
+
+def test_build_run_retention():
+    assert build_run_retention({'rules': []}) is run_retention
+    assert build_run_retention({'retention': {'keep': 3}}).keep == 3
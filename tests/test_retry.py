@@ -0,0 +1,76 @@
+from desired_state.diff import RanRule, converged_state, desired_state_retry
+from desired_state.retry import RetryScheduler, failed_hosts, failed_rules, build_retry_scheduler
+from desired_state.merkle import StateTreeCache
+
+
+RULE = {'rule_selector': 'root.routers.index'}
+
+
+def test_failed_hosts():
+    assert failed_hosts({'event': 'runner_on_failed'}) is None
+    stats = {'event': 'playbook_on_stats',
+             'event_data': {'changed': {'R1': 1},
+                            'dark': {'R3': 1},
+                            'failures': {'R2': 1, 'R1': 0},
+                            'processed': {'R1': 1, 'R2': 1, 'R3': 1}}}
+    assert failed_hosts(stats) == {'R2', 'R3'}
+
+
+def test_failed_rules():
+    ran_rules = [RanRule(RULE, "root.routers[0]", {}, 'R1', ('routers', 0)),
+                 RanRule(RULE, "root.routers[1]", {}, 'R2', ('routers', 1)),
+                 RanRule(RULE, "root.routers", {}, 'routers', ('routers',))]
+    assert failed_rules(ran_rules, {'R2'}, {'R1', 'R2'}) == ran_rules[1:]
+    assert failed_rules(ran_rules, set(), {'R1', 'R2'}) == []
+
+
+def test_retry_scheduler_backoff():
+    scheduler = RetryScheduler(max_attempts=4, base_delay=1, max_delay=5, jitter=0)
+    delays = []
+    while not scheduler.exhausted():
+        delays.append(scheduler.next_delay())
+    assert delays == [1, 2, 4, 5]
+    scheduler.reset()
+    assert not scheduler.exhausted()
+
+
+def test_retry_scheduler_jitter():
+    scheduler = RetryScheduler(base_delay=8, jitter=0.5, random=lambda: 0)
+    assert scheduler.next_delay() == 4
+    scheduler = RetryScheduler(base_delay=8, jitter=0.5, random=lambda: 1)
+    assert scheduler.next_delay() == 8
+
+
+def test_build_retry_scheduler():
+    assert build_retry_scheduler({}) is None
+    scheduler = build_retry_scheduler({'retry': {'max_attempts': 2, 'base_delay': 3}})
+    assert (scheduler.max_attempts, scheduler.base_delay, scheduler.max_delay) == (2, 3, 60)
+
+
+def test_converged_state():
+    state_trees = StateTreeCache()
+    current = {'routers': [{'name': 'R1', 'x': 1}, {'name': 'R2', 'x': 1}]}
+    new = {'routers': [{'name': 'R1', 'x': 2}, {'name': 'R2', 'x': 2}, {'name': 'R3', 'x': 2}]}
+    ran_rules = [RanRule(RULE, "root.routers[0]", {}, 'R1', ('routers', 0)),
+                 RanRule(RULE, "root.routers[2]", {}, 'R3', ('routers', 2)),
+                 RanRule(RULE, "root.routers[4]", {}, 'R5', ('routers', 4))]
+    converged = converged_state(state_trees, current, new, ran_rules)
+    assert converged == {'routers': [{'name': 'R1', 'x': 2}, {'name': 'R2', 'x': 1}, {'name': 'R3', 'x': 2}]}
+    assert current['routers'][0]['x'] == 1
+
+
+class CancelledMonitor(object):
+
+    def __init__(self):
+        self.run_id = 1
+        self.failed_hosts = {'R2'}
+
+    def run_cancelled(self, run_id):
+        return True
+
+
+def test_desired_state_retry_cancelled():
+    monitor = CancelledMonitor()
+    retry_rules = [RanRule(RULE, "root.routers[1]", {}, 'R2', ('routers', 1))]
+    assert desired_state_retry(monitor, {}, '.', {}, {}, {}, '', 0, retry_rules) is retry_rules
+    assert monitor.failed_hosts == set()
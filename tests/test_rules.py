@@ -296,3 +296,58 @@ def test_rules_rename_key2():
     assert actions[0][1] == {'interfaces': [{'ip_address': '1.1.1.1', 'name': 'eth1'}], 'name': 'R1'}
     assert actions[1][0] == Action.DELETE
     assert actions[1][1] == {'interfaces': [{'ip_address': '1.1.1.1', 'name': 'eth1'}], 'name': 'R1'}
+
+
+def test_recursive_selection_prunes_subtrees():
+    '''
+    Adding a large subtree should only select the rules once for each selected
+    subtree and should give the same rules as matching every node.
+    '''
+
+    from desired_state.rule import RuleSelectorTrie, select_rules_recursive_helper
+
+    rules = yaml.safe_load(r'''
+                           rules:
+                            - rule_selector: root.routers.index
+                            - rule_selector: root.routers.index.interfaces.index
+                            - rule_selector: root.switches
+                           ''')
+
+    value = [{'name': f'R{i}',
+              'interfaces': [{'name': f'eth{j}', 'vlans': list(range(10))} for j in range(3)]}
+             for i in range(100)]
+
+    trie = RuleSelectorTrie(rules['rules'])
+
+    def match_every_node(matching_rules, path, value):
+        for rule, match in trie.match(path):
+            matching_rules.append(('subtree', rule, match, value))
+        if type(value) is list:
+            for i, item in enumerate(value):
+                match_every_node(matching_rules, path + (i,), item)
+        if type(value) is dict:
+            for k, v in value.items():
+                match_every_node(matching_rules, path + (k,), v)
+
+    expected = []
+    match_every_node(expected, ('routers',), value)
+    matching_rules = []
+    select_rules_recursive_helper(trie, matching_rules, ('routers',), value)
+
+    assert len(matching_rules) == 100 + 300
+
+    def summary(matching_rules):
+        return [(rule['rule_selector'], match.groups()[0], value)
+                for _, rule, match, value in deduplicate_rules(matching_rules)]
+
+    assert summary(matching_rules) == summary(expected)
+
+
+def test_rule_non_ascii_key():
+
+    rules = {'rules': [{'rule_selector': 'root.café'}]}
+    a = {}
+    b = {'café': {'name': 'R1'}}
+    action, subtree = run_diff_get_action(a, b, rules)
+    assert action == Action.CREATE
+    assert subtree == {'name': 'R1'}
@@ -0,0 +1,77 @@
+import gevent
+
+from desired_state.diff import RanRule
+from desired_state.scheduler import inventory_hosts, group_plays, run_units
+
+
+INVENTORY = '''
+all:
+  hosts:
+    R1:
+    R2:
+  children:
+    switches:
+      hosts:
+        S1:
+'''
+
+
+def make_play(hosts, path, rule=None):
+    return ({'hosts': hosts, 'tasks': []},
+            RanRule(rule or {}, '', None, hosts, path))
+
+
+def group(*plays):
+    return group_plays([p[0] for p in plays], [p[1] for p in plays], {'R1', 'R2', 'S1'})
+
+
+def test_inventory_hosts():
+    assert inventory_hosts(INVENTORY) == {'R1', 'R2', 'S1'}
+    assert inventory_hosts('[all]\nR1\n[routers]\nR2\n') == {'R1', 'R2'}
+
+
+def test_group_plays_disjoint():
+    assert group(make_play('R1', ('routers', 0)),
+                 make_play('R2', ('routers', 1))) == [[0], [1]]
+
+
+def test_group_plays_same_host():
+    assert group(make_play('R1', ('routers', 0)),
+                 make_play('R2', ('routers', 1)),
+                 make_play('R1', ('routers', 2))) == [[0, 2], [1]]
+
+
+def test_group_plays_overlapping_paths():
+    assert group(make_play('R1', ('routers', 0, 'interfaces', 0)),
+                 make_play('R2', ('routers', 1)),
+                 make_play('S1', ('routers', 0))) == [[0, 2], [1]]
+    assert group(make_play('S1', ('routers', 0)),
+                 make_play('R2', ('routers', 1)),
+                 make_play('R1', ('routers', 0, 'interfaces', 0))) == [[0, 2], [1]]
+
+
+def test_group_plays_sequence():
+    assert group(make_play('R1', ('routers', 0), {'sequence': 'a'}),
+                 make_play('R2', ('routers', 1)),
+                 make_play('S1', ('switches', 0), {'sequence': 'a'})) == [[0, 2], [1]]
+
+
+def test_group_plays_unknown_hosts():
+    assert group(make_play('R1', ('routers', 0)),
+                 make_play('all', ('routers', 1))) == [[0, 1]]
+    assert group() == []
+
+
+def test_run_units():
+    running = []
+    peak = []
+
+    def run_unit(unit):
+        running.append(unit)
+        peak.append(len(running))
+        gevent.sleep(0.01)
+        running.remove(unit)
+        return sum(unit)
+
+    assert run_units([[0], [1, 2], [3]], run_unit, 2) == [0, 3, 3]
+    assert max(peak) == 2
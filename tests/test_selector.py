@@ -20,3 +20,41 @@ def test_selector_many_indexes():
 
 def test_selector_name():
     assert r"['name']" == build_rule_selector('name')
+
+
+def test_trie_matches_like_regex():
+    import re
+    from desired_state.util import make_matcher
+    from desired_state.rule import RuleSelectorTrie
+    from desired_state.path import parse_path
+
+    rules = [{'rule_selector': s} for s in ['root.routers.index',
+                                            'root.routers',
+                                            'root',
+                                            'root.routers.index.interfaces.index',
+                                            'root.switch',
+                                            'routers.index']]
+    trie = RuleSelectorTrie(rules)
+
+    for path in ["root",
+                 "root['routers']",
+                 "root['routers'][3]",
+                 "root['routers'][3]['interfaces'][10]['name']",
+                 "root['routers'][3]['name']",
+                 "root['routersX']",
+                 "root['switch']['name']"]:
+        expected = []
+        for rule in rules:
+            match = re.match(make_matcher(build_rule_selector(rule['rule_selector'])), path)
+            if match:
+                expected.append((rule['rule_selector'], match.groups()[0]))
+        assert [(rule['rule_selector'], match.groups()[0])
+                for rule, match in trie.match(parse_path(path))] == expected
+
+
+def test_compile_rules_once():
+    from desired_state.rule import compile_rules
+
+    rules = [{'rule_selector': 'root.routers.index'}]
+    assert compile_rules(rules) is compile_rules(rules)
+    assert compile_rules(rules) is not compile_rules(list(rules))
@@ -0,0 +1,66 @@
+import os
+
+from desired_state.staging import ProjectStaging, replace_file, project_staging, project_staging_for
+
+
+def make_project(path):
+    os.makedirs(os.path.join(path, 'tasks'))
+    with open(os.path.join(path, 'tasks', 'create.yml'), 'w') as f:
+        f.write('- debug: msg=create\n')
+    with open(os.path.join(path, 'playbook.yml'), 'w') as f:
+        f.write('- hosts: all\n')
+
+
+def test_snapshot_reused(tmp_path):
+    src = str(tmp_path / 'src')
+    make_project(src)
+    staging = ProjectStaging(str(tmp_path / 'cache'))
+    assert staging.snapshot(src) == staging.snapshot(src)
+
+
+def test_snapshot_changes_with_contents(tmp_path):
+    src = str(tmp_path / 'src')
+    make_project(src)
+    staging = ProjectStaging(str(tmp_path / 'cache'))
+    first = staging.snapshot(src)
+    with open(os.path.join(src, 'tasks', 'delete.yml'), 'w') as f:
+        f.write('- debug: msg=delete\n')
+    second = staging.snapshot(src)
+    assert first != second
+    assert not os.path.exists(first)
+    assert os.path.exists(os.path.join(second, 'tasks', 'delete.yml'))
+
+
+def test_stage_links_files(tmp_path):
+    src = str(tmp_path / 'src')
+    make_project(src)
+    staging = ProjectStaging(str(tmp_path / 'cache'))
+    for run in ['run1', 'run2']:
+        dest = str(tmp_path / run)
+        os.mkdir(dest)
+        staging.stage(src, dest)
+    snapshot = staging.snapshot(src)
+    for run in ['run1', 'run2']:
+        assert os.path.samefile(os.path.join(snapshot, 'tasks', 'create.yml'),
+                                str(tmp_path / run / 'tasks' / 'create.yml'))
+
+
+def test_replace_file_keeps_snapshot(tmp_path):
+    src = str(tmp_path / 'src')
+    make_project(src)
+    staging = ProjectStaging(str(tmp_path / 'cache'))
+    dest = str(tmp_path / 'run')
+    os.mkdir(dest)
+    staging.stage(src, dest)
+    with open(replace_file(os.path.join(dest, 'playbook.yml')), 'w') as f:
+        f.write('- hosts: localhost\n')
+    with open(os.path.join(staging.snapshot(src), 'playbook.yml')) as f:
+        assert f.read() == '- hosts: all\n'
+
+
+def test_project_staging_for(tmp_path):
+    root = str(tmp_path / 'shm')
+    assert project_staging_for(None) is project_staging
+    staging = project_staging_for(root)
+    assert staging is project_staging_for(root)
+    assert staging.cache_dir == os.path.join(root, 'desired_state_staging')
@@ -0,0 +1,37 @@
+import os
+import socket
+
+from desired_state.zygote import ansible_settings, send_fds, receive_fds, exit_code
+
+
+def test_ansible_settings():
+    env = {'PATH': '/bin',
+           'ANSIBLE_STDOUT_CALLBACK': 'awx_display',
+           'ANSIBLE_CACHE_PLUGIN_CONNECTION': '/tmp/run/fact_cache',
+           'ANSIBLE_SSH_ARGS': '-o ControlPersist=600s',
+           'ANSIBLE_SSH_CONTROL_PATH_DIR': '/tmp/ds_cp'}
+    assert ansible_settings(env) == {'ANSIBLE_STDOUT_CALLBACK': 'awx_display'}
+
+
+def test_send_fds():
+    a, b = socket.socketpair()
+    r, w = os.pipe()
+    try:
+        send_fds(a, [w])
+        fds = receive_fds(b, 3)
+        assert len(fds) == 1
+        os.write(fds[0], b'x')
+        os.close(fds[0])
+        assert os.read(r, 1) == b'x'
+    finally:
+        for fd in (r, w):
+            os.close(fd)
+        a.close()
+        b.close()
+
+
+def test_exit_code():
+    pid = os.fork()
+    if pid == 0:
+        os._exit(3)
+    assert exit_code(os.waitpid(pid, 0)[1]) == 3